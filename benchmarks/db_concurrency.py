@@ -0,0 +1,148 @@
+""" Writer throughput and reader latency with readers in other
+    processes, with the default SQLite profile and the tuned one.
+    Then the wait of a second writer, like --gc or --release, while
+    the tasks transfer a file inside or outside their transaction.
+
+    python benchmarks/db_concurrency.py [readers] [seconds] [transfer ms]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from peewee import OperationalError
+from gdclient import database as db
+from db_lookup import fill
+
+ROWS = 20000
+
+# sqlite3 defaults, rollback journal and full sync
+DEFAULT = {'PRAGMAS': (), 'READ_PRAGMAS': (('query_only', 1),),
+           'BUSY_TIMEOUT': 5}
+
+
+def writer(database, seconds, results, transfer=0, inside=False):
+    db.connect(database, '/Photos', 'Sync_Dir')
+    count = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        # a task: it's transfer, record updates and the journal entry
+        if not inside:
+            time.sleep(transfer)
+        with db.atomic():
+            if inside:
+                time.sleep(transfer)
+            db.Record.update(status=db.Status.synced).where(
+                db.Record.id == random.randint(1, ROWS)).execute()
+            entry = db.Journal.create(task='UPDATE', item='{}', status=1)
+            db.journal_done(entry.id)
+        count += 1
+    db.close()
+    results.put(('writer', count / seconds))
+
+
+def other_writer(database, seconds, results):
+    """ Short write transactions of another process. """
+    db.connect(database, '/Photos', 'Sync_Dir')
+    latencies, errors = [], 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            with db.atomic():
+                db.Journal.update(attempts=0).where(
+                    db.Journal.status == db.JournalStatus.quarantined
+                ).execute()
+        except OperationalError:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+    db.close()
+    results.put(('other', latencies, errors))
+
+
+def reader(database, seconds, results):
+    conn = db.connect_readonly(database)
+    latencies, errors = [], 0
+    end = time.perf_counter() + seconds
+    with conn.bind_ctx(db.MODELS):
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            try:
+                db.Journal.select().where(
+                    db.Journal.status == db.JournalStatus.pending).count()
+                db.Record.get_by_id(random.randint(1, ROWS))
+            except OperationalError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+    conn.close()
+    results.put(('reader', latencies, errors))
+
+
+def run(profile, readers, seconds, transfer=0, inside=False):
+    for name, value in profile.items():
+        setattr(db, name, value)
+
+    directory = tempfile.mkdtemp()
+    database = os.path.join(directory, 'bench.sqlite')
+    db.connect(database, '/Photos', 'Sync_Dir')
+    fill(ROWS)
+    db.close()
+
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(
+        target=writer, args=(database, seconds, results, transfer, inside))]
+    procs += [multiprocessing.Process(target=reader,
+                                      args=(database, seconds, results))
+              for i in range(readers)]
+    if transfer:
+        procs.append(multiprocessing.Process(
+            target=other_writer, args=(database, seconds, results)))
+    for p in procs:
+        p.start()
+    collected = [results.get() for p in procs]
+    for p in procs:
+        p.join()
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+    writes = [r[1] for r in collected if r[0] == 'writer'][0]
+    kind = 'other' if transfer else 'reader'
+    latencies = sorted(l for r in collected if r[0] == kind for l in r[1])
+    errors = sum(r[2] for r in collected if r[0] == kind)
+    return writes, latencies, errors
+
+
+def main():
+    readers = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    transfer = float(sys.argv[3]) / 1e3 if len(sys.argv) > 3 else 0.2
+
+    tuned = {name: getattr(db, name) for name in DEFAULT}
+    for name, profile in [('default', DEFAULT), ('tuned', tuned)]:
+        writes, latencies, errors = run(profile, readers, seconds)
+        print("%-8s writer %7.0f tasks/s, %d readers %8d reads, "
+              "p50 %6.2f ms, p99 %7.2f ms, max %7.1f ms, %d errors" % (
+                  name, writes, readers, len(latencies),
+                  latencies[len(latencies) // 2] * 1e3,
+                  latencies[int(len(latencies) * 0.99)] * 1e3,
+                  latencies[-1] * 1e3, errors))
+
+    for name, inside in [('inside', True), ('outside', False)]:
+        writes, latencies, errors = run(tuned, readers, seconds,
+                                        transfer, inside)
+        print("transfer %-7s the transaction: %5.1f tasks/s, second writer "
+              "%5d writes, p50 %7.2f ms, max %7.1f ms, %d errors" % (
+                  name, writes, len(latencies),
+                  latencies[len(latencies) // 2] * 1e3,
+                  latencies[-1] * 1e3, errors))
+
+
+if __name__ == '__main__':
+    main()
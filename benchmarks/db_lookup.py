@@ -0,0 +1,100 @@
+""" Latency of the live record lookup at a path, with the path hash
+    index and with the former path index, and of an album move.
+
+    python benchmarks/db_lookup.py [rows]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gdclient import database as db, utils
+from gdclient.local_fs import LinuxFS
+
+LOOKUPS = 20000
+
+QUERY = ("SELECT id FROM record INDEXED BY %s WHERE %s path = ? "
+         "AND is_dir = 0 AND fstype = 'LinuxFS' AND deleted = 0")
+
+
+def row(path, parent, is_dir, i=None):
+    return {
+        'name': os.path.basename(path), 'fstype': db.FileType.LinuxFS,
+        'path': path, 'path_hash': utils.path_hash(path), 'id_str': path,
+        'parent': parent, 'is_dir': is_dir, 'deleted': False,
+        'status': db.Status.synced, 'size': i,
+        'md5': '%032x' % i if i is not None else None}
+
+
+def fill(count):
+    # the root is record 1, album k is record k + 2
+    rows = [row('Sync_Dir', None, True)]
+    rows += [row('Sync_Dir/Album %d' % k, 1, True)
+             for k in range((count + 999) // 1000)]
+    for i in range(count):
+        path = 'Sync_Dir/Album %d/IMG_%06d.jpg' % (i // 1000, i)
+        rows.append(row(path, i // 1000 + 2, False, i))
+        if len(rows) >= 5000:
+            with db.atomic():
+                db.Record.insert_many(rows).execute()
+            rows = []
+    with db.atomic():
+        db.Record.insert_many(rows).execute()
+
+
+def timed(lookup, paths):
+    start = time.perf_counter()
+    for path in paths:
+        lookup(path)
+    return (time.perf_counter() - start) / len(paths) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    directory = tempfile.mkdtemp()
+    database = os.path.join(directory, 'bench.sqlite')
+    try:
+        db.connect(database, '/Photos', 'Sync_Dir')
+        start = time.perf_counter()
+        fill(count)
+        print("Inserted %d rows in %.1f s, %.0f MB" % (
+            count, time.perf_counter() - start,
+            os.path.getsize(database) / 2**20))
+
+        paths = ['Sync_Dir/Album %d/IMG_%06d.jpg' % (i // 1000, i)
+                 for i in random.sample(range(count), LOOKUPS)]
+        conn = db._db.connection()
+
+        by_hash = QUERY % ('record_path_hash_fstype_is_dir_deleted',
+                           'path_hash = ? AND')
+        print("path hash index:      %6.1f us" % timed(
+            lambda p: conn.execute(
+                by_hash, (utils.path_hash(p), p)).fetchall(), paths))
+
+        print("database.file_exists: %6.1f us" % timed(
+            lambda p: db.file_exists(LinuxFS(p, False)), paths))
+
+        start = time.perf_counter()
+        db.move(LinuxFS('Sync_Dir/Album 7', True), 'Sync_Dir/Album 7 moved')
+        print("album move:           %6.1f ms" % (
+            (time.perf_counter() - start) * 1e3))
+
+        conn.execute("VACUUM")
+        size = os.path.getsize(database)
+        conn.execute("CREATE INDEX record_path ON record (path)")
+        by_path = QUERY % ('record_path', '')
+        print("path index:           %6.1f us, %.0f MB more" % (
+            timed(lambda p: conn.execute(by_path, (p,)).fetchall(), paths),
+            (os.path.getsize(database) - size) / 2**20))
+    finally:
+        db.close()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
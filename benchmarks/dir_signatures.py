@@ -0,0 +1,58 @@
+""" Local scan without a snapshot, of a tree where one file changed,
+    with and without the directory signatures.
+
+    python benchmarks/dir_signatures.py [files]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gdclient import utils, database as db
+from gdclient.local_fs import LinuxFS
+from gdclient.gdclient import PyGDClient
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    directory = tempfile.mkdtemp()
+    local = os.path.join(directory, 'Sync_Dir')
+    settings = os.path.join(directory, 'settings.json')
+    utils.save_dict({'local_root_path': local, 'remote_root_path': '/Photos',
+                     'db_file': os.path.join(directory, 'bench.sqlite'),
+                     'token_pickle': os.path.join(directory, 'token.pk')},
+                    settings)
+    try:
+        client = PyGDClient(settings)
+        db.add(LinuxFS(local, True))
+        for i in range(count):
+            album = os.path.join(local, 'Album %d' % (i // 100))
+            if i % 100 == 0:
+                os.makedirs(album)
+                db.add(LinuxFS(album, True))
+            path = os.path.join(album, 'IMG_%04d.jpg' % i)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+            db.add(LinuxFS(path))
+
+        with open(os.path.join(local, 'Album 0', 'IMG_0000.jpg'), 'ab') as f:
+            f.write(b'changed')
+
+        for name in ['without', 'with']:
+            if name == 'with':
+                db.refresh_signatures()
+            client.sync._check_queue = []
+            start = time.perf_counter()
+            client._scan_local()
+            print("%-7s signatures: %6.2f s, %d queued" % (
+                name, time.perf_counter() - start, client.sync.pending()))
+    finally:
+        db.close_all()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
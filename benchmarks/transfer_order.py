@@ -0,0 +1,76 @@
+""" Files transferred before a deadline in discovery order and with the
+    scheduler order, on a simulated link, and the rate kept by the
+    bandwidth cap.
+
+    python benchmarks/transfer_order.py [small files] [MB/s] [minutes]
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gdclient import scheduler
+
+
+class Item:
+    def __init__(self, name, size, mtime):
+        self.name = name
+        self.path = 'Sync_Dir/' + name
+        self._size = size
+        self._mtime = mtime
+
+    def size(self):
+        return self._size
+
+    def modifiedTime(self):
+        return self._mtime
+
+
+def simulate(items, rate, seconds):
+    """ Files and bytes done before the deadline, one at a time. """
+    elapsed, files, done = 0, 0, 0
+    for item in items:
+        elapsed += item.size() / rate
+        if elapsed > seconds:
+            break
+        files += 1
+        done += item.size()
+    return files, done
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    minutes = float(sys.argv[3]) if len(sys.argv) > 3 else 60
+
+    rnd = random.Random(1)
+    items = [Item('IMG_%05d.jpg' % i, rnd.randint(2, 8) * 2**20, i)
+             for i in range(count)]
+    # a large video found early in the scan
+    items.insert(count // 10, Item('video.mkv', 50 * 2**30, 0))
+
+    sched = scheduler.Scheduler({})
+    for name, order in [('discovery', items),
+                        ('scheduler', sorted(items, key=sched.key))]:
+        files, done = simulate(order, rate * 2**20, minutes * 60)
+        print("%-9s order: %5d of %d files, %6.0f MB in %g minutes" % (
+            name, files, len(items), done / 2**20, minutes))
+
+    # 2 MB/s cap with the chunk loop of a transfer
+    cap = 2 * 2**20
+    scheduler.set_limits(upload=cap)
+    chunk = scheduler.chunk_size(scheduler.UPLOAD, 100 * 2**20)
+    start = time.perf_counter()
+    for i in range(6):
+        scheduler.throttle(scheduler.UPLOAD, chunk)
+    print("capped upload: %.2f MB/s with a second of burst, cap %.2f MB/s, "
+          "%d KB chunks" % (
+        6 * chunk / (time.perf_counter() - start) / 2**20, cap / 2**20,
+        chunk // 1024))
+    scheduler.set_limits()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+""" Memory used by the in-memory remote and local file trees.
+
+    python benchmarks/tree_memory.py [items]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gdclient.local_fs import LinuxFS
+from gdclient.remote_fs import GDriveFS
+from gdclient.filesystem import MimeTypes
+
+
+def responses(count):
+    """ Api responses of a tree with 100 files per directory. """
+    for i in range(count):
+        if i % 100 == 0:
+            yield {'id': 'dir_%d' % i, 'name': 'Album %d' % i,
+                   'mimeType': MimeTypes.gdrive_directory,
+                   'modifiedTime': '2019-05-21T12:10:12.000Z',
+                   'parents': ['root'], 'trashed': False}
+        else:
+            yield {'id': 'file_%d' % i, 'name': 'IMG_%04d.jpg' % (i % 100),
+                   'mimeType': 'image/jpeg', 'size': str(i * 1024),
+                   'md5Checksum': '%032x' % i,
+                   'modifiedTime': '2019-05-21T12:10:12.000Z',
+                   'parents': ['dir_%d' % (i - i % 100)], 'trashed': False}
+
+
+def measure(build):
+    tracemalloc.start()
+    tree = build()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(tree), size
+
+
+def remote_tree(count):
+    tree = []
+    for response in responses(count):
+        tree.append(GDriveFS(response, '/Photos'))
+    return tree
+
+
+def local_tree(directory):
+    root = LinuxFS(directory, True)
+    root.list_dir(recursive=True)
+    tree = []
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        tree.append(item)
+        stack.extend(item.children)
+    return tree
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    n, size = measure(lambda: remote_tree(count))
+    print("Remote: %d items, %.1f MB, %d bytes per item" %
+          (n, size / 2**20, size / n))
+
+    directory = tempfile.mkdtemp()
+    try:
+        for i in range(min(count, 20000)):
+            if i % 100 == 0:
+                parent = os.path.join(directory, 'Album %d' % i)
+                os.makedirs(parent)
+            open(os.path.join(parent, 'IMG_%04d.jpg' % (i % 100)), 'w').close()
+
+        n, size = measure(lambda: local_tree(directory))
+        print("Local:  %d items, %.1f MB, %d bytes per item" %
+              (n, size / 2**20, size / n))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ from google.auth.transport.requests import Request
 from . import log
 
 service = None
+_services = {}
 _token_pickle = None
 _scopes = ['https://www.googleapis.com/auth/drive.metadata.readonly']
 
@@ -29,12 +30,28 @@ def update_scopes(scope_items, _token_pickle):
         log.trace("Remove ", _token_pickle)
 
 
+def activate(_token_pickle):
+    """ Switch to the API service already built for an account.
+        Returns False if the account is not authenticated yet. """
+    global service
+
+    if _token_pickle in _services:
+        service = _services[_token_pickle]
+        return True
+    return False
+
+
 def authenticate(credentials_file, _token_pickle):
     global _scopes, service
 
     if len(_scopes) == 0:
         raise ValueError("Scopes not set, please set scopes first")
 
+    # one service per account, shared by the sync roots
+    if activate(_token_pickle):
+        log.trace("Reusing API service for", _token_pickle)
+        return
+
     creds = None
     if os.path.exists(_token_pickle):
         with open(_token_pickle, 'rb') as token:
@@ -90,4 +107,5 @@ def authenticate(credentials_file, _token_pickle):
         log.critical("Failed building API service")
         raise
     else:
+        _services[_token_pickle] = service
         log.trace("API service build OK")
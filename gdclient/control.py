@@ -0,0 +1,88 @@
+import os
+import json
+import socket
+
+DEFAULT_SOCKET = '.gdcli.sock'
+MAX_COMMAND = 4096
+
+
+class ControlServer:
+    """ Unix domain socket server for a running client.
+        Each connection sends one command line and receives
+        one json response, then the connection is closed.
+        Does not log, so the thin client stays quiet. """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+        # remove a stale socket left by a previous run
+        if os.path.exists(socket_path):
+            try:
+                request(socket_path, "status", timeout=1)
+            except OSError:
+                os.remove(socket_path)
+            else:
+                raise RuntimeError("Already serving on", socket_path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def accept(self):
+        """ Accept the waiting connections, return a list
+            of (connection, command) tuples. """
+        commands = []
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return commands
+
+            conn.settimeout(5)
+            try:
+                data = b''
+                while not data.endswith(b'\n') and len(data) < MAX_COMMAND:
+                    chunk = conn.recv(MAX_COMMAND)
+                    if not chunk:
+                        break
+                    data += chunk
+                commands.append((conn, data.decode().strip()))
+            except OSError:
+                # client went away, nothing to reply to
+                conn.close()
+
+    def reply(self, conn, response):
+        try:
+            conn.sendall(json.dumps(response, default=str).encode() + b'\n')
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def request(socket_path, command, timeout=None):
+    """ Send a command to a running client and return the response. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(command.strip().encode() + b'\n')
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.decode())
@@ -1,9 +1,13 @@
 import os
-from datetime import datetime
+import json
+from urllib.request import pathname2url
+from datetime import datetime, timedelta
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
 from . import log
 from . import filesystem
+from . import utils
 
 from .errors import *
 from .local_fs import LinuxFS
@@ -13,6 +17,31 @@ _local_root = None
 _remote_root = None
 _db = SqliteDatabase(None)
 
+# open databases by file name, one per sync root
+_connections = {}
+
+# number of values in an IN query, below the SQLite variable limit
+QUERY_BATCH = 500
+
+# Connection profile. In WAL mode readers in other processes do not
+# wait for the writer, and synchronous NORMAL only syncs at checkpoints.
+# auto_vacuum only applies to new files, older ones are switched by gc().
+PRAGMAS = (
+    ('auto_vacuum', 'incremental'),
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -32 * 1024),
+    ('mmap_size', 256 * 2**20),
+)
+READ_PRAGMAS = (
+    ('cache_size', -8 * 1024),
+    ('mmap_size', 256 * 2**20),
+    ('query_only', 1),
+)
+
+# seconds to wait for the lock of another connection
+BUSY_TIMEOUT = 30
+
 
 class Status:
     queued = 1
@@ -20,6 +49,23 @@ class Status:
     modified = 3
 
 
+class JournalStatus:
+    pending = 1
+    done = 2
+    failed = 3
+    quarantined = 4
+
+
+# Failed tasks are retried with exponential backoff, in seconds,
+# and quarantined after the maximum attempts
+RETRY_DELAY = 60
+RETRY_MAX_DELAY = 6 * 3600
+RETRY_ATTEMPTS = 8
+
+# Deleted records are purged by gc() after this many days
+TOMBSTONE_DAYS = 30
+
+
 class FileType:
     LinuxFS = 'LinuxFS'
     DriveFS = 'DriveFS'
@@ -34,6 +80,12 @@ class Configs(BaseModel):
     changeToken = CharField(max_length=10, null=True)
     remote_root_id = CharField(max_length=512, null=True)
 
+    # RFC3339 UTC time of the start of the last successful sync
+    last_sync = CharField(max_length=32, null=True)
+
+    # Number of the migrations applied to the database file
+    schema_version = IntegerField(default=0)
+
 
 class Record(BaseModel):
     # Basename of the file
@@ -43,7 +95,13 @@ class Record(BaseModel):
     fstype = CharField(max_length=16)
 
     # We will match mirrors using paths
-    path = CharField(max_length=4096, index=True)
+    path = CharField(max_length=4096)
+
+    # Directory record containing this one, null for the roots
+    parent = ForeignKeyField('self', null=True, backref='children', index=True)
+
+    # 64 bit hash of the path, for compact equality lookups
+    path_hash = IntegerField(null=True)
 
     # If filesystem has an id instead of path
     id_str = CharField(max_length=512, index=True, null=True)
@@ -60,35 +118,320 @@ class Record(BaseModel):
     mimeType = CharField(max_length=64, null=True)
 
     time_added = DateTimeField(default=datetime.utcnow)
-    time_modified = DateTimeField(null=True)
     time_updated = DateTimeField(null=True)
 
+    # Modified time in integer nanoseconds since the epoch
+    mtime_ns = IntegerField(null=True)
+
     # Applies to files only, not directories
     md5 = CharField(max_length=33, null=True)
     size = IntegerField(null=True)
 
+    # Local files only, used to detect moves and renames
+    inode = IntegerField(null=True)
+
+    # Directories only, signature of the subtree from the children's
+    # records, null when a child changed since it was computed
+    signature = IntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            # content index to find duplicates
+            (('md5', 'size', 'fstype'), False),
+            # live record at a path
+            (('path_hash', 'fstype', 'is_dir', 'deleted'), False),
+        )
+
+
+class Journal(BaseModel):
+    # Planned sync tasks, written before execution
+    task = CharField(max_length=16)
+
+    # json of the item and it's mirror file objects
+    item = TextField()
+    mirror = TextField(null=True)
+
+    # One of the types from Class JournalStatus
+    status = IntegerField(index=True)
+
+    # Last failure, retry not before next_try
+    error_class = CharField(max_length=64, null=True)
+    error = CharField(max_length=512, null=True)
+    attempts = IntegerField(default=0)
+    next_try = DateTimeField(null=True)
+
+    time_added = DateTimeField(default=datetime.utcnow)
+    time_updated = DateTimeField(null=True)
+
+
+class ScanDir(BaseModel):
+    # Frontier of the remote tree scan, directories to be listed
+    id_str = CharField(max_length=512, unique=True)
+    path = CharField(max_length=4096)
+
+    # Page to continue listing from, null for the first page
+    page_token = TextField(null=True)
+    listed = BooleanField(default=False, index=True)
+
+
+class ScanItem(BaseModel):
+    # Items found by the remote tree scan, as api response json
+    parent_path = CharField(max_length=4096)
+    item = TextField()
+
+
+class Pair(BaseModel):
+    # A local record and it's remote mirror, written once synced
+    local = ForeignKeyField(Record, unique=True, backref='remote_pair')
+    remote = ForeignKeyField(Record, unique=True, backref='local_pair')
+
+    # Signature of both sides when last synced, files only
+    size = IntegerField(null=True)
+    md5 = CharField(max_length=33, null=True)
+
+    time_synced = DateTimeField(default=datetime.utcnow)
+
 
 def connect(database_file, remote_root_path, local_root_path):
     """ Initialize the database, connect, create tables if needed.
-            Return the database object. """
-    global _remote_root, _local_root
+            Return the database object.
+            If another database is already open, it's kept open and
+            this one becomes the current database. """
+    global _remote_root, _local_root, _db
 
     _remote_root = remote_root_path
     _local_root = local_root_path
 
-    if _db.is_closed():
-        try:
-            _db.init(database_file)
-            _db.connect()
-            _db.create_tables([Record, Configs])
-            log.trace("Database connect OK:", database_file)
-        except Exception as ex:
-            log.critical("Failed to load database file", database_file)
-            raise
+    # switch to an already open database
+    if database_file in _connections \
+            and not _connections[database_file].is_closed():
+        _db = _connections[database_file]
+        _db.bind(MODELS)
+        return _db
+
+    if not _db.is_closed():
+        # keep the other root's database open
+        _db = SqliteDatabase(None)
+
+    try:
+        _db.init(database_file, pragmas=PRAGMAS, timeout=BUSY_TIMEOUT)
+        _register_functions(_db)
+        _db.bind(MODELS)
+        _db.connect()
+
+        new = not Record.table_exists()
+        if not new:
+            _migrate()
+        _db.create_tables(MODELS)
+        if new:
+            _set_schema_version(SCHEMA_VERSION)
+        _connections[database_file] = _db
+        log.trace("Database connect OK:", database_file)
+    except Exception as ex:
+        log.critical("Failed to load database file", database_file)
+        raise
 
     return _db
 
 
+MODELS = [Record, Configs, Journal, ScanDir, ScanItem, Pair]
+
+
+def _register_functions(database):
+    database.register_function(utils.path_hash, 'path_hash', 1)
+    database.register_function(os.path.dirname, 'dirname', 1)
+
+
+def connect_readonly(database_file):
+    """ Open a separate read-only connection to a database file, for
+        status and reporting while another connection syncs. The models
+        are bound to it with it's bind_ctx(MODELS). """
+    database = SqliteDatabase(
+        'file:%s?mode=ro' % pathname2url(os.path.abspath(database_file)),
+        uri=True, pragmas=READ_PRAGMAS, timeout=BUSY_TIMEOUT)
+    _register_functions(database)
+    database.connect()
+    return database
+
+
+def report(database_file):
+    """ Return the statistics, last sync time and journal state of a
+        database file, read through a read-only connection. """
+    database = connect_readonly(database_file)
+    try:
+        with database.bind_ctx(MODELS):
+            result = stats()
+            result['last_sync'] = getLastSync()
+            result['pending'] = Journal.select().where(
+                Journal.status == JournalStatus.pending).count()
+            result['quarantined'] = journal_quarantined()
+    finally:
+        database.close()
+    return result
+
+
+def _schema_version():
+    columns = [c.name for c in _db.get_columns(Configs._meta.table_name)]
+    if 'schema_version' not in columns:
+        return 0
+    config = Configs.select(Configs.schema_version).first()
+    return config.schema_version if config else 0
+
+
+def _set_schema_version(version):
+    if Configs.select().exists():
+        Configs.update(schema_version=version).execute()
+    else:
+        Configs.create(schema_version=version)
+
+
+def _migrate():
+    """ Upgrade an older database file in place, running each
+        migration it has not seen yet in it's own transaction. """
+    version = _schema_version()
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with atomic():
+            migration()
+            _set_schema_version(number)
+        log.say("Database upgraded to version %d:" % number,
+                migration.__doc__.split('.')[0].strip())
+
+
+def _add_missing_columns():
+    """ Add the columns introduced before the schema versions,
+        create_tables only creates the missing tables. """
+
+    # frozen at version 0, later columns come with their own migrations
+    columns = [
+        (Configs, CharField(max_length=32, null=True), 'last_sync'),
+        (Configs, IntegerField(default=0), 'schema_version'),
+        (Record, IntegerField(null=True), 'path_hash'),
+        (Record, IntegerField(null=True), 'mtime_ns'),
+        (Record, IntegerField(null=True), 'inode'),
+        (Journal, CharField(max_length=64, null=True), 'error_class'),
+        (Journal, CharField(max_length=512, null=True), 'error'),
+        (Journal, IntegerField(default=0), 'attempts'),
+        (Journal, DateTimeField(null=True), 'next_try'),
+    ]
+
+    migrator = SqliteMigrator(_db)
+    for model in MODELS:
+        table = model._meta.table_name
+        if not model.table_exists():
+            continue
+        existing = [c.name for c in _db.get_columns(table)]
+        operations = [migrator.add_column(table, name, field)
+                      for cls, field, name in columns
+                      if cls is model and name not in existing]
+        if operations:
+            migrate(*operations)
+            log.trace("Database upgraded:", table)
+
+
+def _convert_modified_times():
+    """ Fill mtime_ns of the records from the time_modified
+        column of the older database files. """
+
+    table = Record._meta.table_name
+    if 'time_modified' not in [c.name for c in _db.get_columns(table)]:
+        return
+
+    cursor = _db.execute_sql(
+        "SELECT id, time_modified FROM %s WHERE mtime_ns IS NULL "
+        "AND time_modified IS NOT NULL" % table)
+    rows = cursor.fetchall()
+    if not rows:
+        return
+
+    with atomic():
+        for idn, value in rows:
+            Record.update(mtime_ns=utils.to_ns(value)).where(
+                Record.id == idn).execute()
+    log.trace("Database upgraded: %d modified times converted" % len(rows))
+
+
+def _pair_existing():
+    """ Pair the synced records of the older database files,
+        by their calculated mirror paths. """
+    Pair.create_table()
+    if Pair.select().exists():
+        return
+
+    remote = {}
+    for r in Record.select(Record.id, Record.path, Record.is_dir).where(
+            (Record.fstype == FileType.DriveFS) & (Record.deleted == False)):
+        remote.setdefault((r.path, r.is_dir), r.id)
+
+    rows = []
+    for r in Record.select(
+            Record.id, Record.path, Record.is_dir, Record.size, Record.md5
+    ).where((Record.fstype == FileType.LinuxFS) & (Record.deleted == False)):
+        mirror = remote.pop((mirror_path(r.path, True), r.is_dir), None)
+        if mirror:
+            rows.append({'local': r.id, 'remote': mirror,
+                         'size': r.size, 'md5': r.md5})
+
+    with atomic():
+        for i in range(0, len(rows), QUERY_BATCH // 5):
+            Pair.insert_many(rows[i:i + QUERY_BATCH // 5]).execute()
+    if rows:
+        log.trace("Database upgraded: %d mirrors paired" % len(rows))
+
+
+def _fill_path_hashes():
+    """ Hash the paths of the existing records. """
+    Record.update(path_hash=fn.path_hash(Record.path)).where(
+        Record.path_hash.is_null()).execute()
+
+
+def _link_parents():
+    """ Link the records to their parent directory records, and
+        drop the path index as the lookups use the path hash. """
+    table = Record._meta.table_name
+    _db.execute_sql("ALTER TABLE %s ADD COLUMN parent_id INTEGER "
+                    "REFERENCES %s (id)" % (table, table))
+    _db.execute_sql("CREATE INDEX IF NOT EXISTS record_parent_id "
+                    "ON %s (parent_id)" % table)
+
+    count = _fill_parents()
+    _db.execute_sql("DROP INDEX IF EXISTS record_path")
+    log.trace("Database upgraded: %d records linked to parents" % count)
+
+
+def _fill_parents():
+    """ Link the live records without a parent to the live directory
+        record at their dirname, in a single statement. """
+    parent = Record.alias()
+    dirname = fn.dirname(Record.path)
+    return Record.update(parent=parent.select(parent.id).where(
+        (parent.path_hash == fn.path_hash(dirname)) &
+        (parent.path == dirname) &
+        (parent.fstype == Record.fstype) &
+        (parent.is_dir == True) &
+        (parent.deleted == False)
+    ).order_by(parent.id).limit(1)).where(
+        Record.parent.is_null() & (Record.deleted == False)).execute()
+
+
+def _add_signatures():
+    """ Add the directory signatures, computed after the next sync. """
+    migrate(SqliteMigrator(_db).add_column(
+        Record._meta.table_name, 'signature', IntegerField(null=True)))
+
+
+# Schema migrations in order, the schema version of a database file is
+# the number of migrations applied. Append new ones, never reorder.
+MIGRATIONS = [
+    _add_missing_columns,
+    _convert_modified_times,
+    _pair_existing,
+    _fill_path_hashes,
+    _link_parents,
+    _add_signatures,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
 def _record_object_from_file(fileObj):
     """ Given a FileSystem object, try to resolve it's
             path from parent IDs and parent record in database and
@@ -114,14 +457,16 @@ def _record_object_from_file(fileObj):
         dbRec.fstype = FileType.DriveFS
 
     dbRec.path = fileObj.path
+    dbRec.path_hash = utils.path_hash(fileObj.path)
     dbRec.is_dir = fileObj.is_dir()
     dbRec.name = fileObj.name
     dbRec.id_str = fileObj.id
     dbRec.status = 0
     dbRec.mimeType = fileObj.mimeType()
-    dbRec.time_modified = fileObj.modifiedTime()
+    dbRec.mtime_ns = fileObj.modifiedTime()
     dbRec.time_updated = None
     dbRec.deleted = fileObj.trashed
+    dbRec.inode = fileObj.inode()
 
     if fileObj.is_file():
         dbRec.md5 = fileObj.md5()
@@ -146,9 +491,10 @@ def _file_object_from_record(dbObj):
     dbFile._md5 = dbObj.md5
     dbFile._size = dbObj.size
     dbFile._is_dir = dbObj.is_dir
-    dbFile._syncTime = dbObj.time_updated
+    dbFile._syncTime = utils.to_ns(dbObj.time_updated)
     dbFile._mimeType = dbObj.mimeType
-    dbFile._modifiedTime = dbObj.time_modified
+    dbFile._modifiedTime = dbObj.mtime_ns
+    dbFile._inode = dbObj.inode
     dbFile.trashed = dbObj.deleted
     return dbFile
 
@@ -157,22 +503,78 @@ def add(item):
     """ Add if not exists. """
     fstype = FileType.LinuxFS if isinstance(
         item, LinuxFS) else FileType.DriveFS
-    results = Record.select().where(
-        (Record.path == item.path) &
-        (Record.is_dir == item.is_dir()) &
-        (Record.fstype == fstype) &
-        (Record.deleted == False)
-    )
+    results = Record.select().where(_live_at(item.path, item.is_dir(), fstype))
     if results.count() > 0:
         log.trace("Database add, already exists: ", item)
         return False
     else:
         fp = _record_object_from_file(item)
+        fp.parent = _parent_id(fp.path, fp.fstype)
         fp.save()
+        _invalidate_signatures(fp.parent_id)
+        if fp.is_dir:
+            _adopt_children(fp)
         log.trace("Database add OK: ", item)
         return True
 
 
+def adopt(pairs):
+    """ Add the records of the (local, remote, md5) pairs of matching
+        items and pair them, in a single transaction. For the first sync
+        of trees that are already the same, instead of a task per item.
+        The md5 is the one already calculated, None for directories. """
+    # the roots may be recorded by an earlier run
+    existing = set(Record.select(Record.fstype, Record.path).where(
+        Record.deleted == False).tuples())
+    pairs = [(local, remote, md5) for local, remote, md5 in pairs
+             if (FileType.LinuxFS, local.path) not in existing and
+             (FileType.DriveFS, remote.path) not in existing]
+
+    rows = []
+    now = datetime.utcnow()
+    for local, remote, md5 in pairs:
+        # same size on both sides, the remote one needs no stat
+        size = None if md5 is None else remote.size()
+        for item, fstype in [(local, FileType.LinuxFS),
+                             (remote, FileType.DriveFS)]:
+            rows.append({
+                'name': item.name,
+                'fstype': fstype,
+                'path': item.path,
+                'path_hash': utils.path_hash(item.path),
+                'id_str': item.id,
+                'is_dir': item.is_dir(),
+                'deleted': False,
+                'status': Status.synced,
+                'mimeType': item.mimeType(),
+                'time_updated': now,
+                'mtime_ns': item.modifiedTime(),
+                'md5': md5,
+                'size': size,
+                'inode': item.inode(),
+            })
+
+    with atomic():
+        batch = QUERY_BATCH // 20
+        for i in range(0, len(rows), batch):
+            Record.insert_many(rows[i:i + batch]).execute()
+        _fill_parents()
+
+        ids = {(fstype, path): idn for idn, fstype, path in Record.select(
+            Record.id, Record.fstype, Record.path
+        ).where(Record.deleted == False).tuples().iterator()}
+        links = [{'local': ids[(FileType.LinuxFS, local.path)],
+                  'remote': ids[(FileType.DriveFS, remote.path)],
+                  'size': None if md5 is None else remote.size(),
+                  'md5': md5} for local, remote, md5 in pairs]
+        batch = QUERY_BATCH // 5
+        for i in range(0, len(links), batch):
+            Pair.insert_many(links[i:i + batch]).execute()
+
+    log.trace("Database adopted:", len(links), "pairs")
+    return len(links)
+
+
 def update(item):
     """ Add or update a database record with the item's properties. """
 
@@ -189,34 +591,229 @@ def update(item):
         mimeType=item.mimeType(),
         status=Status.synced,
         time_updated=datetime.utcnow(),
-        time_modified=item.modifiedTime()
-    ).where(
-        (Record.path == item.path) &
-        (Record.is_dir == item.is_dir()) &
-        (Record.fstype == fstype) &
-        (Record.deleted == False)
-    )
+        mtime_ns=item.modifiedTime(),
+        inode=item.inode()
+    ).where(_live_at(item.path, item.is_dir(), fstype))
     query.execute()
+    record = Record.select(Record.parent).where(
+        _live_at(item.path, item.is_dir(), fstype)).first()
+    if record:
+        _invalidate_signatures(record.parent_id)
     log.trace("Record updated in database:", item)
 
 
 def remove(item):
-    """ Set deleted=True for an item in database """
+    """ Set deleted=True for an item in database, and for all of it's
+        descendants if it's a directory, in a single statement. """
 
     fstype = FileType.LinuxFS if isinstance(
         item, LinuxFS) else FileType.DriveFS
+    found = list(Record.select(Record.id, Record.parent).where(
+        _live_at(item.path, item.is_dir(), fstype)))
+    if not found:
+        log.trace("Database delete, not found:", item)
+        return 0
+    for record in found:
+        _invalidate_signatures(record.parent_id)
+    records = [r.id for r in found]
+    if item.is_dir():
+        records = _subtree(records)
+
+    # the tombstoned descendants are no longer found by the subtree
+    Pair.delete().where(
+        Pair.local.in_(records) | Pair.remote.in_(records)).execute()
+
     query = Record.update(
         deleted=True,
         status=Status.synced,
         time_updated=datetime.utcnow(),
-    ).where(
-        (Record.path == item.path) &
-        (Record.is_dir == item.is_dir()) &
+    ).where(Record.id.in_(records))
+    count = query.execute()
+    log.trace("Database delete:", item, count, "rows")
+    return count
+
+
+def move(item, new_path):
+    """ Rewrite the path of an item and all of it's descendants
+        in a single statement. """
+
+    fstype = FileType.LinuxFS if isinstance(
+        item, LinuxFS) else FileType.DriveFS
+    old_path = item.path
+    found = list(Record.select(Record.id, Record.parent).where(
+        (Record.path_hash == utils.path_hash(old_path)) &
+        (Record.path == old_path) &
         (Record.fstype == fstype) &
-        (Record.deleted == False)
-    )
-    query.execute()
-    log.trace("Database delete:", item)
+        (Record.deleted == False)))
+    if not found:
+        log.trace("Database move, not found:", old_path)
+        return 0
+    for record in found:
+        _invalidate_signatures(record.parent_id)
+    roots = [r.id for r in found]
+
+    new_prefix = Value(new_path).concat(
+        fn.SUBSTR(Record.path, len(old_path) + 1))
+
+    fields = {Record.path: new_prefix,
+              Record.path_hash: fn.path_hash(new_prefix)}
+    if fstype == FileType.LinuxFS:
+        # for local fs, path is id
+        fields[Record.id_str] = new_prefix
+
+    query = Record.update(fields).where(Record.id.in_(_subtree(roots)))
+    count = query.execute()
+
+    new_parent = _parent_id(new_path, fstype)
+    Record.update(
+        name=os.path.basename(new_path),
+        parent=new_parent
+    ).where(Record.id.in_(roots)).execute()
+    _invalidate_signatures(new_parent)
+
+    log.trace("Database move:", old_path, "==>", new_path, count, "rows")
+    return count
+
+
+def _parent_id(path, fstype):
+    """ Return the id of the live directory record containing
+        the path, None if not in database. """
+    parent = Record.select(Record.id).where(
+        _live_at(os.path.dirname(path), True, fstype)).first()
+    return parent.id if parent else None
+
+
+def _adopt_children(record):
+    """ Link the live records added before their directory record.
+        Only the records without a parent are searched. """
+    Record.update(parent=record.id).where(
+        Record.parent.is_null() &
+        (Record.fstype == record.fstype) &
+        (Record.deleted == False) &
+        (Record.id != record.id) &
+        (fn.dirname(Record.path) == record.path)
+    ).execute()
+
+
+def _subtree(record_ids):
+    """ Query of the ids of the given records and all of their live
+        descendants, walking the parent links. """
+    tree = Record.select(Record.id).where(
+        Record.id.in_(record_ids)).cte('tree', recursive=True)
+    child = Record.alias()
+    descendants = child.select(child.id).join(
+        tree, on=(child.parent == tree.c.id)).where(child.deleted == False)
+    tree = tree.union_all(descendants)
+    return tree.select_from(tree.c.id)
+
+
+def get_children(item):
+    """ Return the file objects of the live records directly under
+        a directory, as saved in database. """
+    fstype = FileType.LinuxFS if isinstance(
+        item, LinuxFS) else FileType.DriveFS
+    parent = _live_record(item, fstype)
+    if parent is None:
+        return []
+    results = Record.select().where(
+        (Record.parent == parent.id) & (Record.deleted == False))
+    return [_file_object_from_record(r) for r in results]
+
+
+def get_subtree(item):
+    """ Return the file objects of the live records under a directory
+        at any depth, as saved in database. """
+    fstype = FileType.LinuxFS if isinstance(
+        item, LinuxFS) else FileType.DriveFS
+    parent = _live_record(item, fstype)
+    if parent is None:
+        return []
+    results = Record.select().where(
+        Record.id.in_(_subtree([parent.id])) & (Record.id != parent.id))
+    return [_file_object_from_record(r) for r in results]
+
+
+def _invalidate_signatures(record_id):
+    """ Clear the signature of a directory record and it's ancestors.
+        Stops at a cleared one, it's ancestors are cleared already. """
+    while record_id:
+        record = Record.select(Record.parent, Record.signature).where(
+            Record.id == record_id).first()
+        if record is None or record.signature is None:
+            return
+        Record.update(signature=None).where(Record.id == record_id).execute()
+        record_id = record.parent_id
+
+
+def refresh_signatures():
+    """ Compute the missing signatures of the live directories from
+        their children's records, deepest first.
+        Returns the number of directories signed. """
+    dirs = list(Record.select(Record.id, Record.path, Record.fstype).where(
+        (Record.is_dir == True) &
+        (Record.deleted == False) &
+        Record.signature.is_null()
+    ).tuples())
+    dirs.sort(key=lambda d: d[1].count(os.sep), reverse=True)
+
+    count = 0
+    with atomic():
+        for idn, path, fstype in dirs:
+            entries = []
+            children = Record.select(
+                Record.name, Record.is_dir, Record.size,
+                Record.mtime_ns, Record.md5, Record.signature
+            ).where((Record.parent == idn) & (Record.deleted == False))
+            for name, is_dir, size, mtime_ns, md5, signature in children.tuples():
+                if is_dir:
+                    entries.append((name, True, None, signature))
+                elif fstype == FileType.LinuxFS:
+                    entries.append((name, False, size, mtime_ns))
+                else:
+                    entries.append((name, False, size, md5))
+
+            # a subdirectory could not be signed
+            if any(e[1] and e[3] is None for e in entries):
+                continue
+            Record.update(signature=utils.tree_signature(entries)).where(
+                Record.id == idn).execute()
+            count += 1
+
+    log.trace("Directory signatures computed:", count)
+    return count
+
+
+def get_dir_signatures(fstype):
+    """ Return a dict of path: signature of the live directories. """
+    results = Record.select(Record.path, Record.signature).where(
+        (Record.fstype == fstype) &
+        (Record.is_dir == True) &
+        (Record.deleted == False) &
+        Record.signature.is_null(False)
+    ).tuples()
+    return dict(results.iterator())
+
+
+def _parent_ids(record):
+    """ Return the ids of the live remote parent directory of
+        a record, by it's parent link or else by it's path. """
+    if record.parent_id:
+        results = Record.select(Record.id_str).where(
+            (Record.id == record.parent_id) & (Record.deleted == False))
+    else:
+        results = Record.select(Record.id_str).where(
+            _live_at(os.path.dirname(record.path), True, FileType.DriveFS))
+    return [p.id_str for p in results]
+
+
+def _live_at(path, is_dir, fstype):
+    """ Query condition of the live record at a path, the path hash
+        narrows it down on the composite index. """
+    return ((Record.path_hash == utils.path_hash(path)) &
+            (Record.path == path) &
+            (Record.is_dir == is_dir) &
+            (Record.fstype == fstype) &
+            (Record.deleted == False))
 
 
 def is_empty():
@@ -234,12 +831,7 @@ def file_exists(item):
     except ErrorPathResolve:
         return False
 
-    results = Record.select().where(
-        (Record.path == recItem.path) &
-        (Record.is_dir == recItem.is_dir) &
-        (Record.fstype == fstype) &
-        (Record.deleted == False)
-    )
+    results = Record.select().where(_live_at(recItem.path, recItem.is_dir, fstype))
     return results.count() > 0
 
 
@@ -258,45 +850,84 @@ def get_file_as_db(item):
 
     fstype = FileType.LinuxFS if isinstance(
         item, LinuxFS) else FileType.DriveFS
-    results = Record.select().where(
-        (Record.path == item.path) &
-        (Record.is_dir == item.is_dir()) &
-        (Record.fstype == fstype) &
-        (Record.deleted == False)
-    )
+    results = Record.select().where(_live_at(item.path, item.is_dir(), fstype))
 
     if results.count() > 0:
         result = results[0]
-        dbFile = filesystem.FileSystem()
-
-        dbFile.id = result.id_str
-        dbFile.path = result.path
-        dbFile.name = result.name
-        dbFile._md5 = result.md5
-        dbFile._size = result.size
-        dbFile._is_dir = result.is_dir
-        dbFile._syncTime = result.time_updated
-        dbFile._mimeType = result.mimeType
-        dbFile._modifiedTime = result.time_modified
+        dbFile = _db_file_from_record(
+            result, _synced_signatures([result.id]).get(result.id))
     else:
         return None
 
     # set GDrive type object's parent IDs
     if result.fstype == FileType.DriveFS and not dbFile.parentIds:
-        parent_path = os.path.dirname(dbFile.path)
+        parentIds = _parent_ids(result)
+        if parentIds:
+            dbFile.parentIds = parentIds
+    return dbFile
+
+
+def _db_file_from_record(result, synced=None):
+    """ The item as last seen, with the size and md5 it was last
+        synced at if paired, the base of the three way comparison. """
+    dbFile = filesystem.FileSystem()
+
+    dbFile.id = result.id_str
+    dbFile.path = result.path
+    dbFile.name = result.name
+    dbFile._md5 = result.md5
+    dbFile._size = result.size
+    dbFile._is_dir = result.is_dir
+    dbFile._syncTime = utils.to_ns(result.time_updated)
+    dbFile._mimeType = result.mimeType
+    dbFile._modifiedTime = result.mtime_ns
+    dbFile._inode = result.inode
+    if synced:
+        dbFile._size, dbFile._md5 = synced
+    return dbFile
+
+
+def get_files_as_db(fstype, paths):
+    """ Return a dict of (path, is_dir): file object with the info as
+        saved in database, for the live records at the given paths.
+        Queried in batches, parent IDs are not set. """
+    files = {}
+    paths = sorted(set(paths))
+    for i in range(0, len(paths), QUERY_BATCH):
+        batch = paths[i:i + QUERY_BATCH]
         results = Record.select().where(
-            (Record.path == parent_path) &
-            (Record.is_dir == True) &
-            (Record.fstype == FileType.DriveFS) &
+            (Record.path_hash.in_([utils.path_hash(p) for p in batch])) &
+            (Record.path.in_(batch)) &
+            (Record.fstype == fstype) &
             (Record.deleted == False)
-        )
-        if results.count() > 0:
-            dbFile.parentIds = [p.id_str for p in results]
-    return dbFile
+        ).order_by(Record.id)
+        results = list(results)
+        synced = _synced_signatures(r.id for r in results if not r.is_dir)
+        for result in results:
+            key = (result.path, result.is_dir)
+            if key not in files:
+                files[key] = _db_file_from_record(result, synced.get(result.id))
+    return files
+
+
+def get_paths_by_id(ids):
+    """ Return a dict of id: path of the records with the given IDs,
+        live records preferred as in get_file_by_id. """
+    paths = {}
+    ids = sorted(set(ids))
+    for i in range(0, len(ids), QUERY_BATCH):
+        results = Record.select(Record.id_str, Record.path).where(
+            Record.id_str.in_(ids[i:i + QUERY_BATCH])
+        ).order_by(Record.deleted, Record.id)
+        for result in results:
+            paths.setdefault(result.id_str, result.path)
+    return paths
 
 
 def get_file_by_id(idn):
-    dbObj = Record.select().where(Record.id_str == idn)
+    # prefer the live record, if a deleted one has the same id
+    dbObj = Record.select().where(
+        Record.id_str == idn).order_by(Record.deleted)
     return _file_object_from_record(dbObj[0]) if dbObj.count() > 0 else None
 
 
@@ -313,6 +944,101 @@ def get_all_local():
     return [LinuxFS(r.path, r.is_dir) for r in results]
 
 
+def get_local_signatures():
+    """ Yield the (path, is_dir, size, mtime_ns, inode, md5) of the
+        local items, without building the file objects. """
+    return Record.select(
+        Record.path, Record.is_dir, Record.size,
+        Record.mtime_ns, Record.inode, Record.md5
+    ).where(
+        (Record.deleted == False) &
+        (Record.fstype == FileType.LinuxFS) &
+        (Record.path != os.path.relpath(_local_root))
+    ).tuples().iterator()
+
+
+def get_all_remote():
+    results = Record.select().where(
+        (Record.deleted == False) &
+        (Record.fstype == FileType.DriveFS)
+    )
+    return [_file_object_from_record(r) for r in results]
+
+
+def get_remote_dirs():
+    """ Return a dict of id: path of the remote directories. """
+    results = Record.select(Record.id_str, Record.path).where(
+        (Record.deleted == False) &
+        (Record.is_dir == True) &
+        (Record.fstype == FileType.DriveFS)
+    )
+    return {r.id_str: r.path for r in results if r.id_str}
+
+
+def find_duplicate(item):
+    """ Return a file object on the mirror side with the same content
+        as the item, None if not found. """
+
+    if item.is_dir() or not item.size():
+        return None
+
+    fstype = FileType.DriveFS if isinstance(
+        item, LinuxFS) else FileType.LinuxFS
+
+    size = item.size()
+    same_size = Record.select().where(
+        (Record.size == size) &
+        (Record.fstype == fstype) &
+        (Record.deleted == False)
+    )
+
+    # hash only if there is a candidate
+    if same_size.count() == 0:
+        return None
+
+    results = Record.select().where(
+        (Record.md5 == item.md5()) &
+        (Record.size == size) &
+        (Record.fstype == fstype) &
+        (Record.is_dir == False) &
+        (Record.deleted == False)
+    )
+
+    for result in results:
+        dup = _file_object_from_record(result)
+
+        # make sure the local file has not changed since recorded
+        if isinstance(dup, LinuxFS) and not _same_stat(dup, result):
+            continue
+
+        log.trace("Duplicate content found:", item, result.path)
+        return dup
+    return None
+
+
+def _same_stat(item, record):
+    """ If a local file still has the stat signature saved in the record. """
+    if not item.exists or item.is_dir():
+        return False
+
+    if item.size() != record.size:
+        return False
+
+    if record.inode and item.inode() != record.inode:
+        return False
+
+    return item.modifiedTime() == record.mtime_ns
+
+
+def mirror_path(path, is_local):
+    """ The path of the mirror of a local or remote path. """
+    if is_local:
+        path = os.path.join(_remote_root, os.path.relpath(path, _local_root))
+    else:
+        path = os.path.join(_local_root, os.path.relpath(path, _remote_root))
+    return os.path.normpath(path)
+
+
 def calculate_mirror(item):
     """ Calculate an item's mirror path based on it's 
             parent id or path.
@@ -322,26 +1048,16 @@ def calculate_mirror(item):
     itemRec = _record_object_from_file(item)
     mirror = Record()
     # fix relative path from sync root
+    path = mirror_path(itemRec.path, itemRec.fstype == FileType.LinuxFS)
     if itemRec.fstype == FileType.DriveFS:
-        path = os.path.relpath(itemRec.path, _remote_root)
-        path = os.path.join(_local_root, path)
-        path = os.path.normpath(path)
         mirror = LinuxFS(path, itemRec.is_dir)
     else:
         mirror = GDriveFS()
-        path = os.path.relpath(itemRec.path, _local_root)
-        path = os.path.join(_remote_root, path)
-        path = os.path.normpath(path)
         mirror.set_path_id(path, None, itemRec.is_dir)
 
     if isinstance(mirror, GDriveFS) and not mirror.parentIds:
         parent_path = os.path.dirname(mirror.path)
-        results = Record.select().where(
-            (Record.path == parent_path) &
-            (Record.is_dir == True) &
-            (Record.fstype == FileType.DriveFS) &
-            (Record.deleted == False)
-        )
+        results = Record.select().where(_live_at(parent_path, True, FileType.DriveFS))
         mirror.parentIds = [p.id_str for p in results]
 
     return mirror
@@ -352,36 +1068,31 @@ def get_mirror(item):
         Raises ErrorPathResolve, ErrorNotInDatabase
     """
 
-    mirror = calculate_mirror(item)
+    record = _paired_record(item)
+    if record is None:
+        # not synced since pairs were introduced
+        mirror = calculate_mirror(item)
 
-    fstype = FileType.LinuxFS if isinstance(
-        mirror, LinuxFS) else FileType.DriveFS
-    results = Record.select().where(
-        (Record.path == mirror.path) &
-        (Record.is_dir == mirror.is_dir()) &
-        (Record.fstype == fstype) &
-        (Record.deleted == False)
-    )
+        fstype = FileType.LinuxFS if isinstance(
+            mirror, LinuxFS) else FileType.DriveFS
+        results = Record.select().where(_live_at(mirror.path, mirror.is_dir(), fstype))
 
-    if results.count() == 0:
-        raise ErrorNotInDatabase
+        if results.count() == 0:
+            raise ErrorNotInDatabase
+        record = results[0]
 
-    mirror = _file_object_from_record(results[0])
+    mirror = _file_object_from_record(record)
 
     if isinstance(mirror, GDriveFS) and not mirror.parentIds:
-        parent_path = os.path.dirname(mirror.path)
-        results = Record.select().where(
-            (Record.path == parent_path) &
-            (Record.is_dir == True) &
-            (Record.fstype == FileType.DriveFS) &
-            (Record.deleted == False)
-        )
-        mirror.parentIds = [p.id_str for p in results]
+        mirror.parentIds = _parent_ids(record)
     return mirror
 
 
 def mirror_exists(item):
     """ If mirror item actually exists in database. """
+    if _paired_record(item):
+        return True
+
     try:
         mirror = calculate_mirror(item)
     except ErrorPathResolve:
@@ -389,18 +1100,72 @@ def mirror_exists(item):
     return file_exists(mirror)
 
 
+def _paired_record(item):
+    """ Return the live record paired with the item's record,
+        None if not paired. """
+    if item.path is None:
+        return None
+
+    own = Record.alias()
+    if isinstance(item, LinuxFS):
+        fstype, own_side, mirror_side = FileType.LinuxFS, Pair.local, Pair.remote
+    else:
+        fstype, own_side, mirror_side = FileType.DriveFS, Pair.remote, Pair.local
+
+    return Record.select().join(
+        Pair, on=(mirror_side == Record.id)
+    ).join(
+        own, on=(own_side == own.id)
+    ).where(
+        (own.path_hash == utils.path_hash(item.path)) &
+        (own.path == item.path) &
+        (own.is_dir == item.is_dir()) &
+        (own.fstype == fstype) &
+        (own.deleted == False) &
+        (Record.deleted == False)
+    ).first()
+
+
+def pair(item, mirror):
+    """ Link the records of a synced item and it's mirror, with the
+        signature they were synced at. Replaces their older pairs. """
+    local, remote = (item, mirror) if isinstance(item, LinuxFS) \
+        else (mirror, item)
+    local = _live_record(local, FileType.LinuxFS)
+    remote = _live_record(remote, FileType.DriveFS)
+    if local is None or remote is None:
+        log.trace("Pair, record not found:", item)
+        return False
+
+    Pair.delete().where(
+        (Pair.local == local.id) | (Pair.remote == remote.id)).execute()
+    Pair.create(local=local.id, remote=remote.id,
+                size=local.size, md5=local.md5)
+    return True
+
+
+def _live_record(item, fstype):
+    return Record.select().where(_live_at(item.path, item.is_dir(), fstype)).first()
+
+
+def _synced_signatures(record_ids):
+    """ Return a dict of record id: (size, md5) as last synced. """
+    signatures = {}
+    record_ids = list(record_ids)
+    for i in range(0, len(record_ids), QUERY_BATCH):
+        ids = record_ids[i:i + QUERY_BATCH]
+        for p in Pair.select().where(Pair.local.in_(ids) | Pair.remote.in_(ids)):
+            signatures[p.local_id] = signatures[p.remote_id] = (p.size, p.md5)
+    return signatures
+
+
 def update_status(item, status):
     fstype = FileType.LinuxFS if isinstance(
         item, LinuxFS) else FileType.DriveFS
     query = Record.update(
         status=status,
         time_updated=datetime.utcnow()
-    ).where(
-        (Record.path == item.path) &
-        (Record.is_dir == item.is_dir()) &
-        (Record.fstype == fstype) &
-        (Record.deleted == False)
-    )
+    ).where(_live_at(item.path, item.is_dir(), fstype))
     query.execute()
 
 
@@ -444,8 +1209,354 @@ def getChangeToken():
         return None
 
 
+def setLastSync(time_str):
+    results = Configs.select().limit(1)
+    if results.count() > 0:
+        query = Configs.update(last_sync=time_str).where(Configs.id == 1)
+        query.execute()
+    else:
+        cfg = Configs()
+        cfg.last_sync = time_str
+        cfg.save()
+    log.trace("Last sync time saved in database.")
+
+
+def getLastSync():
+    results = Configs.select().limit(1)
+    if results.count() > 0:
+        return results[0].last_sync
+    else:
+        return None
+
+
+def _file_to_json(item):
+    """ Serialize a file object to be recreated later. """
+    if item is None:
+        return None
+
+    data = {
+        'fstype': FileType.LinuxFS if isinstance(
+            item, LinuxFS) else FileType.DriveFS,
+        'path': item.path,
+        'is_dir': item.is_dir(),
+        'trashed': item.trashed,
+    }
+
+    # local properties are read again from disk
+    if isinstance(item, GDriveFS):
+        data.update({
+            'id': item.id,
+            'name': item.name,
+            'parentIds': item.parentIds,
+            'md5': item._md5,
+            'size': item._size,
+            'mimeType': item._mimeType,
+            'modifiedTime': item._modifiedTime,
+        })
+    return json.dumps(data)
+
+
+def _file_from_json(text):
+    if text is None:
+        return None
+
+    data = json.loads(text)
+    if data['fstype'] == FileType.LinuxFS:
+        item = LinuxFS(data['path'], data['is_dir'])
+    else:
+        item = GDriveFS()
+        item.path = data['path']
+        item.id = data['id']
+        item.exists = True
+        item.name = data['name']
+        item.parentIds = data['parentIds']
+        item._is_dir = data['is_dir']
+        item._md5 = data['md5']
+        item._size = data['size']
+        item._mimeType = data['mimeType']
+        item._modifiedTime = utils.to_ns(data['modifiedTime'])
+    item.trashed = data['trashed']
+    return item
+
+
+def journal_add(tasks):
+    """ Write the (task, item, mirror) tuples to the journal in
+        a single transaction. Returns the list of journal IDs. """
+    ids = []
+    with atomic():
+        for task, item, mirror in tasks:
+            entry = Journal.create(
+                task=task,
+                item=_file_to_json(item),
+                mirror=_file_to_json(mirror),
+                status=JournalStatus.pending
+            )
+            ids.append(entry.id)
+    log.trace("Journal add OK:", len(ids), "tasks")
+    return ids
+
+
+def journal_transferred(jid, mirror):
+    """ Save the mirror a task's transfer made, in it's own transaction,
+        so the task resumed after a crash does not transfer again. """
+    with atomic():
+        Journal.update(
+            mirror=_file_to_json(mirror),
+            time_updated=datetime.utcnow()
+        ).where(Journal.id == jid).execute()
+
+
+def journal_done(jid):
+    Journal.update(
+        status=JournalStatus.done,
+        time_updated=datetime.utcnow()
+    ).where(Journal.id == jid).execute()
+
+
+def journal_failed(jid, ex):
+    """ Record a failed attempt of a journal task and set the next
+        retry time, quarantine it after too many attempts. """
+    entry = Journal.get_by_id(jid)
+    entry.attempts += 1
+    entry.error_class = type(ex).__name__
+    entry.error = str(ex)[:512]
+    entry.time_updated = datetime.utcnow()
+
+    if entry.attempts >= RETRY_ATTEMPTS:
+        entry.status = JournalStatus.quarantined
+        log.warn("Task quarantined after %d attempts:" % entry.attempts,
+                 entry.task, entry.error_class)
+    else:
+        delay = min(RETRY_DELAY * 2 ** (entry.attempts - 1), RETRY_MAX_DELAY)
+        entry.status = JournalStatus.failed
+        entry.next_try = entry.time_updated + timedelta(seconds=delay)
+        log.trace("Task retry in %d seconds:" % delay, entry.task)
+    entry.save()
+
+
+def journal_retry():
+    """ Return the list of (journal ID, (task, item, mirror))
+        of the failed tasks due for a retry. """
+    results = Journal.select().where(
+        (Journal.status == JournalStatus.failed) &
+        (Journal.next_try <= datetime.utcnow())
+    ).order_by(Journal.next_try)
+    return [(r.id, (r.task, _file_from_json(r.item), _file_from_json(r.mirror)))
+            for r in results]
+
+
+def journal_quarantined():
+    return Journal.select().where(
+        Journal.status == JournalStatus.quarantined).count()
+
+
+def journal_release():
+    """ Retry the quarantined tasks from the next run. """
+    count = Journal.update(
+        status=JournalStatus.failed,
+        attempts=0,
+        next_try=datetime.utcnow()
+    ).where(Journal.status == JournalStatus.quarantined).execute()
+    log.say(count, "quarantined tasks released.")
+    return count
+
+
+def journal_pending():
+    """ Return the list of (journal ID, (task, item, mirror))
+        left pending by an interrupted run. """
+    results = Journal.select().where(
+        Journal.status == JournalStatus.pending
+    ).order_by(Journal.id)
+    return [(r.id, (r.task, _file_from_json(r.item), _file_from_json(r.mirror)))
+            for r in results]
+
+
+def journal_unfinished():
+    """ Return the list of (journal ID, (task, item, mirror))
+        of the pending, failed and quarantined tasks. """
+    results = Journal.select().where(
+        Journal.status != JournalStatus.done).order_by(Journal.id)
+    return [(r.id, (r.task, _file_from_json(r.item), _file_from_json(r.mirror)))
+            for r in results]
+
+
+def journal_clear():
+    """ Remove the finished journal entries. """
+    Journal.delete().where(Journal.status == JournalStatus.done).execute()
+
+
+def scan_started(idn):
+    """ Check if a remote tree scan of the directory was interrupted. """
+    return ScanDir.select().where(ScanDir.id_str == idn).exists()
+
+
+def scan_seed(idn, path):
+    """ Start a remote tree scan from the given directory. """
+    scan_clear()
+    ScanDir.create(id_str=idn, path=path)
+
+
+def scan_next():
+    """ Return the (id, path, page token) of the next directory
+        to list, or None if the scan is complete. """
+    entry = ScanDir.select().where(
+        ScanDir.listed == False).order_by(ScanDir.id).first()
+    if entry is None:
+        return None
+    return entry.id_str, entry.path, entry.page_token
+
+
+def scan_page(idn, path, files, next_page_token):
+    """ Save a listed page of a directory, it's subdirectories to
+        the frontier and the token of the next page, in a single
+        transaction so an interrupted scan continues from here. """
+    with atomic():
+        for response in files:
+            ScanItem.create(parent_path=path, item=json.dumps(response))
+            if response.get('mimeType') == filesystem.MimeTypes.gdrive_directory:
+                ScanDir.insert(
+                    id_str=response.get('id'),
+                    path=os.path.join(path, response.get('name'))
+                ).on_conflict_ignore().execute()
+
+        ScanDir.update(
+            page_token=next_page_token,
+            listed=next_page_token is None
+        ).where(ScanDir.id_str == idn).execute()
+
+
+def scan_progress():
+    """ Return the number of directories listed and to be listed. """
+    listed = ScanDir.select().where(ScanDir.listed == True).count()
+    return listed, ScanDir.select().count() - listed
+
+
+def scan_items():
+    """ Yield the (parent path, response) of the scanned items,
+        parents before their children. """
+    for entry in ScanItem.select().order_by(ScanItem.id).iterator():
+        yield entry.parent_path, json.loads(entry.item)
+
+
+def scan_clear():
+    with atomic():
+        ScanDir.delete().execute()
+        ScanItem.delete().execute()
+
+
+def stats():
+    """ Return a dict of the database size and free space in bytes,
+        and the row counts. """
+    database = Record._meta.database
+    page_size = database.execute_sql("PRAGMA page_size").fetchone()[0]
+    pages = database.execute_sql("PRAGMA page_count").fetchone()[0]
+    free = database.execute_sql("PRAGMA freelist_count").fetchone()[0]
+    return {
+        'size': page_size * pages,
+        'free': page_size * free,
+        'records': Record.select().count(),
+        'tombstones': Record.select().where(Record.deleted == True).count(),
+        'journal': Journal.select().count(),
+    }
+
+
+def gc(days=TOMBSTONE_DAYS):
+    """ Purge the records deleted more than the given days ago, then
+        release the free pages and refresh the query planner statistics.
+        Records are purged in small transactions, so a running sync is
+        not blocked for long. Tombstones of the items of pending or failed
+        journal tasks, or still the parent of a live record, are kept.
+        Quarantined tasks do not keep them, they may never finish.
+        Returns the number of records purged. """
+
+    before = stats()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+
+    # the items the unfinished tasks may still look up
+    keep_ids, keep_hashes = set(), set()
+    for entry in Journal.select(Journal.item, Journal.mirror).where(
+            Journal.status.in_([JournalStatus.pending,
+                                JournalStatus.failed])):
+        for item in [_file_from_json(entry.item),
+                     _file_from_json(entry.mirror)]:
+            if item is None:
+                continue
+            keep_ids.add(item.id)
+            if item.path:
+                keep_hashes.add(utils.path_hash(item.path))
+
+    child = Record.alias()
+    count = 0
+    last = 0
+    while True:
+        with atomic():
+            rows = list(Record.select(
+                Record.id, Record.id_str, Record.path_hash).where(
+                (Record.id > last) &
+                (Record.deleted == True) &
+                (Record.time_updated.is_null() |
+                 (Record.time_updated < cutoff)) &
+                ~fn.EXISTS(child.select(child.id).where(
+                    (child.parent == Record.id) & (child.deleted == False)))
+            ).order_by(Record.id).limit(QUERY_BATCH))
+            if not rows:
+                break
+            last = rows[-1].id
+            ids = [r.id for r in rows if r.id_str not in keep_ids and
+                   r.path_hash not in keep_hashes]
+            if not ids:
+                continue
+            Pair.delete().where(
+                Pair.local.in_(ids) | Pair.remote.in_(ids)).execute()
+            count += Record.delete().where(Record.id.in_(ids)).execute()
+
+    _vacuum()
+    _db.execute_sql("PRAGMA analysis_limit = 1000")
+    _db.execute_sql("ANALYZE")
+
+    after = stats()
+    log.say("Database gc: %d records purged, %d tombstones kept, "
+            "%.1f MB ==> %.1f MB" % (
+                count, after['tombstones'],
+                before['size'] / 2**20, after['size'] / 2**20))
+    log.trace("Database rows before:", before, "after:", after)
+    return count
+
+
+def _vacuum():
+    """ Return the free pages to the filesystem. An older database file
+        is rebuilt once with a full VACUUM to switch it to incremental
+        auto vacuum, later only the free pages are released. """
+    mode = _db.execute_sql("PRAGMA auto_vacuum").fetchone()[0]
+    if mode != 2:
+        _db.execute_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        _db.execute_sql("VACUUM")
+        return
+
+    # the pragma frees a page per result row read, so
+    # step through all of them until the freelist is empty
+    while _db.execute_sql("PRAGMA freelist_count").fetchone()[0]:
+        _db.execute_sql("PRAGMA incremental_vacuum").fetchall()
+
+
+def atomic():
+    """ Write transaction context manager of the current database. The
+        write lock is taken at the start, so a transaction that reads
+        first waits for other writers instead of failing to upgrade. """
+    return _db.atomic('IMMEDIATE')
+
+
 def close():
     global _db
     _db.commit()
     _db.close()
+    _connections.pop(_db.database, None)
     log.trace("Database close OK")
+
+
+def close_all():
+    """ Close all the open databases. """
+    global _db
+    for database in list(_connections.values()):
+        _db = database
+        close()
@@ -44,3 +44,7 @@ class ErrorNotInDatabase(FileNotFoundError):
 
 class ErrorParentNotFound(ErrorPathResolve):
     pass
+
+
+class ErrorChangeTokenInvalid(ValueError):
+    pass
@@ -1,5 +1,7 @@
+import sys
 import json
-import dateutil
+
+from . import utils
 
 UPLOAD_CHUNK_SIZE = 1024*1024
 WRITE_CHUNK_SIZE = 131072
@@ -14,15 +16,28 @@ class MimeTypes:
     gdrive_directory = 'application/vnd.google-apps.folder'
 
 
+def intern(text):
+    """ Share the repeating names and mime types between items. """
+    if text is None:
+        return None
+    return sys.intern(text)
+
+
 class FileSystem:
     """ The base file system class to keep track of the common
         properties of individual file items. """
 
+    # no per instance __dict__, the trees can hold millions of items
+    __slots__ = ('name', 'path', 'id', 'children', 'parentIds', 'exists',
+                 '_is_dir', '_size', '_syncTime', '_md5', '_mimeType',
+                 '_modifiedTime', '_inode', 'trashed')
+
     def __init__(self):
         self.name = None
         self.path = None
         self.id = None
-        self.children = []
+        # shared until listed, files never get a list of their own
+        self.children = ()
         self.parentIds = None
         self.exists = None
         self._is_dir = None
@@ -31,6 +46,7 @@ class FileSystem:
         self._md5 = None
         self._mimeType = None
         self._modifiedTime = None
+        self._inode = None
         self.trashed = False
 
     def is_dir(self):
@@ -65,18 +81,19 @@ class FileSystem:
         return self._mimeType
 
     def modifiedTime(self):
-        if self._modifiedTime and type(self._modifiedTime) == str:
-            return dateutil.parser.parse(self._modifiedTime)
+        """ Integer nanoseconds since the epoch. """
         return self._modifiedTime
 
     def syncTime(self):
-        if self._syncTime and type(self._syncTime) == str:
-            return dateutil.parser.parse(self._syncTime)
+        """ Integer nanoseconds since the epoch. """
         return self._syncTime
 
     def md5(self):
         return self._md5
 
+    def inode(self):
+        return self._inode
+
     def __repr__(self):
         text = [
             self.__class__.__name__,
@@ -96,7 +113,8 @@ class FileSystem:
         for i, child in enumerate(self.children):
             modifiedTime = None
             if child.modifiedTime():
-                modifiedTime = child.modifiedTime().strftime("%Y-%m-%d %H:%M:%S.%f+00:00 (UTC)")
+                modifiedTime = utils.ns_to_datetime(child.modifiedTime()).strftime(
+                    "%Y-%m-%d %H:%M:%S.%f+00:00 (UTC)")
             print("%d   %s \t %s \t\t %s \t %s" %
                   (i+1, child.is_dir(), child.name, child.md5(), modifiedTime))
 
@@ -123,11 +141,14 @@ class FileSystem:
 
         return True
 
-    def upload_or_download(self, mirror):
+    def upload_or_download(self, mirror, source=None):
         raise NotImplementedError()
 
     def update(self, mirror):
         raise NotImplementedError()
 
+    def rename(self, target):
+        raise NotImplementedError()
+
     def remove(self):
         raise NotImplementedError()
@@ -1,50 +1,150 @@
 import os
 import sys
+import copy
+import json
+import time
+import select
 from pathlib import Path
+from datetime import datetime
 
 from . import log
+from . import auth
 from . import utils
+from . import inotify
+from . import control
+from . import snapshot
+from . import scheduler
 from . import sync
 from . import filesystem
 from . import database as db
 
 from .errors import *
 from .local_fs import LinuxFS
-from .remote_fs import GDriveFS, GDChanges
+from .remote_fs import GDriveFS, GDChanges, GDReconcile
+from .snapshot import Snapshot
 
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 
+# watch mode intervals, in seconds
+WATCH_DEBOUNCE = 2
+WATCH_POLL_MIN = 15
+WATCH_POLL_MAX = 600
+WATCH_GC_INTERVAL = 24 * 3600
+
+
+class SyncRoot:
+    """ Settings and state of a single sync root. """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.sync = sync.Sync(SCOPES, settings)
+        self.local_root = None
+        self.remote_root = None
+
+    def __repr__(self):
+        return "SyncRoot::%s::%s" % (self.settings.local_root_path,
+                                     self.settings.remote_root_path)
+
 
 class PyGDClient:
     def __init__(self, settings_file):
         self.settings_file = settings_file
-        self.settings = None
-        self.local_root = None
-        self.remote_root = None
+        self.file_settings = None
+        self.roots = []
+        self.root = None
 
         # read the settings file
         self.read_settings()
 
         # make sure settings are loaded
-        if not self.settings:
+        if not self.file_settings:
             raise RuntimeError("Failed to detect settings.")
 
-        # connect database, setup tables if needed
-        db.connect(self.settings.db_file,
-                   self.settings.remote_root_path,
-                   self.settings.local_root_path)
-
-        # connect remote server, login
-        self.sync = sync.Sync(SCOPES, self.settings)
+        for settings in self._root_settings():
+            self.roots.append(SyncRoot(settings))
+
+        # bandwidth caps are shared by all roots
+        scheduler.set_limits(self.file_settings.max_rate * 1024,
+                             self.file_settings.max_upload_rate * 1024,
+                             self.file_settings.max_download_rate * 1024)
+
+        # connect databases, setup tables if needed,
+        # the first root stays active
+        for root in reversed(self.roots):
+            self.activate(root)
+
+    # the methods below work on the currently active sync root
+    @property
+    def settings(self):
+        return self.root.settings
+
+    @property
+    def sync(self):
+        return self.root.sync
+
+    @property
+    def local_root(self):
+        return self.root.local_root
+
+    @local_root.setter
+    def local_root(self, value):
+        self.root.local_root = value
+
+    @property
+    def remote_root(self):
+        return self.root.remote_root
+
+    @remote_root.setter
+    def remote_root(self, value):
+        self.root.remote_root = value
+
+    def activate(self, root):
+        """ Make a sync root current, switch to it's database
+            and to the API service of it's account. """
+        self.root = root
+        db.connect(root.settings.db_file,
+                   root.settings.remote_root_path,
+                   root.settings.local_root_path)
+        auth.activate(root.settings.token_pickle)
+
+    def _root_settings(self):
+        """ Return the settings of each sync root. Items of the optional
+            roots list override the top level settings. """
+
+        if not 'roots' in self.file_settings:
+            return [self.file_settings]
+
+        defaults = dict(self.file_settings)
+        defaults.pop('roots')
+
+        roots = []
+        db_files = []
+        for i, item in enumerate(self.file_settings.roots):
+            settings = utils.AttrDict(dict(defaults))
+            for key, value in item.items():
+                settings[key] = value
+
+            # each root needs it's own database
+            if not 'db_file' in item:
+                settings.db_file = '.gdcli-db-%d.sqlite' % i
+            if settings.db_file in db_files:
+                raise ValueError("Same db_file used for multiple roots.",
+                                 settings.db_file)
+            db_files.append(settings.db_file)
+            roots.append(settings)
+
+        log.trace("Sync roots:", len(roots))
+        return roots
 
     def read_settings(self):
-        self.settings = utils.AttrDict()
+        self.file_settings = utils.AttrDict()
+        settings = self.file_settings
 
         # settings file
         if os.path.isfile(self.settings_file):
             log.trace("Reading ", self.settings_file)
             try:
-                self.settings.load_json(self.settings_file)
+                settings.load_json(self.settings_file)
             except:
                 log.critical(
                     "Failed to read settings file. Please make sure the json format is valid.")
@@ -55,35 +155,55 @@ class PyGDClient:
         os_home = str(Path.home())
 
         # save the default token file
-        if not 'token_pickle' in self.settings:
-            # self.settings.token_pickle = os.path.join(os_home, '.gdcli.token.pkl')
-            self.settings.token_pickle = '.gdcli-token.pk'
-            log.trace("Set token file: ", self.settings.token_pickle)
+        if not 'token_pickle' in settings:
+            # settings.token_pickle = os.path.join(os_home, '.gdcli.token.pkl')
+            settings.token_pickle = '.gdcli-token.pk'
+            log.trace("Set token file: ", settings.token_pickle)
 
-        if not 'credentials_file' in self.settings:
+        if not 'credentials_file' in settings:
             cred_file = os.path.join(os.path.dirname(os.path.dirname(
                 os.path.realpath(__file__))), "credentials.json")
-            self.settings.credentials_file = cred_file
-            log.trace("Set credentials file: ", self.settings.credentials_file)
+            settings.credentials_file = cred_file
+            log.trace("Set credentials file: ", settings.credentials_file)
+
+        if not 'local_root_path' in settings:
+            settings.local_root_path = os.getcwd()
+            log.trace("Set local root: ", settings.local_root_path)
+
+        if not 'remote_root_path' in settings:
+            settings.remote_root_path = '/'
+            log.trace("Set remote root: ", settings.remote_root_path)
+
+        if not 'db_file' in settings:
+            settings.db_file = '.gdcli-db.sqlite'
+            log.trace("Set database file: ", settings.db_file)
 
-        if not 'local_root_path' in self.settings:
-            self.settings.local_root_path = os.getcwd()
-            log.trace("Set local root: ", self.settings.local_root_path)
+        if not 'ignore_paths' in settings:
+            settings.ignore_paths = [".gdcli*"]
 
-        if not 'remote_root_path' in self.settings:
-            self.settings.remote_root_path = '/'
-            log.trace("Set remote root: ", self.settings.remote_root_path)
+        if not 'control_socket' in settings:
+            settings.control_socket = control.DEFAULT_SOCKET
 
-        if not 'db_file' in self.settings:
-            self.settings.db_file = '.gdcli-db.sqlite'
-            log.trace("Set database file: ", self.settings.db_file)
+        if not 'tombstone_days' in settings:
+            settings.tombstone_days = db.TOMBSTONE_DAYS
 
-        if not 'ignore_paths' in self.settings:
-            self.settings.ignore_paths = [".gdcli*"]
+        if not 'mode' in settings:
+            settings.mode = sync.Mode.sync
+
+        if not 'transfer_order' in settings:
+            settings.transfer_order = scheduler.RULES
+
+        if not 'priority_paths' in settings:
+            settings.priority_paths = {}
+
+        # KB/s, 0 for no limit
+        for key in ['max_rate', 'max_upload_rate', 'max_download_rate']:
+            if not key in settings:
+                settings[key] = 0
 
         # save the default settings
         if not os.path.isfile(self.settings_file):
-            self.settings.save(self.settings_file)
+            settings.save(self.settings_file)
             log.say("Settings file created: ", self.settings_file)
             log.say("Please update the defaults and rerun.")
             sys.exit(0)
@@ -117,14 +237,59 @@ class PyGDClient:
                 self.settings.remote_root_path, db.getRootId(), True)
 
         # recursively query remote directory file list
-        self.remote_root.list_dir(recursive=True)
+        self._list_remote_tree()
 
         # print the root items only
         self.remote_root.print_children()
 
-    def _add_sync_recursive(self, directory):
+    def _list_remote_tree(self):
+        """ Recursively list the remote root. Each listed page is saved
+            to the database, so an interrupted scan continues from the
+            last page instead of starting over. """
+
+        if db.scan_started(self.remote_root.id):
+            listed, pending = db.scan_progress()
+            log.say("Resuming remote scan, %d directories listed, "
+                    "%d to go." % (listed, pending))
+        else:
+            db.scan_seed(self.remote_root.id, self.remote_root.path)
+
+        while True:
+            entry = db.scan_next()
+            if entry is None:
+                break
+
+            idn, path, page_token = entry
+            results = GDriveFS.list_page(idn, page_token)
+            if results.get('files') is None:
+                log.error("No files item returned, something is wrong.")
+                raise RuntimeError(results)
+
+            db.scan_page(idn, path, results.get('files'),
+                         results.get('nextPageToken'))
+            if not results.get('nextPageToken'):
+                log.progressdot("List directory OK: ", path)
+
+        # rebuild the tree from the saved pages
+        self.remote_root.children = []
+        dirs = {self.remote_root.path: self.remote_root}
+        for parent_path, response in db.scan_items():
+            parent = dirs.get(parent_path)
+            if parent is None:
+                continue
+            child = GDriveFS(response, parent_path)
+            parent.children.append(child)
+            if child.is_dir():
+                child.children = []
+                dirs.setdefault(child.path, child)
+
+        # the tree is in memory now, start over on the next scan
+        db.scan_clear()
+
+    def _add_sync_recursive(self, directory, unchanged=None):
         """ Recursively go over directory contents and add
-            to sync queue for processing. """
+            to sync queue for processing. The directories with the
+            signature saved in database are skipped. """
 
         count = 0
         if not isinstance(directory, filesystem.FileSystem):
@@ -133,6 +298,12 @@ class PyGDClient:
         if not directory.is_dir():
             raise NotADirectoryError(directory)
 
+        if unchanged is None:
+            unchanged = self.sync.unchanged_dirs(directory)
+        if directory.path in unchanged:
+            log.trace("Unchanged directory:", directory)
+            return 0
+
         log.progressdot("Scanning ", directory.path)
 
         if not db.file_exists(directory):
@@ -144,7 +315,7 @@ class PyGDClient:
         # add children, recursively
         for child in directory.children:
             if child.is_dir():
-                count += self._add_sync_recursive(child)
+                count += self._add_sync_recursive(child, unchanged)
             else:
                 if not db.file_exists(child):
                     log.trace("New file:", directory)
@@ -154,13 +325,16 @@ class PyGDClient:
 
         return count
 
-    def _add_sync_database(self):
+    def _add_sync_database(self, unchanged=()):
         """ Load all local items from database and add to 
-            sync queue if change detected. """
+            sync queue if change detected. Items in the unchanged
+            directories are not checked. """
 
         log.say("Scanning local files for changes.")
         count = 0
         for item in db.get_all_local():
+            if os.path.dirname(item.path) in unchanged:
+                continue
             dbFile = db.get_file_as_db(item)
             log.progressdot(dbFile.path)
             if item.exists:
@@ -176,52 +350,647 @@ class PyGDClient:
 
         log.say("%d local file changes found." % count)
 
+    def _snapshot_file(self):
+        return self.settings.db_file + '.snapshot'
+
+    def _add_sync_snapshot(self, snap):
+        """ Compare the local directory with the snapshot saved after the
+            last sync, only the differences are checked one by one. """
+
+        log.say("Scanning local files for changes.")
+        current = Snapshot.scan(self.settings.local_root_path)
+        new, removed, changed, changed_old = snap.diff(current)
+
+        count = 0
+        for i in new:
+            item = LinuxFS(current.path(i))
+            if not db.file_exists(item):
+                log.trace("New file:", item)
+                self.sync.add(item)
+                db.update_status(item, db.Status.queued)
+                count += 1
+        log.say(count, "new local files found.")
+
+        for i in removed:
+            item = LinuxFS(snap.path(i), snap.is_dir(i))
+            if not item.exists and db.file_exists(item):
+                item.trashed = True
+                log.trace("File deleted:", item)
+                self.sync.add(item)
+                count += 1
+
+        for i, j in zip(changed, changed_old):
+            item = LinuxFS(current.path(i))
+            if item.md5() != snap.md5(j):
+                log.trace("Change found:", item)
+                self.sync.add(item)
+                count += 1
+            else:
+                # same content, keep the new stat signature
+                db.update(item)
+
+        # the database changes from here on, rebuild after the sync
+        self._remove_snapshot()
+        log.say("%d local file changes found." % count)
+
+    def _save_snapshots(self):
+        """ Save the stat signatures of the synced local items,
+            for the next run to compare against. """
+        for root in self.roots:
+            if not root.sync.reads_local():
+                continue
+            self.activate(root)
+            snap = Snapshot.build(db.get_local_signatures())
+            snap.save(self._snapshot_file())
+
+    def _remove_snapshot(self):
+        for ext in ['.npy', '.paths']:
+            if os.path.isfile(self._snapshot_file() + ext):
+                os.remove(self._snapshot_file() + ext)
+
     def _add_sync_remote_changes(self):
         """ Fetch the remote changes and add to sync 
             queue for processing. """
 
+        token = db.getChangeToken()
+        if token is None:
+            log.warn("No change token found.")
+            return self._add_sync_remote_reconcile()
+
         log.say("Querying remote changes.")
         count = 0
-        dG = GDChanges(db.getChangeToken())
-        for remote_change in dG.fetch():
+        dG = GDChanges(token)
+        try:
+            remote_changes = dG.fetch()
+        except ErrorChangeTokenInvalid:
+            log.warn("Change token is no longer valid.")
+            return self._add_sync_remote_reconcile()
+
+        for remote_change in remote_changes:
             self.sync.add(remote_change)
             count += 1
         log.say("%d remote file changes reported." % count)
-        db.setChangeToken(dG.last_poll_token())
+        self.sync.set_change_token(dG.last_poll_token())
+        return count
+
+    def _add_sync_remote_reconcile(self):
+        """ Recover remote changes since the last successful sync
+            without a change token, and take a fresh token.
+            Falls back to a full remote scan if the last sync is unknown. """
+
+        # take the new token first, so nothing changed
+        # during the reconciliation gets lost
+        dG = GDChanges()
+
+        last_sync = db.getLastSync()
+        if last_sync is None:
+            log.warn("Last sync time unknown, scanning remote tree.")
+            self.build_remote_tree()
+            count = self._add_sync_recursive(self.remote_root)
+            self.sync.set_change_token(dG.last_poll_token())
+            return count
+
+        log.say("Reconciling remote changes since", last_sync)
+
+        dirs = db.get_remote_dirs()
+        known = {item.id: item for item in db.get_all_remote() if item.id}
+        rc = GDReconcile(last_sync, dirs)
+
+        count = 0
+        for item in rc.modified():
+            known.pop(item.id, None)
+            self.sync.add(item)
+            count += 1
+
+        for idn in rc.trashed():
+            if idn in known:
+                item = known.pop(idn)
+                item.trashed = True
+                self.sync.add(item)
+                count += 1
+
+        # the directories only, a deleted or moved directory takes
+        # it's contents with it, remote root is not a child of any
+        known = {idn: item for idn, item in known.items()
+                 if item.is_dir() and idn != db.getRootId()}
+
+        log.say("Checking", len(known), "known remote directories.")
+        for idn, response in rc.sweep(known.keys()).items():
+            item = known[idn]
+            parent_paths = [dirs[p] for p in response.get('parents', [])
+                            if p in dirs] if response else []
+            if response is None or response.get('trashed') \
+                    or not parent_paths:
+                # removed, trashed or moved out of the sync directory
+                item.trashed = True
+            elif response.get('name') != item.name or \
+                    os.path.dirname(item.path) not in parent_paths:
+                # moved or renamed, resolve the new path from parent ID
+                item = GDriveFS()
+                item.set_object(response, None)
+            else:
+                continue
+            self.sync.add(item)
+            count += 1
+
+        log.say("%d remote file changes reconciled." % count)
+        self.sync.set_change_token(dG.last_poll_token())
+        return count
+
+    def _add_sync_paths(self, paths):
+        """ Add the given local paths to sync queue if they are new,
+            changed or deleted. Directories are scanned recursively. """
+
+        count = 0
+        for path in paths:
+            item = LinuxFS(path)
+            if item.exists:
+                if item.is_dir():
+                    item.list_dir(recursive=True)
+                    count += self._add_sync_recursive(item)
+                elif not db.file_exists(item):
+                    self.sync.add(item)
+                    count += 1
+                elif not item.same_file(db.get_file_as_db(item)):
+                    log.trace("Change found:", item)
+                    self.sync.add(item)
+                    count += 1
+            else:
+                for is_dir in [False, True]:
+                    item = LinuxFS(path, is_dir)
+                    if not db.file_exists(item):
+                        continue
+                    # a gone directory takes it's contents with it,
+                    # so a rename is detected as a single move
+                    gone = [item] + (db.get_subtree(item) if is_dir else [])
+                    for item in gone:
+                        item.trashed = True
+                        log.trace("File deleted:", item)
+                        self.sync.add(item)
+                        count += 1
+        return count
+
+    def scan(self, full_scan=False, reconcile=False, poll=True):
+        """ Find the local and remote changes and add them to sync queue.
+            Returns True if the remote changes are still to be polled. """
 
-    def run(self, full_scan=False):
         if full_scan or db.is_empty():
             # Assuming nothing exists in the db
             # Populate it with local and remote items
             log.say("Running full recursive scan, this may take a while.")
+            self._remove_snapshot()
+            adopt = db.is_empty()
 
-            # recursively check the local files
+            # build the local and remote trees, take the change token
+            # first, so nothing changed during the listing gets lost
             self.build_local_tree()
-            self._add_sync_recursive(self.local_root)
-            db.add(self.local_root)
-
-            # Fetch remote items tree
             self.sync.login()
+            dG = GDChanges()
             self.build_remote_tree()
+
+            # pair what is already the same on both sides at once
+            if adopt:
+                self.sync.adopt_matching(self.local_root, self.remote_root)
+
+            # recursively check the rest
+            self._add_sync_recursive(self.local_root)
+            db.add(self.local_root)
             self._add_sync_recursive(self.remote_root)
             db.add(self.remote_root)
+            self.sync.set_change_token(dG.last_poll_token())
         else:
             log.say("Checking for new files.")
-            # recursively check the local files
-            self.build_local_tree()
-            n = self._add_sync_recursive(self.local_root)
-            log.say(n, "new local files found.")
-
-            # add database items to queue
-            self._add_sync_database()
+            if self.sync.reads_local():
+                self._scan_local()
 
             # fetch remote changes and add to queue
             self.sync.login()
-            self._add_sync_remote_changes()
+            if not self.sync.reads_remote():
+                return False
+            if reconcile:
+                self._add_sync_remote_reconcile()
+            elif poll:
+                self._add_sync_remote_changes()
+            else:
+                return True
+        return False
+
+    def _scan_local(self):
+        snap = Snapshot.load(self._snapshot_file())
+        if snap is not None and os.path.isdir(self.settings.local_root_path):
+            self._add_sync_snapshot(snap)
+            return
+
+        # recursively check the local files
+        self.build_local_tree()
+        unchanged = self.sync.unchanged_dirs(self.local_root)
+        n = self._add_sync_recursive(self.local_root, unchanged)
+        log.say(n, "new local files found.")
+
+        # add database items to queue
+        self._add_sync_database(unchanged)
+
+    def _poll_remote_changes(self, roots):
+        """ Poll the remote changes once per account, and add each change
+            to the roots that know it's parent directory or itself.
+            The roots of an account are polled from the oldest of their
+            tokens, and all take the new token, so they stay aligned.
+            Returns the number of changes added. """
+
+        accounts = {}
+        for root in roots:
+            accounts.setdefault(root.settings.token_pickle, []).append(root)
+
+        count = 0
+        for group in accounts.values():
+            tokens = {}
+            for root in group:
+                self.activate(root)
+                tokens[root] = db.getChangeToken()
+
+            # the page tokens are increasing numbers
+            shared = [root for root in group if tokens[root] is not None]
+            if len(shared) < 2 or not all(
+                    tokens[root].isdigit() for root in shared):
+                shared = []
+
+            # nothing to share, poll separately
+            for root in group:
+                if root not in shared:
+                    self.activate(root)
+                    self.sync.login()
+                    count += self._add_sync_remote_changes()
+            if not shared:
+                continue
+
+            # the roots with a newer token get some changes again,
+            # they are found the same as in database
+            oldest = min((tokens[root] for root in shared), key=int)
+            self.activate(shared[0])
+            self.sync.login()
+            log.say("Querying remote changes for", len(shared), "roots.")
+            dG = GDChanges(oldest)
+            try:
+                remote_changes = dG.fetch()
+            except ErrorChangeTokenInvalid:
+                log.warn("Change token is no longer valid.")
+                for root in shared:
+                    self.activate(root)
+                    count += self._add_sync_remote_reconcile()
+                continue
+
+            for root in shared:
+                self.activate(root)
+                n = 0
+                for item in self._route_changes(remote_changes):
+                    self.sync.add(copy.copy(item))
+                    n += 1
+                log.say("%d remote file changes for" % n, root)
+                self.sync.set_change_token(dG.last_poll_token())
+                count += n
+
+        return count
+
+    def _route_changes(self, changes):
+        """ Return the changes of the active root, the items under it's
+            known directories or known themselves. Directories new in the
+            same changes are known as well, in whatever order they come. """
+        dirs = set(db.get_remote_dirs())
+        routed = set()
+        rest = list(changes)
+        while rest:
+            left = []
+            for item in rest:
+                if any(p in dirs for p in item.parentIds or []) \
+                        or db.get_record_by_id(item.id):
+                    routed.add(item.id)
+                    if item.is_dir() and not item.trashed:
+                        dirs.add(item.id)
+                else:
+                    left.append(item)
+            if len(left) == len(rest):
+                break
+            rest = left
+        return [item for item in changes if item.id in routed]
+
+    def _execute(self, interactive=True):
+        """ Run the queued tasks of all roots, taking one task
+            from each root in turn. """
+
+        active = []
+        for root in self.roots:
+            self.activate(root)
+            if self.sync.prepare(interactive):
+                active.append(root)
+
+        while active:
+            for root in list(active):
+                self.activate(root)
+                if not self.sync.execute_next():
+                    active.remove(root)
+
+        # sign the directories changed by the sync
+        for root in self.roots:
+            self.activate(root)
+            db.refresh_signatures()
+
+        log.say("Finished Sync.")
+
+    def _set_last_sync(self, started):
+        for root in self.roots:
+            self.activate(root)
+            db.setLastSync(started)
+
+    def _resume(self):
+        """ Finish the tasks of an interrupted run and retry the
+            failed tasks before scanning. """
+        for root in self.roots:
+            self.activate(root)
+            if self.sync.resume():
+                # the snapshot no longer matches the database
+                self._remove_snapshot()
+            n = db.journal_quarantined()
+            if n:
+                log.warn(n, "tasks quarantined, run with --release to retry.")
+
+    def run(self, full_scan=False, reconcile=False, budget=None):
+        """ Sync once. If a budget in seconds is given, no transfers
+            are started after it, the rest is left for the next run. """
+        started = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        scheduler.set_budget(budget)
+        self._resume()
+
+        poll = []
+        for root in self.roots:
+            self.activate(root)
+            if self.scan(full_scan, reconcile, poll=False):
+                poll.append(root)
+        self._poll_remote_changes(poll)
 
         # start syncing
-        self.sync.run()
+        self._execute()
 
-        db.close()
-        self.settings.save(self.settings_file)
+        self._set_last_sync(started)
+        if snapshot.available():
+            self._save_snapshots()
+        db.close_all()
+        self.file_settings.save(self.settings_file)
         print()
+
+    def watch(self, full_scan=False, serve=False):
+        """ Keep running, sync the local paths reported by inotify and
+            poll the remote changes at an interval adapting to activity.
+            If serve is set, also accept commands on the control socket. """
+
+        started = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        self._resume()
+
+        poll = []
+        for root in self.roots:
+            self.activate(root)
+            if self.scan(full_scan, poll=False):
+                poll.append(root)
+        self._poll_remote_changes(poll)
+        self._execute(interactive=False)
+        self._set_last_sync(started)
+
+        notifier = inotify.Inotify()
+        for root in self.roots:
+            if root.sync.reads_local():
+                notifier.add_watch_recursive(root.settings.local_root_path)
+        log.say("Watching", len(notifier.watched()), "local directories.")
+
+        server = None
+        if serve:
+            server = control.ControlServer(self.file_settings.control_socket)
+            log.say("Listening on", self.file_settings.control_socket)
+
+        self._pending = {}
+        self._paused = False
+        self._running = True
+        self._poll_interval = WATCH_POLL_MIN
+        self._next_poll = time.time() + self._poll_interval
+        self._next_gc = time.time() + WATCH_GC_INTERVAL
+        self._stats = {
+            'started': time.time(),
+            'events': 0,
+            'remote_polls': 0,
+            'remote_changes': 0,
+            'sync_runs': 0,
+            'commands': 0,
+        }
+
+        try:
+            while self._running:
+                now = time.time()
+                timeout = max(0, min(WATCH_DEBOUNCE, self._next_poll - now))
+                if self._paused:
+                    timeout = WATCH_DEBOUNCE
+                fds = [notifier.fd] + ([server] if server else [])
+                readable, _, _ = select.select(fds, [], [], timeout)
+
+                force = False
+                if notifier.fd in readable:
+                    self._watch_events(notifier, notifier.read_events(0))
+
+                if server in readable:
+                    for conn, command in server.accept():
+                        response, forced = self._control_command(command)
+                        force = force or forced
+                        server.reply(conn, response)
+
+                if self._paused:
+                    continue
+
+                self._watch_sync(force)
+
+        except KeyboardInterrupt:
+            log.say("Stopping watch.")
+        finally:
+            notifier.close()
+            if server:
+                server.close()
+            if snapshot.available():
+                self._save_snapshots()
+            db.close_all()
+            self.file_settings.save(self.settings_file)
+
+    def _root_of(self, path):
+        """ Return the sync root a local path belongs to, None if outside. """
+        path = os.path.abspath(path)
+        for root in self.roots:
+            root_path = os.path.abspath(root.settings.local_root_path)
+            if path == root_path or path.startswith(root_path + os.sep):
+                return root
+        return None
+
+    def _watch_events(self, notifier, events):
+        """ Coalesce inotify events per path and follow directory moves. """
+        for event in events:
+            self._stats['events'] += 1
+
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                log.warn("Inotify queue overflow, rescanning local files.")
+                self._pending = {}
+                for root in self.roots:
+                    if not root.sync.reads_local():
+                        continue
+                    self.activate(root)
+                    self._scan_local()
+                    notifier.add_watch_recursive(root.settings.local_root_path)
+                continue
+
+            if event.mask & inotify.IN_IGNORED:
+                continue
+
+            if event.is_dir():
+                if event.mask & inotify.IN_MOVED_FROM:
+                    notifier.remove_watch_recursive(event.path)
+                elif event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    # watch the new or moved in directory tree
+                    notifier.add_watch_recursive(event.path)
+
+            if not event.mask & (inotify.IN_DELETE_SELF |
+                                 inotify.IN_MOVE_SELF):
+                self._pending[event.path] = time.time()
+
+    def _watch_sync(self, force=False):
+        """ Queue the settled local paths, poll the remote changes
+            if due, and sync if anything is queued. """
+
+        now = time.time()
+        started = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+
+        ready = [p for p, t in self._pending.items()
+                 if force or now - t >= WATCH_DEBOUNCE]
+        if ready:
+            for path in ready:
+                self._pending.pop(path)
+            # parents first, so moved directories are scanned once
+            ready.sort(key=lambda p: p.count(os.sep))
+            for root in self.roots:
+                paths = [p for p in ready if self._root_of(p) is root]
+                if paths:
+                    self.activate(root)
+                    self._add_sync_paths(paths)
+
+        if force or now >= self._next_poll:
+            n = self._poll_remote_changes(
+                [r for r in self.roots if r.sync.reads_remote()])
+            self._stats['remote_polls'] += 1
+            self._stats['remote_changes'] += n
+            if n:
+                self._poll_interval = WATCH_POLL_MIN
+            else:
+                self._poll_interval = min(
+                    self._poll_interval * 2, WATCH_POLL_MAX)
+            self._next_poll = now + self._poll_interval
+
+        # retry the failed tasks that are due
+        for root in self.roots:
+            self.activate(root)
+            self.sync.resume()
+
+        if self._queued():
+            # local activity, check the remote side soon as well
+            self._poll_interval = WATCH_POLL_MIN
+            self._next_poll = min(self._next_poll, now + self._poll_interval)
+            self._execute(interactive=False)
+            self._stats['sync_runs'] += 1
+            self._set_last_sync(started)
+        else:
+            # nothing to apply, the polled tokens can be saved
+            for root in self.roots:
+                self.activate(root)
+                self.sync.commit_change_token()
+
+            # compact while idle
+            if now >= self._next_gc:
+                self._gc()
+                self._next_gc = now + WATCH_GC_INTERVAL
+
+    def _queued(self):
+        return sum([root.sync.pending() for root in self.roots])
+
+    def _quarantined(self):
+        count = 0
+        for root in self.roots:
+            self.activate(root)
+            count += db.journal_quarantined()
+        return count
+
+    def release(self):
+        """ Retry the quarantined tasks on the next run. """
+        for root in self.roots:
+            self.activate(root)
+            db.journal_release()
+        db.close_all()
+
+    def status(self):
+        """ Print the database state of each root, read through
+            read-only connections so a running sync is not blocked. """
+        for root in self.roots:
+            print(root)
+            print(json.dumps(db.report(root.settings.db_file), indent=4))
+        db.close_all()
+
+    def _gc(self):
+        for root in self.roots:
+            self.activate(root)
+            db.gc(root.settings.tombstone_days)
+
+    def gc(self):
+        """ Purge the old deleted records and compact the databases. """
+        self._gc()
+        db.close_all()
+
+    def _control_command(self, command):
+        """ Handle a control socket command.
+            Returns the response and if a sync should be forced. """
+
+        log.trace("Control command:", command)
+        self._stats['commands'] += 1
+        words = command.split(None, 2)
+
+        if words[:2] == ['sync', 'now']:
+            return {'ok': True}, True
+
+        elif words[:2] == ['sync', 'path'] and len(words) == 3:
+            path = os.path.normpath(words[2])
+            if self._root_of(path) is None:
+                return {'ok': False, 'error': 'Not in a sync root'}, False
+            self._pending[path] = 0
+            return {'ok': True, 'path': path}, True
+
+        elif words == ['pause']:
+            self._paused = True
+            return {'ok': True, 'paused': True}, False
+
+        elif words == ['resume']:
+            self._paused = False
+            return {'ok': True, 'paused': False}, True
+
+        elif words == ['status']:
+            return {
+                'ok': True,
+                'roots': [[r.settings.local_root_path,
+                           r.settings.remote_root_path] for r in self.roots],
+                'paused': self._paused,
+                'pending_paths': len(self._pending),
+                'queued': self._queued(),
+                'quarantined': self._quarantined(),
+                'last_sync': db.getLastSync(),
+                'next_poll': int(max(0, self._next_poll - time.time())),
+            }, False
+
+        elif words == ['stats']:
+            stats = dict(self._stats)
+            stats['uptime'] = int(time.time() - stats.pop('started'))
+            stats['ok'] = True
+            return stats, False
+
+        elif words == ['stop']:
+            self._running = False
+            return {'ok': True}, False
+
+        return {'ok': False, 'error': 'Unknown command: %s' % command}, False
@@ -0,0 +1,152 @@
+import os
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+
+from . import log
+
+# inotify event masks, from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+_READ_SIZE = 65536
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+
+class Event:
+    """ A single inotify event with the full path resolved. """
+
+    def __init__(self, wd, mask, cookie, name, path):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+        self.path = path
+
+    def is_dir(self):
+        return bool(self.mask & IN_ISDIR)
+
+    def __repr__(self):
+        return "Event::%x::%s" % (self.mask, self.path)
+
+
+class Inotify:
+    """ Minimal inotify binding using ctypes, keeps track
+        of the path of each watched directory. """
+
+    def __init__(self):
+        self._libc = _load_libc()
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._paths = {}
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # removed before we could watch it
+                return None
+            raise OSError(err, os.strerror(err), path)
+
+        # the same directory returns the same wd, update the path
+        self._paths[wd] = path
+        return wd
+
+    def add_watch_recursive(self, path):
+        """ Watch a directory and all of it's subdirectories.
+            Returns the list of directories watched. """
+        watched = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            if self.add_watch(dirpath) is not None:
+                watched.append(dirpath)
+        return watched
+
+    def remove_watch_recursive(self, path):
+        """ Stop watching a directory and it's subdirectories,
+            e.g. after it was moved away. """
+        for wd, wpath in list(self._paths.items()):
+            if wpath == path or wpath.startswith(path + os.sep):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                self._paths.pop(wd, None)
+
+    def watched(self):
+        return list(self._paths.values())
+
+    def read_events(self, timeout=None):
+        """ Wait up to timeout seconds and return the list of events. """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+
+            name = os.fsdecode(name)
+            parent = self._paths.get(wd)
+
+            if mask & IN_IGNORED:
+                # watch removed by the kernel
+                self._paths.pop(wd, None)
+
+            if parent is None and not mask & IN_Q_OVERFLOW:
+                continue
+
+            path = os.path.join(parent, name) if name else parent
+            events.append(Event(wd, mask, cookie, name, path))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+            self._paths = {}
+        log.trace("Inotify close OK")
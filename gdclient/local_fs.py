@@ -1,14 +1,13 @@
 import os
 import io
+import time
 import shutil
 import hashlib
 import mimetypes
-from datetime import datetime
-import pytz
 
 from googleapiclient.http import MediaFileUpload
 
-from . import log, auth, remote_fs
+from . import log, auth, remote_fs, utils, scheduler
 from .filesystem import *
 from .errors import *
 
@@ -17,6 +16,8 @@ class LinuxFS(FileSystem):
     """ A linux specific file handler.
         Can upload files to Google Drive. """
 
+    __slots__ = ()
+
     def __init__(self, path, is_dir=None):
         super().__init__()
 
@@ -29,7 +30,7 @@ class LinuxFS(FileSystem):
 
         # We can create instance even if it doesn't exist yet
         self.exists = os.path.exists(self.path)
-        self.name = os.path.basename(self.path)
+        self.name = intern(os.path.basename(self.path))
 
         if self.exists:
             if os.path.isdir(self.path):
@@ -38,7 +39,7 @@ class LinuxFS(FileSystem):
             else:
                 self._is_dir = False
                 mmtype, encoding = mimetypes.guess_type(self.path)
-                self._mimeType = mmtype
+                self._mimeType = intern(mmtype)
 
         # explicitly set is_dir if specified
         if is_dir is not None:
@@ -78,18 +79,17 @@ class LinuxFS(FileSystem):
                 md5.update(chunk)
         return md5.hexdigest()
 
-    def modifiedTime(self):
+    def inode(self):
         if not self.exists:
             return None
+        return os.stat(self.path).st_ino
 
-        # get OS modified time
-        t = os.path.getmtime(self.path)
-
-        # convert unix epoch time string to datetime
-        dt = datetime.utcfromtimestamp(int(t))
+    def modifiedTime(self):
+        if not self.exists:
+            return None
 
-        # set utc timezone
-        return pytz.UTC.localize(dt)
+        # OS modified time, at full precision
+        return os.stat(self.path).st_mtime_ns
 
     def list_dir(self, recursive=False):
         """ Populate self.children list by reading current directory items. """
@@ -129,7 +129,8 @@ class LinuxFS(FileSystem):
 
         media = MediaFileUpload(self.path,
                                 mimetype=self._mimeType,
-                                chunksize=UPLOAD_CHUNK_SIZE,
+                                chunksize=scheduler.chunk_size(
+                                    scheduler.UPLOAD, UPLOAD_CHUNK_SIZE),
                                 resumable=True
                                 )
 
@@ -142,14 +143,20 @@ class LinuxFS(FileSystem):
         response = None
 
         log.say("Uploading file:", self.name, "please wait ...")
+        sent = 0
         while response is None:
             status, response = file.next_chunk()
             if status:
                 log.progress("Uploaded %d%%" % int(status.progress() * 100))
+                scheduler.throttle(scheduler.UPLOAD,
+                                   status.resumable_progress - sent)
+                sent = status.resumable_progress
+        # the last chunk comes with the response only
+        scheduler.throttle(scheduler.UPLOAD, media.size() - sent)
 
         if file:
             # record sync time
-            self._syncTime = datetime.utcnow()
+            self._syncTime = time.time_ns()
             log.say("Upload successful: ", self.path)
             return response
         else:
@@ -179,7 +186,8 @@ class LinuxFS(FileSystem):
 
         media = MediaFileUpload(
             self.path,
-            chunksize=UPLOAD_CHUNK_SIZE,
+            chunksize=scheduler.chunk_size(
+                scheduler.UPLOAD, UPLOAD_CHUNK_SIZE),
             resumable=True
         )
 
@@ -193,17 +201,23 @@ class LinuxFS(FileSystem):
         response = None
 
         log.say("Uploading file:", self.name, "please wait ...")
+        sent = 0
         while response is None:
             status, response = file.next_chunk()
             if status:
                 log.progress("Uploaded %d%%" % int(status.progress() * 100))
+                scheduler.throttle(scheduler.UPLOAD,
+                                   status.resumable_progress - sent)
+                sent = status.resumable_progress
+        # the last chunk comes with the response only
+        scheduler.throttle(scheduler.UPLOAD, media.size() - sent)
 
         if file:
             # update the remote file properties with the response json
             remote_file.set_object(response, None)
 
             # record sync time
-            self._syncTime = datetime.utcnow()
+            self._syncTime = time.time_ns()
             remote_file._syncTime = self._syncTime
 
             log.say("Update successful: ", self.path)
@@ -212,10 +226,18 @@ class LinuxFS(FileSystem):
 
         return remote_file
 
-    def upload_or_download(self, mirror):
+    def upload_or_download(self, mirror, source=None):
+        """ Upload to the mirror. If a remote source file with the same
+            content is given, copy it on the server instead. """
         if not isinstance(mirror, remote_fs.GDriveFS):
             raise ErrorNotDriveFSObject(mirror)
 
+        if source is not None:
+            try:
+                return source.copy_to(mirror)
+            except Exception as ex:
+                log.warn("Server side copy failed, uploading:", ex)
+
         response = self.gdrive_upload(mirror.parentIds)
 
         # path should be already set, so parent path is None
@@ -228,6 +250,39 @@ class LinuxFS(FileSystem):
             raise ErrorNotDriveFSObject(mirror)
         return self.gdrive_update(mirror)
 
+    def copy_to(self, target):
+        """ Copy the local file to the target object's path,
+            sharing the data blocks where supported. """
+        if not self.exists:
+            raise ErrorPathNotExists(self)
+
+        if self.is_dir():
+            raise IsADirectoryError("Can not copy directory", self)
+
+        method = utils.clone_file(self.path, target.path)
+
+        target.exists = True
+        target._syncTime = time.time_ns()
+        log.say("Local copy OK (%s):" % method, self.path, "==>", target.path)
+        return target
+
+    def rename(self, target):
+        """ Move and/or rename the local file or directory
+            to the target object's path. """
+        if not self.exists:
+            raise ErrorPathNotExists(self)
+
+        if os.path.exists(target.path):
+            raise FileExistsError(target.path)
+
+        parent = os.path.dirname(target.path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        os.rename(self.path, target.path)
+        log.say("Move OK:", self.path, "==>", target.path)
+        return LinuxFS(target.path, self.is_dir())
+
     def remove(self):
         log.trace("Removing", self)
 
@@ -239,5 +294,6 @@ class LinuxFS(FileSystem):
                     os.remove(self.path)
             except Exception as ex:
                 log.error(ex)
+                raise
             else:
                 log.say("Delete OK:", self.path)
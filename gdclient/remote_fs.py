@@ -1,12 +1,12 @@
 import os
 import io
+import time
 import shutil
-import dateutil.parser
-from datetime import datetime
 
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import MediaIoBaseDownload, DEFAULT_CHUNK_SIZE
+from googleapiclient.errors import HttpError
 
-from . import log, auth, local_fs
+from . import log, auth, local_fs, utils, scheduler
 from .filesystem import *
 from .errors import *
 
@@ -14,6 +14,8 @@ from .errors import *
 class GDriveFS(FileSystem):
     """ Google files/dirs handler class. """
 
+    __slots__ = ('is_google_doc',)
+
     def __init__(self, gdFileObject=None, parent_path=None):
         """ Initialize an empty class or with a response 
             object from GDrive api. """
@@ -30,8 +32,7 @@ class GDriveFS(FileSystem):
             if parent_path is None:
                 raise ErrorPathResolve("Parent path must be specified.", self)
             # if a response object, parse basic properties
-            self.gdFileObject = gdFileObject
-            self._parse_object(parent_path)
+            self._parse_object(gdFileObject, parent_path)
 
     def is_local(self):
         return False
@@ -79,8 +80,7 @@ class GDriveFS(FileSystem):
     def set_object(self, gdFileObject, parent_path):
         """ If the file/dir was initialized as an empty object,
             set it's properties using a GDrive api response. """
-        self.gdFileObject = gdFileObject
-        self._parse_object(parent_path)
+        self._parse_object(gdFileObject, parent_path)
 
     def set_name(self, parent_path, name, is_a_directory):
         """ If the file/dir was initialized as an empty object,
@@ -102,20 +102,21 @@ class GDriveFS(FileSystem):
         self._mimeType = MimeTypes.gdrive_directory
         self.name = os.path.basename(self.path)
 
-    def _parse_object(self, parent_path):
-        """ parse the common properties from the api response json. """
+    def _parse_object(self, gdFileObject, parent_path):
+        """ parse the common properties from the api response json,
+            the response itself is not kept. """
 
         # if has a valid id, it exists
-        self.id = self.gdFileObject.get('id')
+        self.id = gdFileObject.get('id')
         if self.id is None:
-            raise ErrorParseResponseObject(self, self.gdFileObject)
+            raise ErrorParseResponseObject(self, gdFileObject)
 
         self.exists = True
 
         # we will resolve the path using name
-        self.name = self.gdFileObject.get('name')
+        self.name = intern(gdFileObject.get('name'))
         if self.name is None:
-            raise ErrorParseResponseObject(self, self.gdFileObject)
+            raise ErrorParseResponseObject(self, gdFileObject)
 
         # resolve remote path
         # if path is already set, ignore
@@ -123,12 +124,14 @@ class GDriveFS(FileSystem):
             if parent_path:
                 self.path = os.path.join(parent_path, self.name)
 
-        self._mimeType = self.gdFileObject.get('mimeType')
-        self._modifiedTime = self.gdFileObject.get('modifiedTime')
+        self._mimeType = intern(gdFileObject.get('mimeType'))
+        if gdFileObject.get('modifiedTime'):
+            self._modifiedTime = utils.rfc3339_to_ns(
+                gdFileObject.get('modifiedTime'))
 
         # store parents to upload later
-        if self.gdFileObject.get('parents'):
-            for p_id in self.gdFileObject.get('parents'):
+        if gdFileObject.get('parents'):
+            for p_id in gdFileObject.get('parents'):
                 self.add_parent_id(p_id)
 
         # set _is_dir properly
@@ -137,12 +140,12 @@ class GDriveFS(FileSystem):
         else:
             self._is_dir = False
 
-        self.trashed = self.gdFileObject.get('trashed', False)
+        self.trashed = gdFileObject.get('trashed', False)
 
         if self.is_file():
             try:
-                self._size = int(self.gdFileObject.get('size'))
-                self._md5 = self.gdFileObject.get('md5Checksum')
+                self._size = int(gdFileObject.get('size'))
+                self._md5 = gdFileObject.get('md5Checksum')
                 self.is_google_doc = False
             except:
                 # ignore, these files might be google docs
@@ -181,17 +184,9 @@ class GDriveFS(FileSystem):
 
         if nextPageToken:
             log.trace("List directory fetching next page: ", self.path)
-            results = auth.service.files().list(
-                q="'%s' in parents and trashed = false" % self.id,
-                fields=LSFIELDS,
-                pageToken=nextPageToken,
-                pageSize=50).execute()
         else:
             log.trace("Listing directory: ", self.path)
-            results = auth.service.files().list(
-                q="'%s' in parents and trashed = false" % self.id,
-                fields=LSFIELDS,
-                pageSize=50).execute()
+        results = GDriveFS.list_page(self.id, nextPageToken)
 
         # if it's not the first page of list dir,
         # append to children list, otherwise clear it
@@ -215,6 +210,18 @@ class GDriveFS(FileSystem):
         if 'nextPageToken' in results:
             self.list_dir(results.get('nextPageToken'), recursive)
 
+    @staticmethod
+    def list_page(idn, nextPageToken=None):
+        """ Request one page of the children of a directory. """
+        request = {
+            'q': "'%s' in parents and trashed = false" % idn,
+            'fields': LSFIELDS,
+            'pageSize': 50
+        }
+        if nextPageToken:
+            request['pageToken'] = nextPageToken
+        return auth.service.files().list(**request).execute()
+
     def download_to_local(self, local_file):
         """ Download current remote file to a local file object and 
             set each other as mirrors. """
@@ -245,7 +252,7 @@ class GDriveFS(FileSystem):
             return False
 
         # record sync time
-        self._syncTime = datetime.utcnow()
+        self._syncTime = time.time_ns()
         local_file._syncTime = self._syncTime
 
         return True
@@ -268,13 +275,19 @@ class GDriveFS(FileSystem):
             request = auth.service.files().get_media(fileId=self.id)
 
             fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
+            downloader = MediaIoBaseDownload(
+                fh, request, chunksize=scheduler.chunk_size(
+                    scheduler.DOWNLOAD, DEFAULT_CHUNK_SIZE))
 
             log.say("Downloading file:", self.name, "please wait ...")
             done = False
+            received = 0
             while done is False:
                 status, done = downloader.next_chunk()
                 log.progress("Downloaded %d%%." % int(status.progress() * 100))
+                scheduler.throttle(scheduler.DOWNLOAD,
+                                   status.resumable_progress - received)
+                received = status.resumable_progress
 
             return fh
 
@@ -357,28 +370,93 @@ class GDriveFS(FileSystem):
         log.say("Resolved path OK: ", parent.path)
         return parent
 
-    def upload_or_download(self, mirror):
-        self.download_to_local(mirror)
+    def upload_or_download(self, mirror, source=None):
+        """ Download to the mirror. If a local source file with the same
+            content is given, copy it locally instead. """
+        if source is not None:
+            try:
+                return source.copy_to(mirror)
+            except Exception as ex:
+                log.warn("Local copy failed, downloading:", ex)
+
+        if not self.download_to_local(mirror):
+            raise IOError("Download failed", self.path)
         return mirror
 
     def update(self, mirror):
-        self.download_to_local(mirror)
+        if not self.download_to_local(mirror):
+            raise IOError("Download failed", self.path)
         return mirror
 
+    def copy_to(self, target):
+        """ Copy the remote file on the server to the target object's
+            parent and name, no content is transferred. """
+        if not self.id:
+            raise ErrorIDNotSet("Can not copy.", self)
+
+        if self.is_dir():
+            raise IsADirectoryError("Can not copy directory", self)
+
+        if not target.parentIds:
+            raise ErrorParentNotFound("Target parent IDs not set.", target)
+
+        log.trace("Copying", self, "to", target.path)
+        response = auth.service.files().copy(
+            fileId=self.id,
+            body={'name': target.name, 'parents': target.parentIds},
+            fields=FIELDS
+        ).execute()
+
+        # path should be already set, so parent path is None
+        target.set_object(response, None)
+        target._syncTime = time.time_ns()
+        log.say("Server side copy OK:", self.path, "==>", target.path)
+        return target
+
+    def rename(self, target):
+        """ Move and/or rename the remote file to the target object's
+            parent and name. Only metadata is updated, no content is sent. """
+        if not self.id:
+            raise ErrorIDNotSet("Can not move.", self)
+
+        if not target.parentIds:
+            raise ErrorParentNotFound("Target parent IDs not set.", target)
+
+        removeParents = [p for p in (self.parentIds or [])
+                         if p not in target.parentIds]
+        addParents = [p for p in target.parentIds
+                      if p not in (self.parentIds or [])]
+
+        log.trace("Moving", self, "to", target.path)
+        response = auth.service.files().update(
+            fileId=self.id,
+            addParents=",".join(addParents),
+            removeParents=",".join(removeParents),
+            body={'name': target.name},
+            fields=FIELDS
+        ).execute()
+
+        moved = GDriveFS()
+        moved.path = target.path
+        moved.set_object(response, None)
+        log.say("Move OK:", moved)
+        return moved
+
     def remove(self):
         if not self.id:
             raise ErrorIDNotSet("Can not remove.")
 
         log.trace("Removing", self)
         try:
-            # trash/delete is recursive
-            # @todo: if directory, recursively remove children from DB as well
+            # trash/delete is recursive, database.remove
+            # tombstones the children of a directory as well
             updated_file = auth.service.files().update(fileId=self.id,
                                                        body={'trashed': True},
                                                        fields=FIELDS
                                                        ).execute()
         except Exception as ex:
             log.error(ex)
+            raise
         else:
             self.set_object(updated_file, None)
             log.say("Trash OK:", self)
@@ -399,11 +477,17 @@ class GDChanges:
         page_token = self.startPageToken
 
         while page_token is not None:
-            response = auth.service.changes().list(
-                pageToken=page_token,
-                spaces='drive',
-                fields=CHFIELDS
-            ).execute()
+            try:
+                response = auth.service.changes().list(
+                    pageToken=page_token,
+                    spaces='drive',
+                    fields=CHFIELDS
+                ).execute()
+            except HttpError as ex:
+                # expired or otherwise unusable token
+                if ex.resp.status in (400, 404, 410):
+                    raise ErrorChangeTokenInvalid(page_token)
+                raise
             for change in response.get('changes'):
                 item = GDriveFS()
 
@@ -425,3 +509,109 @@ class GDChanges:
 
     def last_poll_token(self):
         return self.startPageToken
+
+
+class GDReconcile:
+    """ Recover the remote changes since the last successful sync
+        when no valid change token is available. Only the known
+        directories are queried for items modified after the last sync.
+        Trashed items are found by one query, and the known directories
+        are swept in batches for deletions and moves. Files moved in or
+        out, or deleted without the trash, keep their modified time and
+        are not found, a full scan finds those. """
+
+    QUERY_PARENTS = 40
+    BATCH_SIZE = 100
+
+    def __init__(self, last_sync, known_dirs):
+        """ last_sync is an RFC3339 UTC time string,
+            known_dirs is a dict of id: path of remote directories. """
+        self.last_sync = last_sync
+        self.known_dirs = dict(known_dirs)
+
+    def _list(self, query):
+        items = []
+        page_token = None
+        while True:
+            results = auth.service.files().list(
+                q=query,
+                fields=LSFIELDS,
+                pageToken=page_token,
+                pageSize=1000).execute()
+            items.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if page_token is None:
+                return items
+
+    def _query_dirs(self, dir_ids, condition):
+        """ List the children of the given directories, a few
+            directories per query. """
+        items = []
+        for i in range(0, len(dir_ids), self.QUERY_PARENTS):
+            parents = " or ".join(["'%s' in parents" % idn
+                                   for idn in dir_ids[i:i+self.QUERY_PARENTS]])
+            items.extend(self._list("(%s) and %s" % (parents, condition)))
+        return items
+
+    def modified(self):
+        """ Return a list of GDriveFS objects modified after the last sync.
+            Contents of the newly found directories are listed entirely,
+            since moved in items keep their old modified time. """
+
+        changed = []
+        condition = "modifiedTime > '%s'" % self.last_sync
+        dir_ids = list(self.known_dirs.keys())
+
+        while dir_ids:
+            new_dirs = []
+            for response in self._query_dirs(dir_ids, condition):
+                parent_path = None
+                for p_id in response.get('parents', []):
+                    if p_id in self.known_dirs:
+                        parent_path = self.known_dirs[p_id]
+                        break
+
+                item = GDriveFS(response, parent_path)
+                changed.append(item)
+
+                if item.is_dir() and not item.trashed \
+                        and item.id not in self.known_dirs:
+                    self.known_dirs[item.id] = item.path
+                    new_dirs.append(item.id)
+
+            dir_ids = new_dirs
+            condition = "trashed = false"
+
+        log.trace("Reconcile found %d modified items." % len(changed))
+        return changed
+
+    def trashed(self):
+        """ Return the IDs of the items trashed after the last sync. """
+        return [response['id'] for response in self._list(
+            "trashed = true and modifiedTime > '%s'" % self.last_sync)]
+
+    def sweep(self, ids):
+        """ Fetch the current state of the given IDs in batches.
+            Returns a dict of id: response object, None if removed. """
+
+        states = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                states[request_id] = response
+            elif isinstance(exception, HttpError) \
+                    and exception.resp.status == 404:
+                states[request_id] = None
+            else:
+                log.warn("Sweep failed:", request_id, exception)
+
+        ids = list(ids)
+        for i in range(0, len(ids), self.BATCH_SIZE):
+            batch = auth.service.new_batch_http_request(callback=callback)
+            for idn in ids[i:i+self.BATCH_SIZE]:
+                batch.add(auth.service.files().get(
+                    fileId=idn, fields=FIELDS), request_id=idn)
+            batch.execute()
+            log.progressdot()
+
+        return states
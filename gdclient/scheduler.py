@@ -0,0 +1,154 @@
+import re
+import time
+import fnmatch
+from datetime import datetime
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# transfer order rules, applied in the order listed in settings
+RULES = ['priority', 'small', 'recent']
+
+# resumable upload chunks must be multiples of 256 KB
+CHUNK_UNIT = 256 * 1024
+
+# process wide, the caps are shared by all sync roots
+_buckets = {}
+_deadline = None
+
+
+class TokenBucket:
+    """ Average rate in bytes per second, with bursts up to capacity.
+        A transfer takes it's bytes after each chunk, going into debt
+        if needed, and waits until the debt is paid back. """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self._time = time.monotonic()
+
+    def take(self, nbytes):
+        """ Take the bytes, returns the seconds to wait for them. """
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._time) * self.rate)
+        self._time = now
+        self.tokens -= nbytes
+        return max(0.0, -self.tokens / self.rate)
+
+
+def set_limits(rate=0, upload=0, download=0):
+    """ Set the bandwidth caps in bytes per second, 0 for no cap.
+        The total rate is shared by both directions. """
+    _buckets.clear()
+    for direction, value in [(None, rate), (UPLOAD, upload),
+                             (DOWNLOAD, download)]:
+        if value:
+            _buckets[direction] = TokenBucket(value)
+
+
+def throttle(direction, nbytes):
+    """ Account the bytes of a transferred chunk, and sleep as long
+        as the stricter of the total and the direction caps needs. """
+    wait = 0
+    for name in [None, direction]:
+        if name in _buckets:
+            wait = max(wait, _buckets[name].take(nbytes))
+    if wait:
+        time.sleep(wait)
+
+
+def chunk_size(direction, default):
+    """ About a second of transfer when capped, so the rate
+        is shaped smoothly, the default chunk size otherwise. """
+    rates = [_buckets[name].rate for name in [None, direction]
+             if name in _buckets]
+    if not rates:
+        return default
+    return min(default, max(CHUNK_UNIT, min(rates) // CHUNK_UNIT * CHUNK_UNIT))
+
+
+def set_budget(seconds):
+    """ Do not start new transfers after the given seconds from now,
+        None for no deadline. """
+    global _deadline
+    _deadline = time.time() + seconds if seconds else None
+
+
+def parse_duration(text):
+    """ Seconds of a duration like 90, 45m, 2h or 1h30m. """
+    match = re.fullmatch(r'(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?', text.strip())
+    if not text.strip() or not match:
+        raise ValueError("Invalid duration", text)
+    hours, minutes, seconds = (int(g or 0) for g in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_window(text):
+    """ Start and end minutes of the day of a time window
+        like 01:00-06:30, the end may be past midnight. """
+    match = re.fullmatch(r'(\d\d?):(\d\d)-(\d\d?):(\d\d)', text.strip())
+    if not match:
+        raise ValueError("Invalid time window", text)
+    h1, m1, h2, m2 = (int(g) for g in match.groups())
+    if h1 > 23 or h2 > 23 or m1 > 59 or m2 > 59:
+        raise ValueError("Invalid time window", text)
+    return h1 * 60 + m1, h2 * 60 + m2
+
+
+def in_window(window, now):
+    """ If the datetime is within the (start, end) minutes window. """
+    start, end = window
+    minute = now.hour * 60 + now.minute
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+class Scheduler:
+    """ Order of the transfer tasks of a sync root, and if new
+        transfers can be started now. """
+
+    def __init__(self, settings):
+        self.rules = settings.get('transfer_order', RULES)
+        for rule in self.rules:
+            if rule not in RULES:
+                raise ValueError("Unknown transfer order rule", rule)
+
+        # glob pattern: priority, higher first
+        self.priorities = settings.get('priority_paths', {})
+
+        window = settings.get('sync_window')
+        self.window = parse_window(window) if window else None
+
+    def priority(self, item):
+        """ Highest priority of the patterns matching the item,
+            by name or path like the ignore patterns, 0 if none. """
+        return max([p for pattern, p in self.priorities.items()
+                    if fnmatch.fnmatch(item.name or '', pattern) or
+                    (item.path and fnmatch.fnmatch(item.path, pattern))],
+                   default=0)
+
+    def key(self, item):
+        """ Sort key of a transfer, by the rules in order. """
+        key = []
+        for rule in self.rules:
+            if rule == 'priority':
+                key.append(-self.priority(item))
+            elif rule == 'small':
+                size = item.size()
+                key.append(size if size is not None else float('inf'))
+            else:
+                key.append(-(item.modifiedTime() or 0))
+        return tuple(key)
+
+    def allowed(self, now=None):
+        """ If new transfers can be started, before the budget deadline
+            and within the sync window. """
+        now = now or time.time()
+        if _deadline is not None and now >= _deadline:
+            return False
+        if self.window:
+            return in_window(self.window, datetime.fromtimestamp(now))
+        return True
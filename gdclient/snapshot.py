@@ -0,0 +1,139 @@
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import log, utils
+
+# one row per local item, sorted by path hash
+DTYPE = [
+    ('hash', '<i8'),
+    ('is_dir', '?'),
+    ('size', '<i8'),
+    ('mtime', '<i8'),
+    ('inode', '<u8'),
+    ('md5', 'V16'),
+]
+
+
+_NO_MD5 = bytes(16)
+
+
+def available():
+    """ Snapshots need numpy, without it every record is checked. """
+    return np is not None
+
+
+class Snapshot:
+    """ Columnar stat signatures of the local items, with the paths
+        kept in a separate file in the same order. The arrays are
+        memory mapped when loaded from a file. """
+
+    def __init__(self, rows, paths=None, paths_file=None):
+        self.rows = rows
+        self._paths = paths
+        self._paths_file = paths_file
+
+    def __len__(self):
+        return len(self.rows)
+
+    def path(self, index):
+        if self._paths is None:
+            with open(self._paths_file, 'rb') as f:
+                self._paths = f.read().split(b'\0')
+        return os.fsdecode(self._paths[index])
+
+    @staticmethod
+    def build(items):
+        """ Build from an iterable of
+            (path, is_dir, size, mtime_ns, inode, md5) tuples. """
+        items = list(items)
+        rows = np.zeros(len(items), dtype=DTYPE)
+        for i, (path, is_dir, size, mtime, inode, md5) in enumerate(items):
+            rows[i] = (utils.path_hash(path), is_dir, size or 0, mtime or 0,
+                       inode or 0, bytes.fromhex(md5) if md5 else _NO_MD5)
+
+        order = np.argsort(rows['hash'], kind='stable')
+        paths = [os.fsencode(items[i][0]) for i in order]
+        return Snapshot(rows[order], paths)
+
+    @staticmethod
+    def scan(root_path):
+        """ Walk a local directory and build the snapshot of it's
+            contents from stat only, without reading any file. """
+        items = []
+        stack = [os.path.relpath(root_path)]
+        while stack:
+            directory = stack.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    path = os.path.join(directory, entry.name)
+                    st = entry.stat()
+                    is_dir = entry.is_dir()
+                    if is_dir:
+                        stack.append(path)
+                        items.append((path, True, 0, 0, st.st_ino, None))
+                    else:
+                        items.append((path, False, st.st_size,
+                                      st.st_mtime_ns, st.st_ino, None))
+        return Snapshot.build(items)
+
+    @staticmethod
+    def load(file):
+        """ Memory map a saved snapshot, None if there is none. """
+        if np is None or not os.path.isfile(file + '.npy'):
+            return None
+        try:
+            rows = np.load(file + '.npy', mmap_mode='r')
+        except (OSError, ValueError) as ex:
+            log.warn("Ignoring unreadable snapshot", file, ex)
+            return None
+        return Snapshot(rows, paths_file=file + '.paths')
+
+    def save(self, file):
+        """ Write both files, replacing the old ones atomically. """
+        np.save(file + '.tmp.npy', self.rows)
+        with open(file + '.paths.tmp', 'wb') as f:
+            f.write(b'\0'.join(self._paths))
+        os.replace(file + '.paths.tmp', file + '.paths')
+        os.replace(file + '.tmp.npy', file + '.npy')
+        log.trace("Snapshot saved:", len(self), "items")
+
+    def diff(self, current):
+        """ Compare with a newer snapshot. Returns the indices of the
+            new items in current, the removed items in self, and the
+            files with a different stat signature in current and self. """
+        old, cur = self.rows, current.rows
+        if not len(old):
+            empty = np.zeros(0, dtype=np.intp)
+            return np.arange(len(cur)), empty, empty, empty
+
+        pos = np.searchsorted(old['hash'], cur['hash'])
+        pos[pos == len(old)] = 0
+        found = old['hash'][pos] == cur['hash']
+
+        # an item changed type, it was removed and added
+        matched = old[pos]
+        retyped = found & (matched['is_dir'] != cur['is_dir'])
+        found &= ~retyped
+
+        changed = found & ~cur['is_dir'] & (
+            (matched['size'] != cur['size']) |
+            (matched['mtime'] != cur['mtime']) |
+            (matched['inode'] != cur['inode']))
+
+        kept = np.zeros(len(old), dtype=bool)
+        kept[pos[found]] = True
+
+        changed = np.flatnonzero(changed)
+        return (np.flatnonzero(~found), np.flatnonzero(~kept),
+                changed, pos[changed])
+
+    def md5(self, index):
+        value = bytes(self.rows['md5'][index])
+        return value.hex() if value != _NO_MD5 else None
+
+    def is_dir(self, index):
+        return bool(self.rows['is_dir'][index])
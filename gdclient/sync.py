@@ -3,7 +3,9 @@ import fnmatch
 
 from . import log
 from . import auth
+from . import utils
 from . import database as db
+from .scheduler import Scheduler
 
 from .errors import *
 from .filesystem import FileSystem
@@ -18,6 +20,33 @@ class Task:
     update      = 'UPDATE'
     delete      = 'DELETE'
     conflict    = 'CONFLICT'
+    move        = 'MOVE'
+    restore     = 'RESTORE'
+    discard     = 'DISCARD'
+
+
+class Mode:
+    # both ways
+    sync        = 'sync'
+    # local changes to remote, remote changes are ignored
+    upload      = 'upload-only'
+    # remote changes to local, local changes are ignored
+    download    = 'download-only'
+    # remote changes to local, local changes are reverted
+    mirror      = 'mirror'
+
+    all = [sync, upload, download, mirror]
+
+
+# tasks that transfer file contents, ordered and limited by the scheduler
+TRANSFERS = [Task.load, Task.update, Task.restore]
+
+
+def _save_pair(item, mirror, save=db.update):
+    """ Record a synced item and it's mirror, and pair them. """
+    save(item)
+    save(mirror)
+    db.pair(item, mirror)
 
 
 class Sync:
@@ -25,9 +54,24 @@ class Sync:
         self.scopes = scopes
         self.settings = settings
         self._login = False
+        self._interactive = True
         self._check_queue = []
         self._sync_queue = []
 
+        # journal IDs of the sync queue items, in the same order
+        self._journal_ids = []
+
+        # remote change token to save once the changes are applied
+        self._change_token = None
+
+        self.mode = settings.get('mode', Mode.sync)
+        if self.mode not in Mode.all:
+            raise ValueError("Unknown sync mode", self.mode)
+
+        self.scheduler = Scheduler(settings)
+        # transfers left in the journal, out of the time limits
+        self._deferred = 0
+
         self.setup_auth()
 
     def setup_auth(self):
@@ -40,8 +84,18 @@ class Sync:
             self._login = True
             log.say("Authetication OK")
         else:
+            # another sync root may use a different account
+            auth.activate(self.settings.token_pickle)
             log.trace("Already logged in to remote.")
 
+    def reads_local(self):
+        """ If local changes can produce tasks in this mode. """
+        return self.mode != Mode.download
+
+    def reads_remote(self):
+        """ If remote changes can produce tasks in this mode. """
+        return self.mode != Mode.upload
+
     def __repr__(self):
         return "SyncQ items: \n" + "\n".join([str(i) for i in self._sync_queue])
 
@@ -50,51 +104,313 @@ class Sync:
 
         # if type and id not in queue, id is set to path for local files
         if not any(x for x in self._check_queue if all([x.id == item.id, x.__class__ == item.__class__])):
-            for ignore in self.settings.ignore_paths:
-                if fnmatch.fnmatch(item.name, ignore) or (item.path and fnmatch.fnmatch(item.path, ignore)):
-                    log.say("Ignore: ", item)
-                    return
+            if self.ignored(item):
+                log.say("Ignore: ", item)
+                return
             self._check_queue.append(item)
         else:
             log.trace("Already in queue:", item)
 
-    def get_Qmirror(self, item):
-        """ Return and remove the mirror item from the queue if exists. """
-        try:
-            mirror = db.calculate_mirror(item)
-        except ErrorPathResolve:
-            return None
-        qmirrors = [x for x in self._check_queue if all(
-            [x.path == mirror.path, x.__class__ == mirror.__class__])]
-        Qmirror = qmirrors[0] if len(qmirrors) else None
-        try:
-            # remove mirror from queue to avoid double handling
-            self._check_queue.remove(Qmirror)
-        except:
-            # "easier to ask for forgiveness than permission"
-            pass
+    def ignored(self, item):
+        """ If the item matches one of the ignore patterns. """
+        for ignore in self.settings.ignore_paths:
+            if fnmatch.fnmatch(item.name, ignore) or (item.path and fnmatch.fnmatch(item.path, ignore)):
+                return True
+        return False
+
+    def unchanged_dirs(self, directory):
+        """ Return the paths of the directories in a listed tree with the
+            same signature as saved in database, nothing under them
+            changed since their records were last updated. """
+        fstype = db.FileType.LinuxFS if isinstance(
+            directory, LinuxFS) else db.FileType.DriveFS
+        saved = db.get_dir_signatures(fstype)
+        unchanged = set()
+        if not saved:
+            return unchanged
+
+        def sign(d):
+            entries = []
+            for child in d.children:
+                if self.ignored(child):
+                    continue
+                if child.is_dir():
+                    entries.append((child.name, True, None, sign(child)))
+                elif fstype == db.FileType.LinuxFS:
+                    entries.append((child.name, False, child.size(),
+                                    child.modifiedTime()))
+                else:
+                    entries.append((child.name, False, child.size(),
+                                    child.md5()))
+            signature = utils.tree_signature(entries)
+            if saved.get(d.path) == signature:
+                unchanged.add(d.path)
+            return signature
+
+        sign(directory)
+        log.trace(len(unchanged), "unchanged directories.")
+        return unchanged
+
+    def adopt_matching(self, local_root, remote_root):
+        """ First sync of trees that are already the same, S2 in
+            algorithm.txt. The local and remote items at the same relative
+            path are joined, the files are hashed only if their sizes
+            match, and the matching pairs are added to the database at
+            once. The rest is found as new items by the scan.
+            Returns the number of pairs added. """
+
+        def walk(directory, root):
+            stack = [directory]
+            while stack:
+                d = stack.pop()
+                yield os.path.relpath(d.path, root), d
+                for child in d.children:
+                    if self.ignored(child):
+                        continue
+                    if child.is_dir():
+                        stack.append(child)
+                    else:
+                        yield os.path.relpath(child.path, root), child
 
-        return Qmirror
+        remote = dict(walk(remote_root, remote_root.path))
+        pairs = []
+        for path, item in walk(local_root, local_root.path):
+            mirror = remote.get(path)
+            if mirror is None or mirror.is_dir() != item.is_dir():
+                continue
+            if item.is_dir():
+                pairs.append((item, mirror, None))
+            elif mirror.md5() and item.size() == mirror.size() \
+                    and item.md5() == mirror.md5():
+                pairs.append((item, mirror, mirror.md5()))
+
+        count = db.adopt(pairs)
+        db.refresh_signatures()
+        log.say(count, "matching local and remote items adopted.")
+        return count
+
+    def _under(self, path, directory):
+        return path == directory or path.startswith(directory + os.sep)
+
+    def _detect_local_moves(self):
+        """ Pair the disappeared and the new local items in the check queue
+            to detect moves and renames. Paired items are removed from the
+            check queue and queued as move tasks. """
+
+        gone = {}
+        for item in self._check_queue:
+            if isinstance(item, LinuxFS) and item.trashed:
+                dbFile = db.get_file_as_db(item)
+                if dbFile and db.mirror_exists(item):
+                    gone[item.path] = (item, dbFile)
+
+        if not gone:
+            return 0
+
+        by_inode = {}
+        by_content = {}
+        for item, dbFile in gone.values():
+            if dbFile.inode():
+                by_inode[dbFile.inode()] = (item, dbFile)
+            if not dbFile.is_dir() and dbFile.md5():
+                by_content[(dbFile.size(), dbFile.md5())] = (item, dbFile)
+        sizes = set([k[0] for k in by_content.keys()])
+
+        new = [x for x in self._check_queue if isinstance(x, LinuxFS)
+               and x.exists and not x.trashed and not db.file_exists(x)]
+
+        # shallow items first, so directory moves claim their children
+        new.sort(key=lambda x: x.path.count(os.sep))
+
+        moves = []
+        claimed = []
+        for item in new:
+            if any(self._under(item.path, m.path) for m, o in moves):
+                continue
 
-    def _check_queue_items(self, item):
-        """ Check an item for update, creation etc and set to
-            corresponding task queue. """
+            match = by_inode.get(item.inode())
+            if match:
+                dbFile = match[1]
+                if dbFile.is_dir() != item.is_dir():
+                    match = None
+                elif item.is_file() and (
+                        dbFile.size() != item.size() or
+                        dbFile.modifiedTime() != item.modifiedTime()):
+                    match = None
+
+            # fall back to the content signature
+            if match is None and item.is_file() and item.size() in sizes:
+                match = by_content.get((item.size(), item.md5()))
+
+            if match is None or match[0].path in claimed:
+                continue
 
-        try:
-            item = db.resolve_path(item)
-        except:
-            # if path not resolved, file not within our directory, ignore
-            log.trace("Failed to resolve path from DB: ", item)
+            claimed.append(match[0].path)
+            moves.append((item, match[0]))
+
+        for item, old in moves:
+            log.trace("Move detected:", old.path, "==>", item.path)
+            self._check_queue = [x for x in self._check_queue if not (
+                isinstance(x, LinuxFS) and (
+                    (x.trashed and self._under(x.path, old.path)) or
+                    (not x.trashed and self._under(x.path, item.path) and
+                     os.path.normpath(os.path.join(old.path, os.path.relpath(
+                         x.path, item.path))) in gone)))]
+            self._sync_queue.append((Task.move, item, old))
+
+        return len(moves)
+
+    def _detect_remote_moves(self):
+        """ Find the remote changes of known IDs reported at a new path.
+            They are removed from the check queue and queued as move tasks,
+            so the local mirror is renamed instead of downloaded again. """
+
+        count = 0
+        for item in [x for x in self._check_queue if isinstance(x, GDriveFS)]:
+            if item.trashed or not item.id:
+                continue
+
+            old = db.get_file_by_id(item.id)
+            if old is None or old.trashed or not isinstance(old, GDriveFS):
+                continue
+
+            try:
+                path = db.resolve_path(item).path
+            except ErrorPathResolve:
+                # parent not known yet, resolve during execution
+                path = None
+
+            if path == old.path or not db.mirror_exists(old):
+                continue
+
+            log.trace("Remote move detected:", old.path, "==>", path)
+            self._check_queue.remove(item)
+            self._sync_queue.append((Task.move, item, old))
+            count += 1
+
+        return count
+
+    def _apply_mode(self):
+        """ Drop the tasks of the changes ignored by a one directional
+            mode. In mirror mode the local changes are turned into tasks
+            restoring the remote version. Conflicts are resolved by the
+            mode when they run. """
+        if self.mode == Mode.sync:
+            return
+
+        queue = []
+        for task, item, mirror in self._sync_queue:
+            local = isinstance(item, LinuxFS)
+            if task in [Task.nochange, Task.conflict] or \
+                    local == (self.mode == Mode.upload):
+                queue.append((task, item, mirror))
+            elif self.mode == Mode.mirror and \
+                    task in [Task.create, Task.load]:
+                queue.append((Task.discard, item, None))
+            elif self.mode == Mode.mirror and \
+                    task in [Task.update, Task.delete]:
+                queue.append((Task.restore, item, None))
+            else:
+                log.trace("Ignored in %s mode:" % self.mode, task, item)
+        self._sync_queue = queue
+
+    def _drop_covered_deletes(self):
+        """ Drop the delete tasks of the items under a directory that is
+            deleted as well. The directory is removed recursively, with
+            it's whole subtree on both sides in the database. """
+
+        dirs = set((item.__class__, item.path)
+                   for task, item, _ in self._sync_queue
+                   if task == Task.delete and item.path and item.is_dir())
+        if not dirs:
+            return 0
+
+        def covered(item):
+            path = os.path.dirname(item.path)
+            while path and path != os.path.dirname(path):
+                if (item.__class__, path) in dirs:
+                    return True
+                path = os.path.dirname(path)
+            return False
+
+        count = len(self._sync_queue)
+        self._sync_queue = [
+            (task, item, mirror) for task, item, mirror in self._sync_queue
+            if not (task == Task.delete and item.path and covered(item))]
+        return count - len(self._sync_queue)
+
+    def _check_queue_batch(self):
+        """ Check all the queued items at once, setting their tasks
+            in queue order. The records are fetched in batches, and
+            the queued mirrors are paired by path. """
+
+        queue = self._check_queue
+        self._check_queue = []
+
+        # resolve the remote paths from the parent IDs
+        unresolved = [x for x in queue if x.path is None and
+                      isinstance(x, GDriveFS) and x.parentIds]
+        parents = db.get_paths_by_id([x.parentIds[0] for x in unresolved])
+        for item in unresolved:
+            if item.parentIds[0] in parents:
+                item.path = os.path.join(parents[item.parentIds[0]], item.name)
+            else:
+                log.trace("Failed to resolve path from DB: ", item)
+
+        records = {}
+        for cls, fstype in [(LinuxFS, db.FileType.LinuxFS),
+                            (GDriveFS, db.FileType.DriveFS)]:
+            paths = [x.path for x in queue if isinstance(x, cls) and x.path]
+            for (path, is_dir), dbFile in db.get_files_as_db(
+                    fstype, paths).items():
+                records[(cls, path, is_dir)] = dbFile
+
+        # items resolved above had no path while queued,
+        # so they can not be found as the mirror of another item
+        late = set(id(x) for x in unresolved)
+        mirrors = {}
+        for item in queue:
+            if item.path is not None and id(item) not in late:
+                mirrors.setdefault((item.__class__, item.path), []).append(item)
+        for candidates in mirrors.values():
+            candidates.reverse()
+
+        done = set()
+
+        def qmirror(item):
+            if item.path is None:
+                return None
+            cls = GDriveFS if isinstance(item, LinuxFS) else LinuxFS
+            candidates = mirrors.get(
+                (cls, db.mirror_path(item.path, cls is GDriveFS)), [])
+            while candidates and id(candidates[-1]) in done:
+                candidates.pop()
+            if not candidates:
+                return None
+            mirror = candidates.pop()
+            done.add(id(mirror))
+            return mirror
+
+        for item in queue:
+            if id(item) in done:
+                continue
+            done.add(id(item))
+            dbFile = records.get(
+                (item.__class__, item.path, item.is_dir())) if item.path else None
+            self._set_task(item, dbFile, lambda: qmirror(item))
 
-        if db.file_exists(item):
+    def _set_task(self, item, dbFile, get_Qmirror):
+        """ Set the task of an item from it's database record, None if not
+            in database, and it's queued mirror returned by get_Qmirror. """
+
+        if dbFile:
             # change, no change, delete
-            dbFile = db.get_file_as_db(item)
             log.trace("DB record found:", dbFile)
 
             if not item.same_file(dbFile):
                 log.trace("Not same as DB:", item)
                 # change or delete
-                Qmirror = self.get_Qmirror(item)
+                Qmirror = get_Qmirror()
                 if Qmirror:
                     # change in both local and remote
                     if item.same_file(Qmirror):
@@ -124,7 +440,7 @@ class Sync:
         else:
             log.trace("Not in DB:", item)
             # new file, new setup
-            Qmirror = self.get_Qmirror(item)
+            Qmirror = get_Qmirror()
             if Qmirror:
                 # item both in local and remote
                 if item.same_file(Qmirror):
@@ -150,89 +466,276 @@ class Sync:
 
     def _execute(self):
         """ Run the set task for the queue items. """
-        while self._sync_queue:
-            task, item, Qmirror = self._sync_queue.pop(0)
+        while self.execute_next():
+            pass
 
-            log.trace("Processing", task, item)
+    def execute_next(self):
+        """ Run the task of the next queue item, and mark it done in the
+            journal in the same transaction as it's database updates.
+            Returns False if the queue is empty. """
+        if not self._sync_queue:
+            if self._deferred:
+                log.say(self._deferred, "transfers left for the next run.")
+                self._deferred = 0
+            self.commit_change_token()
+            db.journal_clear()
+            return False
+
+        task, item, Qmirror = self._sync_queue.pop(0)
+        jid = self._journal_ids.pop(0)
+
+        if self._is_transfer(task, item) and not self.scheduler.allowed():
+            # stays pending in the journal, resumed by a later run
+            self._deferred += 1
+            return True
 
-            try:
-                item = db.resolve_path(item)
-            except:
-                # if path not resolved, file not within our directory, ignore
-                log.trace("Failed to resolve path from DB: ", item)
-                continue
+        try:
+            writes = self._run_task(task, item, Qmirror, jid)
+            # the write lock is held for the database writes only,
+            # not during the transfers or a conflict prompt
+            with db.atomic():
+                if writes:
+                    writes()
+                db.journal_done(jid)
+        except Exception as ex:
+            # database changes of the task are rolled back,
+            # keep it in the journal to retry later
+            log.warn(type(ex).__name__)
+            log.warn("Task.%s failed:" % task, ex)
+            db.journal_failed(jid, ex)
+
+        return True
+
+    def _run_task(self, task, item, Qmirror, jid=None):
+        """ Run the transfers and file operations of a task. Returns a
+            function of it's database writes, run by the caller in one
+            short transaction with the journal update, or None. """
+        log.trace("Processing", task, item)
 
-            if task == Task.create:
-                try:
-                    mirror = db.calculate_mirror(item)
-                    mirror.create_dir()
-                    db.add(item)
-                    db.add(mirror)
-                except Exception as ex:
-                    log.warn(type(ex).__name__)
-                    log.warn("Task.create failed:", ex)
-
-            elif task == Task.update:
-                try:
-                    # mirror must exists in db for updating
-                    mirror = db.get_mirror(item)
-                    self._sync_files(item, mirror)
-                except Exception as ex:
-                    log.warn(type(ex).__name__)
-                    log.warn("Task.update failed:", ex)
-
-            elif task == Task.load:
-                # mirror existence in database is optional
-                try:
-                    mirror = db.calculate_mirror(item)
-                    db.add(item)
-                    mirror = item.upload_or_download(mirror)
-                    db.add(mirror)
-                except Exception as ex:
-                    log.warn(type(ex).__name__)
-                    log.warn("Task.load failed:", ex)
-
-            elif task == Task.delete:
-                try:
-                    db.remove(item)
-                    if db.mirror_exists(item):
-                        mirror = db.get_mirror(item)
-                        mirror.remove()
-                        db.remove(mirror)
-                except Exception as ex:
-                    log.warn(type(ex).__name__)
-                    log.warn("Task.delete failed:", ex)
-
-            elif task == Task.conflict:
-                try:
-                    self.resolve_conflict(item, Qmirror)
-                except Exception as ex:
-                    log.warn(type(ex).__name__)
-                    log.warn("Task.conflict failed:", ex)
+        try:
+            item = db.resolve_path(item)
+        except:
+            # if path not resolved, file not within our directory, ignore
+            log.trace("Failed to resolve path from DB: ", item)
+            return None
+
+        if task == Task.create:
+            mirror = db.calculate_mirror(item)
+            mirror.create_dir()
+            return lambda: _save_pair(item, mirror, db.add)
+
+        elif task == Task.update:
+            # mirror must exists in db for updating
+            mirror = db.get_mirror(item)
+            return self._sync_files(item, mirror)
+
+        elif task == Task.load:
+            if Qmirror is not None:
+                # transferred before an interrupted run, record it only
+                mirror = Qmirror
             else:
-                # no change
-                db.update(item)
-                db.update(Qmirror)
+                # mirror existence in database is optional
+                mirror = db.calculate_mirror(item)
+                source = db.find_duplicate(item)
+                mirror = item.upload_or_download(mirror, source)
+                if jid:
+                    db.journal_transferred(jid, mirror)
+            return lambda: _save_pair(item, mirror, db.add)
+
+        elif task == Task.delete:
+            # find the mirror before the pair is removed
+            mirror = db.get_mirror(item) if db.mirror_exists(item) else None
+            if mirror:
+                mirror.remove()
+
+            def writes():
+                db.remove(item)
+                if mirror:
+                    db.remove(mirror)
+            return writes
+
+        elif task == Task.move:
+            return self._move(item, Qmirror)
+
+        elif task == Task.restore:
+            return self._restore(item)
+
+        elif task == Task.discard:
+            item.remove()
+            return lambda: db.remove(item)
+
+        elif task == Task.conflict:
+            return self.resolve_conflict(item, Qmirror)
 
-    def run(self):
-        """ Process sync queue """
+        else:
+            # no change
+            return lambda: _save_pair(item, Qmirror)
+
+    def _is_transfer(self, task, item):
+        """ If the task copies a file. A conflict does when resolved,
+            by the mode's side or by the prompt, not when skipped. """
+        if item.is_dir():
+            return False
+        if task == Task.conflict:
+            return self.mode != Mode.sync or self._interactive
+        return task in TRANSFERS
+
+    def _schedule_key(self, entry):
+        """ Other tasks keep their order before the transfers,
+            so the directories exist before their contents. """
+        task, item, mirror = entry
+        if self._is_transfer(task, item):
+            return (1,) + self.scheduler.key(item)
+        return (0,)
+
+    def _drop_journaled(self):
+        """ Drop the tasks already unfinished in the journal: transfers
+            left out of the time limits, failed tasks waiting for their
+            retry and quarantined ones, so a task failing again and
+            again is journaled once. Returns the number of tasks dropped. """
+        pending = set((task, type(item), item.path)
+                      for jid, (task, item, mirror) in db.journal_unfinished()
+                      if item.path)
+        if not pending:
+            return 0
+
+        count = len(self._sync_queue)
+        self._sync_queue = [
+            (task, item, mirror) for task, item, mirror in self._sync_queue
+            if (task, type(item), item.path) not in pending]
+        return count - len(self._sync_queue)
+
+    def pending(self):
+        """ Number of items waiting to be checked. """
+        return len(self._check_queue)
+
+    def prepare(self, interactive=True):
+        """ Check the queued items and set the tasks. If interactive,
+            ask for confirmation. Returns True if there are tasks to run. """
+        self._interactive = interactive
         log.say("Checking SyncQ: ", len(self._check_queue), "items")
 
-        while self._check_queue:
-            self._check_queue_items(self._check_queue.pop(0))
+        # local moves are reverted in mirror mode, as a delete and a new item
+        if self.mode in [Mode.sync, Mode.upload]:
+            n = self._detect_local_moves()
+            if n:
+                log.say(n, "local moves detected.")
+
+        if self.reads_remote():
+            n = self._detect_remote_moves()
+            if n:
+                log.say(n, "remote moves detected.")
+
+        self._check_queue_batch()
+        self._apply_mode()
+
+        n = self._drop_covered_deletes()
+        if n:
+            log.trace(n, "deletes covered by their directory delete.")
+
+        # parents before children, so moved or created directories
+        # exist before their new contents are processed,
+        # unresolved paths are resolved last
+        self._sync_queue.sort(key=lambda t: (
+            t[1].path is None, (t[1].path or '').count(os.sep)))
+        self._sync_queue.sort(key=self._schedule_key)
+
+        n = self._drop_journaled()
+        if n:
+            log.trace(n, "tasks already in the journal.")
 
         log.say("SyncQ check complete.")
 
         if len(self._sync_queue):
             print(self)
-            input("Press Enter to execute the above changes: ")
+            if interactive:
+                input("Press Enter to execute the above changes: ")
             self.login()
-            self._execute()
+            self._journal_ids = db.journal_add(self._sync_queue)
+            return True
         else:
             log.say("All files in sync, no action needed.")
+            self.commit_change_token()
+            return False
+
+    def resume(self):
+        """ Run the tasks left pending in the journal by an interrupted
+            run, and the failed tasks due for a retry.
+            Returns the number of tasks resumed. """
+        pending = db.journal_pending() + db.journal_retry()
+        if not self.scheduler.allowed():
+            # the transfers wait in the journal, the other tasks can run
+            pending = [(jid, task) for jid, task in pending
+                       if not self._is_transfer(task[0], task[1])]
+        if not pending:
+            return 0
+
+        log.say("Resuming", len(pending), "tasks from the journal.")
+        # the journal IDs move with their tasks
+        pending.sort(key=lambda p: self._schedule_key(p[1]))
+        self._journal_ids = [jid for jid, task in pending]
+        self._sync_queue = [task for jid, task in pending]
+        print(self)
+        self.login()
+        self._execute()
+        return len(pending)
+
+    def set_change_token(self, token):
+        """ Remember the new remote change token, it's saved
+            only after the queued changes are executed. """
+        self._change_token = token
+
+    def commit_change_token(self):
+        """ Save the remembered remote change token. """
+        if self._change_token:
+            db.setChangeToken(self._change_token)
+            self._change_token = None
+
+    def run(self, interactive=True):
+        """ Process sync queue. If not interactive, execute without
+            confirmation and skip the conflicts. """
+        if self.prepare(interactive):
+            self._execute()
 
         log.say("Finished Sync.")
 
+    def _move(self, item, old):
+        """ Move the mirror of the old item to the mirror path of the
+            moved item, and rewrite the database paths of both subtrees. """
+        log.trace("Moving:", old, " ==> ", item)
+
+        mirror = db.get_mirror(old)
+        target = db.calculate_mirror(item)
+
+        moved = mirror.rename(target)
+
+        def writes():
+            db.move(mirror, target.path)
+            db.move(old, item.path)
+            _save_pair(item, moved)
+        return writes
+
+    def _restore(self, item):
+        """ Put the remote version of a changed or deleted local item
+            back in place. """
+        try:
+            mirror = db.get_mirror(item)
+        except ErrorNotInDatabase:
+            # never synced from the remote side, nothing to restore
+            if item.exists:
+                item.remove()
+            return lambda: db.remove(item)
+        log.trace("Restoring:", mirror, " ==> ", item)
+
+        if mirror.is_dir():
+            item = LinuxFS(item.path, True)
+            item.create_dir()
+        else:
+            # stat the downloaded file again
+            mirror.update(item)
+            item = LinuxFS(item.path, False)
+        return lambda: _save_pair(item, mirror)
+
     def _sync_files(self, item, mirror):
         """ Sync the item with it's mirror file. """
         log.trace("Syncing:", item, " ==> ", mirror)
@@ -244,27 +747,34 @@ class Sync:
         # the one saved in database
         if item.modifiedTime() > dbItem.modifiedTime():
             mirror = item.update(mirror)
-            db.update(item)
-            db.update(mirror)
+            return lambda: _save_pair(item, mirror)
+        return None
 
     def resolve_conflict(self, item, mirror):
         log.warn("Conflict between", item, "and", mirror)
-        print("1. Keep", item)
-        print("2. Keep", mirror)
-        print("Anything else: skip")
+        if self.mode != Mode.sync:
+            # the source side of the mode wins
+            local = isinstance(item, LinuxFS)
+            i = 1 if local == (self.mode == Mode.upload) else 2
+        elif not self._interactive:
+            log.warn("Skipped, please run interactively to resolve.")
+            return None
+        else:
+            print("1. Keep", item)
+            print("2. Keep", mirror)
+            print("Anything else: skip")
 
-        try:
-            i = int(input("Please enter your choice: "))
-        except:
-            i = None
+            try:
+                i = int(input("Please enter your choice: "))
+            except:
+                i = None
 
         if i == 1:
             log.trace("Syncing:", item, " ==> ", mirror)
             mirror = item.update(mirror)
-            db.update(item)
-            db.update(mirror)
+            return lambda: _save_pair(item, mirror)
         elif i == 2:
             log.trace("Syncing:", mirror, " ==> ", item)
             item = mirror.update(item)
-            db.update(mirror)
-            db.update(item)
+            return lambda: _save_pair(item, mirror)
+        return None
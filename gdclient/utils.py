@@ -1,6 +1,17 @@
 import os
 import re
 import json
+import fcntl
+import shutil
+import hashlib
+import dateutil.parser
+from datetime import date, datetime, timezone
+
+# ioctl request to share the data blocks of a file, linux/fs.h
+FICLONE = 0x40049409
+
+NS = 1000000000
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
 
 
 class AttrDict(dict):
@@ -127,3 +138,97 @@ def _do_cmp(f1, f2):
                 return False
             if not b1:
                 return True
+
+
+def clone_file(src, dst):
+    """ Copy a file using a reflink where the filesystem supports it,
+        otherwise with copy_file_range or a plain copy.
+        Returns the method used. """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+
+        try:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            if remaining == 0:
+                return 'copy_file_range'
+        except (AttributeError, OSError):
+            # not available, or not supported between these filesystems
+            pass
+
+        # stopped short, e.g. the source changed, copy it all again
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+
+        shutil.copyfileobj(fsrc, fdst, 1048576)
+        return 'copy'
+
+
+def rfc3339_to_ns(text):
+    """ Convert a time string to integer nanoseconds since the epoch.
+        The fixed UTC format of the api, e.g. 2019-05-21T12:10:12.123Z,
+        is sliced directly, other formats are left to dateutil. """
+    if len(text) >= 20 and text[10] == 'T' and text[-1] == 'Z' \
+            and text[19] in '.Z':
+        days = date(int(text[0:4]), int(text[5:7]),
+                    int(text[8:10])).toordinal() - _EPOCH_ORDINAL
+        seconds = (days * 86400 + int(text[11:13]) * 3600 +
+                   int(text[14:16]) * 60 + int(text[17:19]))
+        fraction = text[20:-1]
+        if fraction:
+            return seconds * NS + int(fraction[:9].ljust(9, '0'))
+        return seconds * NS
+
+    return datetime_to_ns(dateutil.parser.parse(text))
+
+
+def datetime_to_ns(dt):
+    """ Naive datetimes are taken as UTC. """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    delta = dt - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * NS + \
+        delta.microseconds * 1000
+
+
+def ns_to_datetime(ns):
+    """ UTC datetime of integer nanoseconds, for display. """
+    return datetime.fromtimestamp(ns / NS, timezone.utc)
+
+
+def to_ns(value):
+    """ Integer nanoseconds of a time stored in any of the older
+        representations: string, datetime or already an integer. """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, datetime):
+        return datetime_to_ns(value)
+    return rfc3339_to_ns(str(value))
+
+
+def tree_signature(entries):
+    """ Stable signed 64 bit signature of a directory, from the
+        (name, is_dir, size, stamp) of it's children in any order.
+        The stamp of a file is it's md5 or modified time, of a
+        directory it's signature. """
+    digest = hashlib.blake2b(digest_size=8)
+    for entry in sorted(repr((name, bool(is_dir), size, stamp))
+                        for name, is_dir, size, stamp in entries):
+        digest.update(entry.encode('utf-8', 'surrogateescape') + b'\n')
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+
+def path_hash(path):
+    """ Stable signed 64 bit hash of a path, fits an SQLite integer. """
+    digest = hashlib.blake2b(os.fsencode(path), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
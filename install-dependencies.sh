@@ -1,4 +1,4 @@
 #!/usr/bin/env bash
 # installer
 
-pip install --upgrade pytz python-dateutil google-api-python-client google-auth-httplib2 google-auth-oauthlib peewee
+pip install --upgrade python-dateutil google-api-python-client google-auth-httplib2 google-auth-oauthlib peewee
@@ -2,11 +2,22 @@ import unittest
 
 import os
 import json
+import random
+import shutil
+import sqlite3
+import peewee
+import hashlib
+import threading
+import dateutil.parser
+from datetime import datetime, timedelta
 import gdclient.database as db
+from gdclient import sync, utils, inotify, control, auth, snapshot, scheduler
 from gdclient.errors import *
 from gdclient.local_fs import LinuxFS
-from gdclient.remote_fs import GDriveFS
+from gdclient.remote_fs import GDriveFS, GDReconcile
 from gdclient.filesystem import FileSystem
+from gdclient.gdclient import PyGDClient
+from gdclient.snapshot import Snapshot
 
 remote_path = '/Photos'
 local_path = 'Sync_Dir'
@@ -66,6 +77,44 @@ class TestRemote(unittest.TestCase):
         self.assertEqual(sd.id, "12345_photo_folder")
         self.assertIsNotNone(sd.mimeType())
 
+    def test_modified_time(self):
+        parent, subdir = load_test_responses()
+        response = parent.get('files')[1]
+        sd = GDriveFS(response, remote_path)
+        self.assertEqual(sd.modifiedTime(), utils.datetime_to_ns(
+            dateutil.parser.parse(response.get('modifiedTime'))))
+
+        ns = utils.rfc3339_to_ns('2019-05-21T12:10:12.123456789Z')
+        self.assertEqual(ns % utils.NS, 123456789)
+        self.assertEqual(utils.to_ns('2019-05-21 12:10:12+00:00'),
+                         utils.rfc3339_to_ns('2019-05-21T12:10:12Z'))
+
+    def test_reconcile_new_dir(self):
+        rc = GDReconcile('2020-01-01T00:00:00', {'test_12345': remote_path})
+        responses = {
+            'test_12345': [
+                {'id': 'old_id', 'name': 'old.jpg', 'mimeType': 'image/jpeg',
+                 'parents': ['test_12345'],
+                 'modifiedTime': '2019-05-21T12:10:12.000Z'},
+                {'id': 'new_id', 'name': 'New',
+                 'mimeType': 'application/vnd.google-apps.folder',
+                 'parents': ['test_12345'],
+                 'modifiedTime': '2020-02-01T12:10:12.000Z'}],
+            # moved in, modified before
+            'new_id': [
+                {'id': 'inner_id', 'name': 'in.jpg', 'mimeType': 'image/jpeg',
+                 'parents': ['new_id'],
+                 'modifiedTime': '2019-05-21T12:10:12.000Z'}]}
+
+        def query_dirs(ids, condition):
+            # both UTC RFC3339, ordered as strings
+            return [r for idn in ids for r in responses.get(idn, [])
+                    if 'modifiedTime' not in condition or
+                    r['modifiedTime'] > rc.last_sync]
+        rc._query_dirs = query_dirs
+
+        self.assertEqual([item.path for item in rc.modified()],
+                         [remote_path + '/New', remote_path + '/New/in.jpg'])
 
 class TestLocal(unittest.TestCase):
 
@@ -206,6 +255,21 @@ class TestDatabase(unittest.TestCase):
         ret = db.get_file_by_id(rr.id)
         self.assertEqual(ret.path, rr.path)
 
+    def test_readonly_report(self):
+        with db.atomic():
+            db.setLastSync('2019-05-21T12:10:12')
+            # the reader sees the last commit without waiting for the writer
+            report = db.report(self.test_database)
+            self.assertIsNone(report['last_sync'])
+            self.assertEqual(report['records'], 7)
+
+        self.assertEqual(db.report(self.test_database)['last_sync'],
+                         '2019-05-21T12:10:12')
+        reader = db.connect_readonly(self.test_database)
+        with self.assertRaises(peewee.OperationalError):
+            reader.execute_sql("DELETE FROM record")
+        reader.close()
+
     def test_update_status(self):
         ret = db.get_file_by_id('test_12345')
         db.update_status(ret, db.Status.synced)
@@ -213,6 +277,18 @@ class TestDatabase(unittest.TestCase):
         row = db.get_record_by_id('test_12345')
         self.assertEqual(row.status, db.Status.synced)
 
+    def test_last_sync(self):
+        self.assertIsNone(db.getLastSync())
+        db.setLastSync("2019-05-21T12:10:12")
+        self.assertEqual(db.getLastSync(), "2019-05-21T12:10:12")
+
+    def test_remote_dirs(self):
+        dirs = db.get_remote_dirs()
+        self.assertEqual(dirs.get('test_12345'), remote_path)
+        self.assertEqual(dirs.get('12345_photo_folder'), remote_path+'/Photos')
+        self.assertEqual(len(dirs), 2)
+        self.assertEqual(len(db.get_all_remote()), 4)
+
     def test_get_mirror(self):
         fp = LinuxFS("settings.json")
         dp = LinuxFS("gdclient")
@@ -268,5 +344,1059 @@ class TestDatabase(unittest.TestCase):
             self.assertEqual(remote_mirror.path, rpath)
 
 
+class TestMigration(unittest.TestCase):
+    test_database = 'test_database.sqlite'
+
+    def setUp(self):
+        # a database file written before the schema versions
+        conn = sqlite3.connect(self.test_database)
+        conn.executescript("""
+            CREATE TABLE configs (id INTEGER PRIMARY KEY,
+                changeToken VARCHAR(10), remote_root_id VARCHAR(512));
+            CREATE TABLE record (id INTEGER PRIMARY KEY,
+                name VARCHAR(256) NOT NULL, fstype VARCHAR(16) NOT NULL,
+                path VARCHAR(4096) NOT NULL, id_str VARCHAR(512),
+                is_dir INTEGER NOT NULL, deleted INTEGER NOT NULL,
+                status INTEGER NOT NULL, mimeType VARCHAR(64),
+                time_added DATETIME NOT NULL, time_modified DATETIME,
+                time_updated DATETIME, md5 VARCHAR(33), size INTEGER);
+            INSERT INTO configs VALUES (1, '1234', 'test_12345');
+            INSERT INTO record VALUES (1, '1.jpg', 'LinuxFS',
+                'Sync_Dir/Photos/1.jpg', 'Sync_Dir/Photos/1.jpg', 0, 0, 2,
+                'image/jpeg', '2019-05-21 12:10:12', '2019-05-21 12:10:12+00:00',
+                NULL, 'a1f5c9df5f7c8c2e3d4a1d8c5ca4e1d2', 9);
+            INSERT INTO record VALUES (2, '1.jpg', 'DriveFS',
+                '/Photos/Photos/1.jpg', 'photo_1_id', 0, 0, 2,
+                'image/jpeg', '2019-05-21 12:10:12', '2019-05-21T12:10:12.266Z',
+                NULL, 'a1f5c9df5f7c8c2e3d4a1d8c5ca4e1d2', 9);
+            INSERT INTO record VALUES (3, 'Photos', 'LinuxFS',
+                'Sync_Dir/Photos', 'Sync_Dir/Photos', 1, 0, 2, NULL,
+                '2019-05-21 12:10:12', NULL, NULL, NULL, NULL);
+            CREATE INDEX record_path ON record (path);
+        """)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        db.close()
+        if os.path.isfile(self.test_database):
+            os.remove(self.test_database)
+
+    def test_upgrade(self):
+        db.connect(self.test_database, remote_path, local_path)
+        self.assertEqual(db._schema_version(), db.SCHEMA_VERSION)
+        self.assertEqual(db.getRootId(), 'test_12345')
+
+        lf = LinuxFS(local_path + '/Photos/1.jpg', False)
+        self.assertTrue(db.file_exists(lf))
+        self.assertEqual(db.get_file_as_db(lf).modifiedTime(),
+                         utils.rfc3339_to_ns('2019-05-21T12:10:12Z'))
+        self.assertEqual(db.get_mirror(lf).id, 'photo_1_id')
+        self.assertFalse(db.Record.select().where(
+            db.Record.path_hash.is_null()).exists())
+        self.assertEqual(db.Record.get_by_id(1).parent_id, 3)
+        self.assertNotIn('record_path', [
+            i.name for i in db._db.get_indexes('record')])
+        self.assertEqual(
+            sorted(c.name for c in db._db.get_columns('record')),
+            sorted([f.column_name for f in db.Record._meta.sorted_fields] +
+                   ['time_modified']))
+
+        # hashes follow the paths when moved
+        db.move(lf, local_path + '/Album/1.jpg')
+        self.assertTrue(db.file_exists(
+            LinuxFS(local_path + '/Album/1.jpg', False)))
+
+        # nothing to do on the next connect
+        db.close()
+        db.connect(self.test_database, remote_path, local_path)
+        self.assertEqual(db._schema_version(), db.SCHEMA_VERSION)
+
+
+class TestSync(unittest.TestCase):
+    test_database = 'test_database.sqlite'
+
+    def setUp(self):
+        db.connect(self.test_database, remote_path, local_path)
+        os.makedirs(os.path.join(local_path, 'Photos'))
+        with open(os.path.join(local_path, 'Photos', '1.jpg'), 'w') as fp:
+            fp.write('photo one')
+
+        settings = utils.AttrDict({'ignore_paths': [], 'token_pickle': None})
+        self.sync = sync.Sync([], settings)
+
+        rr = GDriveFS()
+        rr.set_path_id(remote_path, 'test_12345', True)
+        for path, idn, isDir in [
+                (local_path, None, True),
+                (local_path + '/Photos', None, True),
+                (local_path + '/Photos/1.jpg', None, False),
+                (remote_path, 'test_12345', True),
+                (remote_path + '/Photos', 'photos_id', True),
+                (remote_path + '/Photos/1.jpg', 'photo_1_id', False)]:
+            if idn:
+                item = GDriveFS()
+                item.set_path_id(path, idn, isDir)
+                if not isDir:
+                    item._size = 9
+                    item._md5 = 'a1f5c9df5f7c8c2e3d4a1d8c5ca4e1d2'
+            else:
+                item = LinuxFS(path, isDir)
+            db.add(item)
+
+    def tearDown(self):
+        db.close()
+        shutil.rmtree(local_path, ignore_errors=True)
+        if os.path.isfile(self.test_database):
+            os.remove(self.test_database)
+
+    def _scan(self):
+        for item in db.get_all_local():
+            if not item.exists:
+                item.trashed = True
+                self.sync.add(item)
+        root = LinuxFS(local_path, True)
+        root.list_dir(recursive=True)
+        stack = [root]
+        while stack:
+            d = stack.pop()
+            for child in d.children:
+                if not db.file_exists(child):
+                    self.sync.add(child)
+                if child.is_dir():
+                    stack.append(child)
+
+    def test_local_move_detection(self):
+        os.rename(os.path.join(local_path, 'Photos'),
+                  os.path.join(local_path, 'Album'))
+        with open(os.path.join(local_path, 'Album', '2.jpg'), 'w') as fp:
+            fp.write('photo two')
+        self._scan()
+
+        self.assertEqual(self.sync._detect_local_moves(), 1)
+        task, item, old = self.sync._sync_queue[0]
+        self.assertEqual(task, sync.Task.move)
+        self.assertEqual(item.path, local_path + '/Album')
+        self.assertEqual(old.path, local_path + '/Photos')
+
+        # only the new file is left for checking
+        self.assertEqual([x.path for x in self.sync._check_queue],
+                         [local_path + '/Album/2.jpg'])
+
+    def test_remote_move(self):
+        change = GDriveFS()
+        change.set_object({
+            'id': 'photos_id',
+            'name': 'Album',
+            'mimeType': 'application/vnd.google-apps.folder',
+            'parents': ['test_12345'],
+        }, None)
+        self.sync.add(change)
+
+        self.assertEqual(self.sync._detect_remote_moves(), 1)
+        self.assertFalse(self.sync._check_queue)
+        task, item, old = self.sync._sync_queue[0]
+        self.assertEqual(task, sync.Task.move)
+        self.assertEqual(old.path, remote_path + '/Photos')
+
+        self.sync._move(db.resolve_path(item), old)()
+        self.assertTrue(os.path.isfile(local_path + '/Album/1.jpg'))
+        self.assertFalse(os.path.exists(local_path + '/Photos'))
+        self.assertEqual(db.get_file_by_id('photo_1_id').path,
+                         remote_path + '/Album/1.jpg')
+        self.assertTrue(db.file_exists(
+            LinuxFS(local_path + '/Album/1.jpg', False)))
+
+    def test_find_duplicate(self):
+        fp = LinuxFS(local_path + '/Photos/1.jpg')
+        self.assertIsNone(db.find_duplicate(fp))
+
+        # same content as the remote file
+        db.Record.update(md5=fp.md5()).where(
+            db.Record.id_str == 'photo_1_id').execute()
+        with open(local_path + '/copy.jpg', 'w') as f:
+            f.write('photo one')
+
+        dup = db.find_duplicate(LinuxFS(local_path + '/copy.jpg'))
+        self.assertIsInstance(dup, GDriveFS)
+        self.assertEqual(dup.id, 'photo_1_id')
+
+    def test_find_local_duplicate(self):
+        fp = LinuxFS(local_path + '/Photos/1.jpg')
+        rf = GDriveFS()
+        rf.set_object({
+            'id': 'photo_2_id',
+            'name': '2.jpg',
+            'mimeType': 'image/jpeg',
+            'parents': ['photos_id'],
+            'size': '9',
+            'md5Checksum': fp.md5(),
+        }, remote_path + '/Photos')
+
+        dup = db.find_duplicate(rf)
+        self.assertIsInstance(dup, LinuxFS)
+        self.assertEqual(dup.path, fp.path)
+
+        target = LinuxFS(local_path + '/Photos/2.jpg', False)
+        rf.upload_or_download(target, dup)
+        self.assertTrue(utils._do_cmp(fp.path, target.path))
+
+        # local file changed after it was recorded
+        with open(fp.path, 'w') as f:
+            f.write('photo one, edited')
+        self.assertIsNone(db.find_duplicate(rf))
+
+    def test_journal_resume(self):
+        change = GDriveFS()
+        change.set_object({
+            'id': 'photos_id',
+            'name': 'Album',
+            'mimeType': 'application/vnd.google-apps.folder',
+            'parents': ['test_12345'],
+        }, None)
+        self.sync.add(change)
+        self.sync._detect_remote_moves()
+        self.sync.set_change_token('1234')
+        db.journal_add(self.sync._sync_queue)
+
+        # interrupted before execution, a new run resumes the task
+        resumed = sync.Sync([], self.sync.settings)
+        resumed._login = True
+        self.assertEqual(resumed.resume(), 1)
+        self.assertTrue(os.path.isfile(local_path + '/Album/1.jpg'))
+        self.assertEqual(db.get_file_by_id('photo_1_id').path,
+                         remote_path + '/Album/1.jpg')
+        self.assertFalse(db.journal_pending())
+
+        # change token was not applied by the interrupted run
+        self.assertIsNone(db.getChangeToken())
+
+    def test_journal_resume_transferred(self):
+        fp = LinuxFS(local_path + '/Photos/1.jpg')
+        rf = GDriveFS()
+        rf.set_object({
+            'id': 'photo_2_id',
+            'name': '2.jpg',
+            'mimeType': 'image/jpeg',
+            'parents': ['photos_id'],
+            'size': '9',
+            'md5Checksum': fp.md5(),
+        }, remote_path + '/Photos')
+        db.add(rf)
+        task = (sync.Task.load, rf, None)
+        jid = db.journal_add([task])[0]
+
+        # crashed after the transfer, before it's database writes
+        self.sync._run_task(*task, jid)
+        target = LinuxFS(local_path + '/Photos/2.jpg', False)
+        self.assertTrue(target.exists)
+        self.assertFalse(db.file_exists(target))
+
+        def transfer(*args):
+            raise AssertionError("transferred again")
+        saved, GDriveFS.upload_or_download = \
+            GDriveFS.upload_or_download, transfer
+        try:
+            resumed = sync.Sync([], self.sync.settings)
+            resumed._login = True
+            self.assertEqual(resumed.resume(), 1)
+        finally:
+            GDriveFS.upload_or_download = saved
+
+        # done and cleared, not failed
+        self.assertFalse(db.Journal.select().exists())
+        self.assertTrue(db.file_exists(target))
+        self.assertEqual(db.get_mirror(target).id, 'photo_2_id')
+
+    def test_journal_retry(self):
+        rf = GDriveFS()
+        rf.set_path_id(remote_path + '/Photos/1.jpg', 'some_id', False)
+        task = (sync.Task.delete, rf, None)
+        jid = db.journal_add([task])[0]
+        self.sync._sync_queue, self.sync._journal_ids = [task], [jid]
+
+        def fail(*args):
+            def writes():
+                db.remove(rf)
+                raise IOError("disk full")
+            return writes
+        self.sync._run_task = fail
+
+        # the task fails and is kept for a retry
+        self.assertTrue(self.sync.execute_next())
+        self.assertFalse(db.journal_pending())
+        self.assertFalse(db.journal_retry())
+        self.assertEqual(db.Journal.get_by_id(jid).error_class, 'OSError')
+
+        # database changes of the failed task were rolled back
+        self.assertTrue(db.file_exists(rf))
+
+        for i in range(db.RETRY_ATTEMPTS - 1):
+            db.journal_failed(jid, IOError("network down"))
+        self.assertEqual(db.journal_quarantined(), 1)
+        self.assertEqual(db.journal_release(), 1)
+        self.assertEqual(len(db.journal_retry()), 1)
+
+    def test_subtree_delete(self):
+        shutil.rmtree(os.path.join(local_path, 'Photos'))
+        self._scan()
+        self.sync._check_queue_batch()
+        self.assertEqual(len(self.sync._sync_queue), 2)
+
+        # the file is removed with it's directory
+        self.assertEqual(self.sync._drop_covered_deletes(), 1)
+        task, item, mirror = self.sync._sync_queue[0]
+        self.assertEqual((task, item.path),
+                         (sync.Task.delete, local_path + '/Photos'))
+
+        rd = GDriveFS()
+        rd.set_path_id(remote_path + '/Photos', 'photos_id', True)
+        self.assertEqual(db.remove(item), 2)
+        self.assertEqual(db.remove(rd), 2)
+        self.assertFalse(db.Record.select().where(
+            (db.Record.name == '1.jpg') &
+            (db.Record.deleted == False)).exists())
+
+    def test_gc(self):
+        dp = LinuxFS(local_path + '/Photos', True)
+        self.assertEqual(db.remove(dp), 2)
+        self.assertEqual(db.gc(), 0)
+
+        old = datetime.utcnow() - timedelta(days=db.TOMBSTONE_DAYS + 1)
+        db.Record.update(time_updated=old).where(
+            db.Record.deleted == True).execute()
+
+        # an unfinished task keeps the tombstone of it's item only
+        db.journal_add([(sync.Task.delete, dp, None)])
+        self.assertEqual(db.gc(), 1)
+        self.assertEqual(db.stats()['tombstones'], 1)
+
+        # a quarantined task does not, a live record under a tombstone does
+        db.Journal.update(status=db.JournalStatus.quarantined).execute()
+        db.Record.update(parent=db.get_record_by_id(dp.path).id).where(
+            db.Record.id_str == 'test_12345').execute()
+        self.assertEqual(db.gc(), 0)
+        db.Record.update(parent=None).where(
+            db.Record.id_str == 'test_12345').execute()
+        self.assertEqual(db.gc(), 1)
+        self.assertEqual(db.stats()['tombstones'], 0)
+        self.assertEqual(
+            db._db.execute_sql("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+        # the pages of the purged records are returned to the filesystem
+        db.Record.insert_many([{
+            'name': 'old_%d' % i, 'fstype': db.FileType.LinuxFS,
+            'path': local_path + '/old_%d' % i, 'status': db.Status.synced,
+            'deleted': True, 'time_updated': old} for i in range(3000)]
+        ).execute()
+        db.Record.delete().where(db.Record.name << [
+            'old_%d' % i for i in range(0, 3000, 2)]).execute()
+        before = db.stats()
+        self.assertGreater(before['free'], 0)
+        self.assertEqual(db.gc(), 1500)
+        after = db.stats()
+        self.assertLess(after['size'], before['size'])
+        self.assertEqual(after['free'], 0)
+
+    def test_dir_signatures(self):
+        self.assertEqual(db.refresh_signatures(), 4)
+        self.assertEqual(len(db.get_dir_signatures(db.FileType.DriveFS)), 2)
+        self.assertEqual(
+            utils.tree_signature([('a', False, 1, 2), ('b', True, None, 3)]),
+            utils.tree_signature([('b', True, None, 3), ('a', False, 1, 2)]))
+
+        root = LinuxFS(local_path, True)
+        root.list_dir(recursive=True)
+        self.assertEqual(self.sync.unchanged_dirs(root),
+                         {local_path, local_path + '/Photos'})
+
+        # a new file changes it's directory and the ones above
+        with open(os.path.join(local_path, 'Photos', '2.jpg'), 'w') as fp:
+            fp.write('photo two')
+        root.list_dir(recursive=True)
+        self.assertEqual(self.sync.unchanged_dirs(root), set())
+
+        db.add(LinuxFS(local_path + '/Photos/2.jpg'))
+        self.assertFalse(db.get_dir_signatures(db.FileType.LinuxFS))
+        self.assertEqual(db.refresh_signatures(), 2)
+        self.assertEqual(self.sync.unchanged_dirs(root),
+                         {local_path, local_path + '/Photos'})
+
+    def test_adopt_matching(self):
+        db.Record.delete().execute()
+        with open(os.path.join(local_path, 'Photos', '2.jpg'), 'w') as fp:
+            fp.write('photo two')
+        local = LinuxFS(local_path, True)
+        local.list_dir(recursive=True)
+
+        remote, photos, same, other = [GDriveFS() for i in range(4)]
+        remote.set_path_id(remote_path, 'test_12345', True)
+        photos.set_path_id(remote_path + '/Photos', 'photos_id', True)
+        same.set_path_id(remote_path + '/Photos/1.jpg', 'photo_1_id', False)
+        same._size, same._md5 = 9, hashlib.md5(b'photo one').hexdigest()
+        other.set_path_id(remote_path + '/Photos/2.jpg', 'photo_2_id', False)
+        other._size, other._md5 = 9, hashlib.md5(b'photo 2!!').hexdigest()
+        remote.children, photos.children = [photos], [same, other]
+
+        # the root, Photos and 1.jpg, 2.jpg has the same size only
+        self.assertEqual(self.sync.adopt_matching(local, remote), 3)
+        lf = LinuxFS(local_path + '/Photos/1.jpg')
+        self.assertEqual(db.get_mirror(lf).id, 'photo_1_id')
+        self.assertEqual(db.get_record_by_id('photo_1_id').parent.id_str,
+                         'photos_id')
+        self.assertFalse(db.file_exists(LinuxFS(local_path + '/Photos/2.jpg')))
+
+        # the rest is found by the scan
+        self.assertEqual(self.sync.unchanged_dirs(local), set())
+        self.assertEqual(self.sync.adopt_matching(local, remote), 0)
+
+    def test_sync_modes(self):
+        lf = LinuxFS(local_path + '/Photos/1.jpg')
+        new = LinuxFS(local_path + '/Photos/2.jpg', False)
+        rf = GDriveFS()
+        rf.set_path_id(remote_path + '/Photos/3.jpg', 'photo_3_id', False)
+        queue = [(sync.Task.update, lf, None), (sync.Task.create, new, None),
+                 (sync.Task.load, rf, None), (sync.Task.conflict, lf, rf)]
+
+        results = {}
+        for mode in sync.Mode.all:
+            s = sync.Sync([], utils.AttrDict({'ignore_paths': [],
+                                              'token_pickle': None,
+                                              'mode': mode}))
+            s._sync_queue = list(queue)
+            s._apply_mode()
+            results[mode] = [(t, i.path) for t, i, m in s._sync_queue]
+
+        self.assertEqual(len(results[sync.Mode.sync]), 4)
+        self.assertEqual(results[sync.Mode.upload], [
+            (sync.Task.update, lf.path), (sync.Task.create, new.path),
+            (sync.Task.conflict, lf.path)])
+        self.assertEqual(results[sync.Mode.download], [
+            (sync.Task.load, rf.path), (sync.Task.conflict, lf.path)])
+        # local edits are reverted, new local files removed
+        self.assertEqual(results[sync.Mode.mirror], [
+            (sync.Task.restore, lf.path), (sync.Task.discard, new.path),
+            (sync.Task.load, rf.path), (sync.Task.conflict, lf.path)])
+
+        with self.assertRaises(ValueError):
+            sync.Sync([], utils.AttrDict({'ignore_paths': [], 'mode': 'both'}))
+
+    def test_transfer_window(self):
+        # a window that is not now, in an hour for an hour
+        now = datetime.now()
+        start, end = now + timedelta(hours=1), now + timedelta(hours=2)
+        s = sync.Sync([], utils.AttrDict({
+            'ignore_paths': [], 'token_pickle': None,
+            'sync_window': '%s-%s' % (start.strftime('%H:%M'),
+                                      end.strftime('%H:%M'))}))
+        self.assertFalse(s.scheduler.allowed())
+
+        new = LinuxFS(local_path + '/Photos/2.jpg', False)
+        dp = LinuxFS(local_path + '/Photos', True)
+        s._sync_queue = [(sync.Task.load, new, None),
+                         (sync.Task.nochange, dp, None)]
+        s._sync_queue.sort(key=s._schedule_key)
+        self.assertEqual(s._sync_queue[0][0], sync.Task.nochange)
+        s._sync_queue.pop(0)
+        s._journal_ids = db.journal_add(s._sync_queue)
+
+        # the transfer is not started and stays pending for a later run
+        self.assertTrue(s.execute_next())
+        self.assertFalse(s.execute_next())
+        self.assertEqual(len(db.journal_pending()), 1)
+
+        # other tasks still run outside the window
+        old = LinuxFS(local_path + '/Photos/old.jpg', False)
+        db.add(old)
+        old.trashed = True
+        db.journal_add([(sync.Task.delete, old, None)])
+        s._login = True
+        self.assertEqual(s.resume(), 1)
+        self.assertFalse(db.file_exists(old))
+        self.assertEqual(len(db.journal_pending()), 1)
+
+        # and is not journaled again when found by the next scan
+        s._sync_queue = [(sync.Task.load, new, None)]
+        self.assertEqual(s._drop_journaled(), 1)
+
+        # a conflict copies a file unless skipped by a non interactive run
+        self.assertTrue(s._is_transfer(sync.Task.conflict, new))
+        s._interactive = False
+        self.assertFalse(s._is_transfer(sync.Task.conflict, new))
+        s.mode = sync.Mode.upload
+        self.assertTrue(s._is_transfer(sync.Task.conflict, new))
+
+    def test_failing_task_quarantined(self):
+        # not in database, updating it fails every time
+        with open(os.path.join(local_path, 'Photos', '2.jpg'), 'w') as fp:
+            fp.write('photo two')
+        item = LinuxFS(local_path + '/Photos/2.jpg')
+
+        s = self.sync
+        for i in range(db.RETRY_ATTEMPTS + 2):
+            # found again by each scan
+            s._sync_queue = [(sync.Task.update, item, None)]
+            s._drop_journaled()
+            s._journal_ids = db.journal_add(s._sync_queue)
+            s._execute()
+
+            # and retried when due
+            db.Journal.update(next_try=datetime.utcnow()).execute()
+            pending = db.journal_retry()
+            s._journal_ids = [jid for jid, task in pending]
+            s._sync_queue = [task for jid, task in pending]
+            s._execute()
+
+        self.assertEqual(
+            [e.status for e in db.Journal.select()],
+            [db.JournalStatus.quarantined])
+
+    def test_pair(self):
+        lf = LinuxFS(local_path + '/Photos/1.jpg')
+        rf = GDriveFS()
+        rf.set_path_id(remote_path + '/Photos/1.jpg', 'photo_1_id', False)
+
+        # paired when synced, the database file was new
+        self.assertFalse(db.Pair.select().exists())
+        self.assertTrue(db.pair(lf, rf))
+
+        # found from the pair even if the paths do not match anymore
+        db.Record.update(path=remote_path + '/Other/1.jpg').where(
+            db.Record.id_str == 'photo_1_id').execute()
+        self.assertTrue(db.mirror_exists(lf))
+        self.assertEqual(db.get_mirror(lf).id, 'photo_1_id')
+
+        # last synced signature is the base of the comparison
+        db.Record.update(md5='0' * 32).where(
+            db.Record.path == lf.path).execute()
+        self.assertEqual(db.get_file_as_db(lf).md5(), lf.md5())
+
+        db.remove(lf)
+        self.assertFalse(db.Pair.select().exists())
+        self.assertFalse(db.mirror_exists(lf))
+
+    def test_pair_existing(self):
+        db._pair_existing()
+        pairs = [(p.local.path, p.remote.path) for p in db.Pair.select()]
+        self.assertIn((local_path + '/Photos/1.jpg',
+                       remote_path + '/Photos/1.jpg'), pairs)
+        self.assertIn((local_path + '/Photos', remote_path + '/Photos'), pairs)
+
+    def test_check_queue_batch(self):
+        photos = os.path.join(local_path, 'Photos')
+        for name, content in [('1.jpg', 'photo one, edited'), ('a', 'one'),
+                              ('b', 'two'), ('c', 'three')]:
+            with open(os.path.join(photos, name), 'w') as fp:
+                fp.write(content)
+        os.makedirs(os.path.join(photos, 'D'))
+
+        def remote(name, content):
+            rf = GDriveFS()
+            rf.set_path_id(remote_path + '/Photos/' + name, 'id_' + name, False)
+            rf._size = len(content)
+            rf._md5 = hashlib.md5(content.encode()).hexdigest()
+            return rf
+
+        # deleted locally since the last sync
+        gone = LinuxFS(photos + '/d', False)
+        rec = db._record_object_from_file(gone)
+        rec.size, rec.md5 = 3, hashlib.md5(b'one').hexdigest()
+        rec.save()
+        gone.trashed = True
+
+        # reported by id and parent only
+        new = remote('e', 'one')
+        new.path, new.parentIds = None, ['photos_id']
+
+        self.sync._check_queue = [
+            LinuxFS(photos + '/1.jpg'), LinuxFS(photos + '/a'),
+            remote('b', 'two'), LinuxFS(photos + '/b'),
+            LinuxFS(photos + '/c'), remote('c', 'one'),
+            gone, new, LinuxFS(photos + '/D', True)]
+        self.sync._check_queue_batch()
+        self.assertEqual(self.sync._check_queue, [])
+        self.assertEqual([
+            (task, type(item).__name__, item.path, mirror and mirror.path)
+            for task, item, mirror in self.sync._sync_queue], [
+            (sync.Task.update, 'LinuxFS', photos + '/1.jpg', None),
+            (sync.Task.load, 'LinuxFS', photos + '/a', None),
+            (sync.Task.nochange, 'GDriveFS', remote_path + '/Photos/b',
+             photos + '/b'),
+            (sync.Task.conflict, 'LinuxFS', photos + '/c',
+             remote_path + '/Photos/c'),
+            (sync.Task.delete, 'LinuxFS', photos + '/d', None),
+            (sync.Task.load, 'GDriveFS', remote_path + '/Photos/e', None),
+            (sync.Task.create, 'LinuxFS', photos + '/D', None)])
+
+    def test_database_move(self):
+        dp = LinuxFS(local_path + '/Photos', True)
+        self.assertEqual(db.move(dp, local_path + '/Album'), 2)
+        self.assertTrue(db.file_exists(LinuxFS(local_path + '/Album', True)))
+        self.assertTrue(db.file_exists(
+            LinuxFS(local_path + '/Album/1.jpg', False)))
+        self.assertFalse(db.file_exists(dp))
+        rec = db.get_record_by_id(local_path + '/Album/1.jpg')
+        self.assertEqual(rec.name, '1.jpg')
+
+    def test_parent_links(self):
+        dp = LinuxFS(local_path + '/Photos', True)
+        self.assertEqual([c.path for c in db.get_children(dp)],
+                         [local_path + '/Photos/1.jpg'])
+
+        # records added before their directory are linked to it
+        db.add(LinuxFS(local_path + '/Album/Day/2.jpg', False))
+        db.add(LinuxFS(local_path + '/Album/Day', True))
+        db.add(LinuxFS(local_path + '/Album', True))
+        day = db.get_record_by_id(local_path + '/Album/Day')
+        self.assertEqual(day.parent.path, local_path + '/Album')
+        self.assertEqual(day.parent.parent.path, local_path)
+
+        # a move follows the links and reparents the moved directory
+        self.assertEqual(db.move(LinuxFS(local_path + '/Album', True),
+                                 local_path + '/Photos/Album'), 3)
+        rec = db.get_record_by_id(local_path + '/Photos/Album/Day/2.jpg')
+        self.assertEqual(rec.parent.parent.parent.path, local_path + '/Photos')
+        self.assertEqual(len(db.get_children(dp)), 2)
+
+        rf = GDriveFS()
+        rf.set_path_id(remote_path + '/Photos/1.jpg', 'photo_1_id', False)
+        self.assertEqual(db.get_file_as_db(rf).parentIds, ['photos_id'])
+
+
+class TestRoots(unittest.TestCase):
+    settings_file = 'test_settings.json'
+
+    def setUp(self):
+        utils.save_dict({
+            'token_pickle': 'test_token.pk',
+            'roots': [
+                {'local_root_path': local_path + '/A',
+                 'remote_root_path': '/A',
+                 'db_file': 'test_db_a.sqlite'},
+                {'local_root_path': local_path + '/B',
+                 'remote_root_path': '/B',
+                 'db_file': 'test_db_b.sqlite'},
+            ]
+        }, self.settings_file)
+        self.client = PyGDClient(self.settings_file)
+
+    def tearDown(self):
+        db.close_all()
+        for path in [self.settings_file, 'test_db_a.sqlite', 'test_db_b.sqlite']:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def test_roots(self):
+        a, b = self.client.roots
+        self.assertIs(self.client.root, a)
+        self.assertEqual(b.settings.token_pickle, 'test_token.pk')
+        self.assertEqual(b.settings.local_root_path, local_path + '/B')
+
+        self.client.activate(b)
+        db.setLastSync("2019-05-21T12:10:12")
+        self.client.activate(a)
+        self.assertIsNone(db.getLastSync())
+        self.client.activate(b)
+        self.assertEqual(db.getLastSync(), "2019-05-21T12:10:12")
+
+        self.assertIs(self.client._root_of(local_path + '/B/1.jpg'), b)
+        self.assertIsNone(self.client._root_of(local_path + '/C'))
+
+    def test_route_changes(self):
+        a, b = self.client.roots
+        root = GDriveFS()
+        root.set_path_id('/A', 'a_id', True)
+        db.add(root)
+
+        # a file listed before it's folder, which is new as well
+        folder, photo, other = GDriveFS(), GDriveFS(), GDriveFS()
+        photo.set_object({'id': 'photo_id', 'name': '1.jpg',
+                          'mimeType': 'image/jpeg',
+                          'parents': ['folder_id']}, None)
+        folder.set_object({'id': 'folder_id', 'name': 'Album',
+                           'mimeType': 'application/vnd.google-apps.folder',
+                           'parents': ['a_id']}, None)
+        other.set_object({'id': 'other_id', 'name': '2.jpg',
+                          'mimeType': 'image/jpeg',
+                          'parents': ['unknown_id']}, None)
+        changes = [photo, folder, other]
+
+        self.assertEqual([i.id for i in self.client._route_changes(changes)],
+                         ['photo_id', 'folder_id'])
+        self.client.activate(b)
+        self.assertEqual(self.client._route_changes(changes), [])
+
+    def test_shared_poll(self):
+        a, b = self.client.roots
+        for root, path, token in [(a, '/A', '5'), (b, '/B', '9')]:
+            self.client.activate(root)
+            rf = GDriveFS()
+            rf.set_path_id(path, path + '_id', True)
+            db.add(rf)
+            db.setChangeToken(token)
+
+        service = FakeChanges([{'id': 'photo_id', 'name': '1.jpg',
+                                'mimeType': 'image/jpeg',
+                                'parents': ['/A_id']}])
+        saved, auth.service = auth.service, service
+        try:
+            for root in self.client.roots:
+                root.sync._login = True
+            self.assertEqual(self.client._poll_remote_changes([a, b]), 1)
+        finally:
+            auth.service = saved
+
+        # one poll from the oldest token, both roots take the new one
+        self.assertEqual(service.polled, ['5'])
+        for root in [a, b]:
+            self.client.activate(root)
+            root.sync.commit_change_token()
+            self.assertEqual(db.getChangeToken(), '12')
+        self.assertEqual(len(a.sync._check_queue), 1)
+        self.assertFalse(b.sync._check_queue)
+
+
+class FakeChanges:
+    """ Minimal changes().list() of the Drive api, one page. """
+
+    def __init__(self, files):
+        self.files = files
+        self.polled = []
+
+    def changes(self):
+        return self
+
+    def list(self, pageToken, spaces, fields):
+        self.polled.append(pageToken)
+        return self
+
+    def execute(self):
+        return {'changes': [{'file': f} for f in self.files],
+                'newStartPageToken': '12'}
+
+
+class FakeDrive:
+    """ Minimal files().list() of the Drive api over an in-memory
+        tree, failing after a given number of requests. """
+    page_size = 50
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.fail_after = None
+        self.pages = []
+
+    def files(self):
+        return self
+
+    def list(self, q, fields, pageSize, pageToken=None):
+        self._request = (q.split("'")[1], int(pageToken or 0))
+        return self
+
+    def changes(self):
+        return self
+
+    def getStartPageToken(self):
+        self._request = None
+        return self
+
+    def execute(self):
+        if self._request is None:
+            return {'startPageToken': 'start_token'}
+
+        if self.fail_after is not None:
+            if self.fail_after == 0:
+                raise IOError("Connection reset")
+            self.fail_after -= 1
+
+        idn, offset = self._request
+        self.pages.append(self._request)
+        children = self.tree.get(idn, [])
+        results = {'files': children[offset:offset + self.page_size]}
+        if offset + self.page_size < len(children):
+            results['nextPageToken'] = str(offset + self.page_size)
+        return results
+
+
+class TestRemoteScan(unittest.TestCase):
+    settings_file = 'test_settings.json'
+    test_database = 'test_database.sqlite'
+
+    def setUp(self):
+        utils.save_dict({
+            'token_pickle': 'test_token.pk',
+            'local_root_path': local_path,
+            'remote_root_path': remote_path,
+            'db_file': self.test_database,
+        }, self.settings_file)
+        self.client = PyGDClient(self.settings_file)
+        db.setRootId('root_id')
+
+        # three levels of directories, some with several pages
+        random.seed(36)
+        self.tree = {}
+        self.paths = set()
+        self._make_dir('root_id', remote_path, 3)
+        self.service = FakeDrive(self.tree)
+        self.saved_service = auth.service
+        auth.service = self.service
+
+    def tearDown(self):
+        auth.service = self.saved_service
+        db.close_all()
+        for path in [self.settings_file, self.test_database]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _make_dir(self, idn, path, depth):
+        children = []
+        for i in range(random.randint(0, 120) if depth < 3 else 60):
+            name = 'file_%d' % i
+            children.append({'id': idn + '/' + name, 'name': name,
+                             'mimeType': 'image/jpeg', 'parents': [idn]})
+            self.paths.add(os.path.join(path, name))
+        for i in range(random.randint(1, 4) if depth else 0):
+            name = 'dir_%d' % i
+            children.append({'id': idn + '/' + name, 'name': name,
+                             'mimeType': 'application/vnd.google-apps.folder',
+                             'parents': [idn]})
+            self.paths.add(os.path.join(path, name))
+            self._make_dir(idn + '/' + name, os.path.join(path, name), depth - 1)
+        self.tree[idn] = children
+
+    def _tree_paths(self, directory):
+        paths = set()
+        for child in directory.children:
+            paths.add(child.path)
+            if child.is_dir():
+                paths |= self._tree_paths(child)
+        return paths
+
+    def test_scan_resume(self):
+        failures = 0
+        while True:
+            self.service.fail_after = random.randint(0, 4)
+            try:
+                self.client.build_remote_tree()
+                break
+            except IOError:
+                failures += 1
+
+        self.assertGreater(failures, 0)
+        self.assertEqual(self._tree_paths(self.client.remote_root), self.paths)
+
+        # every page was listed once, none repeated after a failure
+        self.assertEqual(len(self.service.pages), len(set(self.service.pages)))
+        self.assertFalse(db.scan_started('root_id'))
+
+    def test_full_scan_token(self):
+        os.makedirs(local_path)
+        try:
+            self.client.sync._login = True
+            self.client.scan(full_scan=True)
+        finally:
+            shutil.rmtree(local_path)
+
+        # taken before the listing, saved with the queued changes
+        self.client.sync.commit_change_token()
+        self.assertEqual(db.getChangeToken(), 'start_token')
+
+
+@unittest.skipUnless(snapshot.available(), "numpy not installed")
+class TestSnapshot(unittest.TestCase):
+    settings_file = 'test_settings.json'
+    test_database = 'test_database.sqlite'
+
+    def setUp(self):
+        utils.save_dict({
+            'token_pickle': 'test_token.pk',
+            'local_root_path': local_path,
+            'remote_root_path': remote_path,
+            'db_file': self.test_database,
+        }, self.settings_file)
+        self.client = PyGDClient(self.settings_file)
+
+        os.makedirs(os.path.join(local_path, 'Photos', 'Old'))
+        for name in ['1.jpg', '2.jpg', 'Old/3.jpg', 'Old/4.jpg']:
+            with open(os.path.join(local_path, 'Photos', name), 'w') as fp:
+                fp.write('photo ' + name)
+        self.client.build_local_tree()
+        stack = [self.client.local_root]
+        while stack:
+            item = stack.pop()
+            db.add(item)
+            stack.extend(item.children)
+        self.client._save_snapshots()
+
+    def tearDown(self):
+        db.close_all()
+        shutil.rmtree(local_path, ignore_errors=True)
+        for path in [self.settings_file, self.test_database,
+                     self.test_database + '.snapshot.npy',
+                     self.test_database + '.snapshot.paths']:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _queued(self):
+        queued = {(item.path, item.trashed) for item in
+                  self.client.sync._check_queue}
+        self.client.sync._check_queue = []
+        return queued
+
+    def test_snapshot_diff(self):
+        photos = os.path.join(local_path, 'Photos')
+        with open(os.path.join(photos, '1.jpg'), 'w') as fp:
+            fp.write('photo one, edited')
+        os.utime(os.path.join(photos, '2.jpg'))
+        os.remove(os.path.join(photos, 'Old', '4.jpg'))
+        with open(os.path.join(photos, 'Old', '5.jpg'), 'w') as fp:
+            fp.write('photo five')
+
+        self.client._scan_local()
+        self.assertEqual(self._queued(), {
+            (os.path.join(photos, '1.jpg'), False),
+            (os.path.join(photos, 'Old', '4.jpg'), True),
+            (os.path.join(photos, 'Old', '5.jpg'), False)})
+
+        # snapshot is used once, same result checking every record
+        self.assertIsNone(Snapshot.load(self.client._snapshot_file()))
+        self.client._scan_local()
+        self.assertEqual(self._queued(), {
+            (os.path.join(photos, '1.jpg'), False),
+            (os.path.join(photos, 'Old', '4.jpg'), True),
+            (os.path.join(photos, 'Old', '5.jpg'), False)})
+
+    def test_watch_rename(self):
+        for path, is_dir in [('Photos', True), ('Photos/1.jpg', False),
+                             ('Photos/2.jpg', False), ('Photos/Old', True),
+                             ('Photos/Old/3.jpg', False),
+                             ('Photos/Old/4.jpg', False)]:
+            rf = GDriveFS()
+            rf.set_path_id(remote_path + '/' + path, path + '_id', is_dir)
+            db.add(rf)
+
+        photos = os.path.join(local_path, 'Photos')
+        album = os.path.join(local_path, 'Album')
+        os.rename(photos, album)
+        self.client._add_sync_paths([photos, album])
+
+        s = self.client.sync
+        self.assertEqual(s._detect_local_moves(), 1)
+        s._check_queue_batch()
+        self.assertEqual([(t, i.path) for t, i, m in s._sync_queue],
+                         [(sync.Task.move, album)])
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        os.makedirs(os.path.join(local_path, 'Photos'))
+
+    def tearDown(self):
+        shutil.rmtree(local_path, ignore_errors=True)
+
+    def test_parse(self):
+        self.assertEqual(scheduler.parse_duration('90'), 90)
+        self.assertEqual(scheduler.parse_duration('1h30m'), 5400)
+        self.assertRaises(ValueError, scheduler.parse_duration, '2 days')
+
+        window = scheduler.parse_window('22:30-06:00')
+        self.assertEqual(window, (1350, 360))
+        self.assertTrue(scheduler.in_window(window, datetime(2020, 1, 1, 23)))
+        self.assertTrue(scheduler.in_window(window, datetime(2020, 1, 1, 5)))
+        self.assertFalse(scheduler.in_window(window, datetime(2020, 1, 1, 6)))
+        self.assertRaises(ValueError, scheduler.parse_window, '25:00-01:00')
+
+    def test_order(self):
+        sizes = {'big.raw': 5000, 'small.jpg': 10, 'medium.jpg': 100,
+                 'old.jpg': 100}
+        for name, size in sizes.items():
+            with open(os.path.join(local_path, 'Photos', name), 'wb') as fp:
+                fp.write(b'x' * size)
+        os.utime(os.path.join(local_path, 'Photos', 'old.jpg'), (0, 0))
+        items = [LinuxFS(os.path.join(local_path, 'Photos', name), False)
+                 for name in sizes]
+
+        def order(settings):
+            sched = scheduler.Scheduler(settings)
+            return [i.name for i in sorted(items, key=sched.key)]
+
+        self.assertEqual(order({}), [
+            'small.jpg', 'medium.jpg', 'old.jpg', 'big.raw'])
+        self.assertEqual(order({'priority_paths': {'*.raw': 1}}), [
+            'big.raw', 'small.jpg', 'medium.jpg', 'old.jpg'])
+        self.assertEqual(order({'transfer_order': ['recent', 'small']})[-1],
+                         'old.jpg')
+        self.assertRaises(ValueError, scheduler.Scheduler,
+                          {'transfer_order': ['largest']})
+
+    def test_limits(self):
+        bucket = scheduler.TokenBucket(1000)
+        # a second of burst, then waits for the debt
+        self.assertEqual(bucket.take(1000), 0)
+        self.assertAlmostEqual(bucket.take(500), 0.5, places=2)
+
+        scheduler.set_limits(upload=1024 * 1024)
+        self.assertEqual(scheduler.chunk_size(scheduler.UPLOAD, 10**8),
+                         1024 * 1024)
+        self.assertEqual(scheduler.chunk_size(scheduler.DOWNLOAD, 10**8),
+                         10**8)
+        scheduler.set_limits()
+
+class TestInotify(unittest.TestCase):
+
+    def setUp(self):
+        os.makedirs(os.path.join(local_path, 'Photos'))
+        self.notifier = inotify.Inotify()
+
+    def tearDown(self):
+        self.notifier.close()
+        shutil.rmtree(local_path, ignore_errors=True)
+
+    def test_events(self):
+        self.assertEqual(len(self.notifier.add_watch_recursive(local_path)), 2)
+
+        with open(os.path.join(local_path, 'Photos', '1.jpg'), 'w') as fp:
+            fp.write('photo one')
+        os.rename(os.path.join(local_path, 'Photos'),
+                  os.path.join(local_path, 'Album'))
+
+        events = self.notifier.read_events(1)
+        paths = [e.path for e in events]
+        self.assertIn(os.path.join(local_path, 'Photos', '1.jpg'), paths)
+        moved = [e for e in events if e.mask & inotify.IN_MOVED_TO]
+        self.assertEqual(moved[0].path, os.path.join(local_path, 'Album'))
+        self.assertTrue(moved[0].is_dir())
+
+        # the moved directory keeps it's watch under the new path
+        self.notifier.add_watch_recursive(moved[0].path)
+        self.assertIn(os.path.join(local_path, 'Album'),
+                      self.notifier.watched())
+        self.assertNotIn(os.path.join(local_path, 'Photos'),
+                         self.notifier.watched())
+
+
+class TestControl(unittest.TestCase):
+    socket_path = 'test_control.sock'
+
+    def test_request(self):
+        server = control.ControlServer(self.socket_path)
+        responses = []
+        client = threading.Thread(target=lambda: responses.append(
+            control.request(self.socket_path, "status", timeout=5)))
+        client.start()
+
+        commands = []
+        while not commands:
+            commands = server.accept()
+        conn, command = commands[0]
+        self.assertEqual(command, "status")
+        server.reply(conn, {'ok': True, 'queued': 3})
+
+        client.join()
+        server.close()
+        self.assertEqual(responses, [{'ok': True, 'queued': 3}])
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
 if __name__ == '__main__':
     unittest.main()